@@ -1,3 +1,57 @@
-from django.test import TestCase
+import json
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory, TestCase
+from rest_framework_simplejwt.views import TokenObtainPairView
+
+from chat import middleware
+
+
+class LoginTokenTests(TestCase):
+    """Access tokens from api/users/login/ are what the chat WebSocket accepts."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("ana", password="s3cret-pass")
+        middleware.invalidate_user(self.user.pk)
+
+    def _login(self, password="s3cret-pass"):
+        request = RequestFactory().post(
+            "/api/users/login/", json.dumps({"username": "ana", "password": password}),
+            content_type="application/json",
+        )
+        response = TokenObtainPairView.as_view()(request)
+        response.render()
+        return response.status_code, json.loads(response.content)
+
+    def test_login_token_authenticates_the_websocket(self):
+        status, body = self._login()
+        self.assertEqual(status, 200)
+        user = async_to_sync(middleware.get_user_from_token)(body["access"])
+        self.assertEqual(user.pk, self.user.pk)
+
+        # a reconnect with the same token is answered from the cache
+        with self.assertNumQueries(0):
+            again = async_to_sync(middleware.get_user_from_token)(body["access"])
+        self.assertEqual(again.pk, self.user.pk)
+
+    def test_wrong_password_gets_no_token(self):
+        status, body = self._login(password="wrong")
+        self.assertEqual(status, 401)
+        self.assertNotIn("access", body)
+
+    def test_refresh_token_and_inactive_user_are_anonymous(self):
+        _, body = self._login()
+        self.assertFalse(async_to_sync(middleware.get_user_from_token)(body["refresh"]).is_authenticated)
+
+        self.user.is_active = False
+        self.user.save()  # also drops the cached user
+        self.assertFalse(async_to_sync(middleware.get_user_from_token)(body["access"]).is_authenticated)
+
+    def test_token_from_query_string_or_header(self):
+        self.assertEqual(middleware.get_token_from_scope({"query_string": b"token=abc&x=1"}), "abc")
+        self.assertEqual(
+            middleware.get_token_from_scope({"query_string": b"", "headers": [(b"authorization", b"Bearer xyz")]}),
+            "xyz",
+        )
+        self.assertIsNone(middleware.get_token_from_scope({"query_string": b"", "headers": []}))
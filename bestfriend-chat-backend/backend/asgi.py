@@ -3,23 +3,28 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from chat import routing as api_routing
+from backend.startup import StartupMiddleware, start_preload
 import django
 
-# from chat.middleware import JWTAuthMiddleware
-# from chat.routing import websocket_urlpatterns
-
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 django.setup()
 
-application = ProtocolTypeRouter({
+from chat.middleware import JWTAuthMiddleware  # noqa: E402  (needs the app registry)
+
+application = StartupMiddleware(ProtocolTypeRouter({
     "http": get_asgi_application(),
    
+    # session user first, replaced by the JWT user when a token is sent
     "websocket": AuthMiddlewareStack(
-        URLRouter(
-            api_routing.websocket_urlpatterns
+        JWTAuthMiddleware(
+            URLRouter(
+                api_routing.websocket_urlpatterns
+            )
         )
     ),
-})
+}))
+
+start_preload()
 
 
 
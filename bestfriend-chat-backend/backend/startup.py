@@ -0,0 +1,217 @@
+# backend/startup.py
+import os
+import sys
+import time
+import signal
+import logging
+import asyncio
+import importlib
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+# Import the heavy SDKs in a background thread as soon as the app is loaded
+# (instead of on the first turn that needs them)
+WARM_UP_PRELOAD = os.getenv("WARM_UP_PRELOAD", "1") == "1"
+
+_preload_thread = None
+
+
+def _configured_providers():
+    from chat.providers import CALL_TYPES, get_provider
+    providers = []
+    for call_type in CALL_TYPES:
+        provider = get_provider(call_type)
+        if provider not in providers:
+            providers.append(provider)
+    return providers
+
+
+def _modules_to_preload():
+    from memory.recall import RECALL_ENABLED
+    modules = []
+    for provider in _configured_providers():
+        modules.extend(m for m in provider.modules if m not in modules)
+    if RECALL_ENABLED:
+        modules.append("numpy")
+    return modules
+
+
+def preload_modules():
+    """Import what the configured backends will need; returns {module: ms}."""
+    timings = {}
+    for name in _modules_to_preload():
+        started = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            logger.warning("preload of %s failed: %s", name, e)
+            continue
+        timings[name] = round((time.perf_counter() - started) * 1000, 1)
+    return timings
+
+
+def start_preload():
+    """Kick off preload_modules() in a daemon thread (once per process)."""
+    global _preload_thread
+    if WARM_UP_PRELOAD and _preload_thread is None:
+        _preload_thread = threading.Thread(target=preload_modules, name="preload", daemon=True)
+        _preload_thread.start()
+
+
+def _open_db_connection():
+    from django.db import connection
+    connection.ensure_connection()
+
+
+async def warm_up():
+    """
+    Open long-lived resources before the first chat turn needs them: the
+    heavy imports, DB connections for the auth lookups (database_sync_to_async)
+    and for every thread of the memory DB executor, and the upstream
+    connection pool of every configured model backend.
+    """
+    from channels.db import database_sync_to_async
+    from memory.db import get_db_executor, run_db
+
+    started = time.perf_counter()
+    # imports first: building a client imports its SDK on the event loop otherwise
+    await asyncio.to_thread(_preload_thread.join if _preload_thread is not None else preload_modules)
+    imports_done = time.perf_counter()
+
+    try:
+        await database_sync_to_async(_open_db_connection)()
+        await asyncio.gather(*(run_db(_open_db_connection) for _ in range(get_db_executor().max_workers)))
+    except Exception as e:
+        logger.warning("database warm-up failed: %s", e)
+    db_done = time.perf_counter()
+
+    for provider in _configured_providers():
+        try:
+            await provider.warm_up()
+        except Exception as e:
+            logger.warning("%s backend warm-up failed: %s", provider.name, e)
+    finished = time.perf_counter()
+
+    logger.info(
+        "warm-up took %.1fms (imports %.1fms, database %.1fms, upstream %.1fms)",
+        (finished - started) * 1000, (imports_done - started) * 1000,
+        (db_done - imports_done) * 1000, (finished - db_done) * 1000,
+    )
+
+
+_shut_down_task = None
+
+
+def shut_down():
+    """
+    Flush queued messages, hand pending summaries to the job supervisor,
+    let the queued and running memory jobs finish, then close the pools.
+    Runs once per process; later calls await the same run.
+    """
+    global _shut_down_task
+    if _shut_down_task is None:
+        _shut_down_task = asyncio.ensure_future(_shut_down())
+    return _shut_down_task
+
+
+async def _shut_down():
+    from chat.providers import close_providers
+    from memory.scheduler import summary_scheduler
+    from memory.services import message_buffer
+    from memory.jobs import job_supervisor
+    from memory.db import get_db_executor
+    await message_buffer.flush()
+    summary_scheduler.flush_all()
+    await job_supervisor.drain()
+    await close_providers()
+    await asyncio.to_thread(get_db_executor().shutdown)
+    logger.info("shut down")
+
+
+def install_shutdown_hook():
+    """
+    Run shut_down() when a server without lifespan events stops.
+
+    Under daphne (a Twisted reactor on this asyncio loop) it becomes a
+    "before shutdown" trigger, which daphne's SIGTERM/SIGINT handling fires
+    after closing the connections and which the reactor waits for. Anywhere
+    else SIGTERM runs it and then lets the signal take its default course.
+    """
+    reactor = sys.modules.get("twisted.internet.reactor")
+    if reactor is not None:
+        from twisted.internet.defer import Deferred
+
+        def before_shutdown():
+            return Deferred.fromFuture(asyncio.ensure_future(_shut_down_quietly()))
+
+        reactor.addSystemEventTrigger("before", "shutdown", before_shutdown)
+        return
+
+    loop = asyncio.get_running_loop()
+
+    async def on_sigterm():
+        await _shut_down_quietly()
+        loop.remove_signal_handler(signal.SIGTERM)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(on_sigterm()))
+    except (NotImplementedError, RuntimeError, ValueError):
+        logger.warning("no shutdown hook: queued memory jobs are lost on exit")
+
+
+async def _shut_down_quietly():
+    try:
+        await shut_down()
+    except Exception as e:
+        logger.warning("shutdown failed: %s", e)
+
+
+class StartupMiddleware:
+    """
+    ASGI wrapper that runs warm_up() once per process.
+
+    Servers that speak the lifespan protocol (uvicorn, hypercorn) get it at
+    startup and shut_down() on exit. Daphne never sends lifespan events, so
+    there the first connection kicks off the warm-up in the background
+    (without holding that connection up) and installs the shutdown hook.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._warm_up_task = None
+        self._lifespan = False
+        self._hook_installed = False
+
+    def _ensure_warm_up(self):
+        if self._warm_up_task is None:
+            self._warm_up_task = asyncio.ensure_future(warm_up())
+        return self._warm_up_task
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            self._lifespan = True
+            return await self._run_lifespan(receive, send)
+
+        self._ensure_warm_up()
+        if not self._lifespan and not self._hook_installed:
+            self._hook_installed = True
+            install_shutdown_hook()
+        return await self.app(scope, receive, send)
+
+    async def _run_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self._ensure_warm_up()
+                except Exception as e:
+                    logger.warning("warm-up failed: %s", e)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await _shut_down_quietly()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
@@ -16,9 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from chat import views as chat_views
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics', chat_views.metrics, name='metrics'),
     # path('api/', include('api.urls')),
     # path('chat/', include('chat.urls')),
     # path('memory/', include('memory.urls')),
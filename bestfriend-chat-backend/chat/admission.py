@@ -0,0 +1,385 @@
+# chat/admission.py
+import logging
+import os
+import math
+import time
+import uuid
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+
+from memory.cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+# Per external_id: sustained messages per minute + burst
+ADMISSION_USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "20"))      # per minute
+ADMISSION_USER_BURST = float(os.getenv("ADMISSION_USER_BURST", "5"))
+# All users together (stay under the provider's request limit)
+ADMISSION_GLOBAL_RATE = float(os.getenv("ADMISSION_GLOBAL_RATE", "3000"))  # per minute
+ADMISSION_GLOBAL_BURST = float(os.getenv("ADMISSION_GLOBAL_BURST", "100"))
+# Upstream calls in flight across all workers
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "32"))
+# Longest a call waits in the queue for an upstream slot
+ADMISSION_CHAT_TIMEOUT = float(os.getenv("ADMISSION_CHAT_TIMEOUT", "20"))          # seconds
+ADMISSION_BACKGROUND_TIMEOUT = float(os.getenv("ADMISSION_BACKGROUND_TIMEOUT", "120"))
+# A slot of a crashed worker is freed after this long
+ADMISSION_SLOT_TTL = float(os.getenv("ADMISSION_SLOT_TTL", "120"))                 # seconds
+ADMISSION_POLL = 0.05
+REDIS_RETRY_SECONDS = 30.0
+KEY_PREFIX = "admission:"
+
+PRIORITY_CHAT = 0
+PRIORITY_BACKGROUND = 1
+
+# Take `cost` from every bucket, or from none of them.
+# KEYS: buckets; ARGV: now_ms, then rate (tokens/ms), burst, cost per bucket.
+# Returns {1, 0} or {0, ms until all buckets could pay}.
+_TAKE = """
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[3 * i - 1])
+  local burst = tonumber(ARGV[3 * i])
+  local cost = tonumber(ARGV[3 * i + 1])
+  local state = redis.call('HMGET', key, 't', 'ts')
+  local t = tonumber(state[1]) or burst
+  local ts = tonumber(state[2]) or now
+  t = math.min(burst, t + math.max(0, now - ts) * rate)
+  tokens[i] = t
+  if t < cost then wait = math.max(wait, (cost - t) / rate) end
+end
+if wait > 0 then return {0, math.ceil(wait)} end
+for i, key in ipairs(KEYS) do
+  local rate = tonumber(ARGV[3 * i - 1])
+  local burst = tonumber(ARGV[3 * i])
+  local cost = tonumber(ARGV[3 * i + 1])
+  redis.call('HSET', key, 't', tostring(tokens[i] - cost), 'ts', now)
+  redis.call('PEXPIRE', key, math.ceil(burst / rate) + 1000)
+end
+return {1, 0}
+"""
+
+# Shared semaphore: a sorted set of holders scored by lease expiry.
+# KEYS[1] set; ARGV: now_ms, limit, holder, ttl_ms
+_ACQUIRE = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+  redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[4]), ARGV[3])
+  redis.call('PEXPIRE', KEYS[1], ARGV[4])
+  return 1
+end
+return 0
+"""
+
+
+class AdmissionTimeout(Exception):
+    """No upstream slot became free before the deadline."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"upstream busy, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """In-process token bucket, used when Redis is unavailable."""
+
+    def __init__(self, rate_per_second, burst):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, cost):
+        """Seconds until `cost` tokens are available (0 if they are now)."""
+        self.refill()
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / self.rate
+
+
+class AdmissionController:
+    """
+    Admission control for upstream LLM calls.
+
+    1. check_rate(): token buckets per external_id and global, both taken
+       atomically in one Redis script. A rejected message gets a retry_after
+       instead of an upstream call (and a provider 429).
+    2. slot(): a semaphore shared by all workers (Redis sorted set of leases)
+       caps upstream calls in flight. Calls that find it full wait in a fair
+       queue: chat before background work, and within a priority round-robin
+       across users, so one busy user cannot starve the rest. Each waiter has
+       a deadline, after which AdmissionTimeout carries a retry_after.
+
+    Without Redis both fall back to per-process buckets and a per-process
+    limit, and Redis is retried after REDIS_RETRY_SECONDS.
+    """
+
+    def __init__(self, redis_url, enabled=True, user_rate=ADMISSION_USER_RATE, user_burst=ADMISSION_USER_BURST,
+                 global_rate=ADMISSION_GLOBAL_RATE, global_burst=ADMISSION_GLOBAL_BURST,
+                 max_concurrency=UPSTREAM_MAX_CONCURRENCY, slot_ttl=ADMISSION_SLOT_TTL):
+        self.redis_url = redis_url
+        self.enabled = enabled
+        self.user_rate = user_rate / 60.0        # per second
+        self.user_burst = user_burst
+        self.global_rate = global_rate / 60.0
+        self.global_burst = global_burst
+        self.max_concurrency = max(1, max_concurrency)
+        self.slot_ttl = slot_ttl
+
+        self._redis = None
+        self._redis_loop = None
+        self._redis_retry_at = 0.0
+        self._scripts = {}
+        self._local_buckets = LRUCache(max_entries=100000)  # external_id / "__global__" -> TokenBucket
+        self._local_in_flight = 0
+
+        self._loop = None
+        self._waiters = []         # heap of (priority, rank, seq, waiter)
+        self._queued_per_user = {}
+        self._seq = itertools.count()
+        self._released = None
+        self._dispatcher = None
+        self._hold_ema = 1.0       # seconds a slot is typically held, for retry_after
+        self._stats = {
+            "admitted": 0, "queued": 0, "rate_limited": 0, "timeouts": 0,
+            "in_flight": 0, "max_queue_wait_ms": 0.0, "redis_errors": 0,
+        }
+
+    # rate limiting ---------------------------------------------------------
+
+    async def check_rate(self, external_id, cost=1):
+        """0 if the message may go upstream now, else seconds until it may."""
+        if not self.enabled:
+            return 0
+        client = await self._client()
+        if client is not None:
+            try:
+                allowed, wait_ms = await self._scripts["take"](
+                    keys=[KEY_PREFIX + "bucket:user:" + external_id, KEY_PREFIX + "bucket:global"],
+                    args=[int(time.time() * 1000),
+                          self.user_rate / 1000.0, self.user_burst, cost,
+                          self.global_rate / 1000.0, self.global_burst, cost],
+                )
+                if allowed:
+                    return 0
+                self._stats["rate_limited"] += 1
+                return max(1, math.ceil(int(wait_ms) / 1000.0))
+            except Exception as e:
+                self._redis_failed(e)
+
+        user = self._local_bucket(external_id, self.user_rate, self.user_burst)
+        overall = self._local_bucket("__global__", self.global_rate, self.global_burst)
+        wait = max(user.wait_for(cost), overall.wait_for(cost))
+        if wait > 0:
+            self._stats["rate_limited"] += 1
+            return max(1, math.ceil(wait))
+        user.tokens -= cost
+        overall.tokens -= cost
+        return 0
+
+    # concurrency -------------------------------------------------------------
+
+    @asynccontextmanager
+    async def slot(self, external_id, priority=PRIORITY_CHAT, timeout=None, on_queued=None):
+        """
+        Hold one upstream slot for the block. `on_queued(position)` is awaited
+        once if the call has to wait. Raises AdmissionTimeout.
+        """
+        if not self.enabled:
+            yield
+            return
+        if timeout is None:
+            timeout = ADMISSION_CHAT_TIMEOUT if priority == PRIORITY_CHAT else ADMISSION_BACKGROUND_TIMEOUT
+
+        holder = await self._acquire(external_id, priority, timeout, on_queued)
+        started = time.perf_counter()
+        self._stats["admitted"] += 1
+        self._stats["in_flight"] += 1
+        try:
+            yield
+        finally:
+            self._stats["in_flight"] -= 1
+            held = time.perf_counter() - started
+            self._hold_ema += 0.1 * (held - self._hold_ema)
+            await self._release(holder)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["waiting"] = sum(1 for *_, w in self._waiters if not w["future"].done())
+        stats["max_concurrency"] = self.max_concurrency
+        stats["redis_connected"] = self._redis is not None
+        return stats
+
+    # internals ------------------------------------------------------------
+
+    def _local_bucket(self, key, rate, burst):
+        bucket = self._local_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+        # an entry idle long enough to refill completely is the same as a new one
+        self._local_buckets.set(key, bucket, ttl=burst / rate)
+        return bucket
+
+    def _bind_loop(self):
+        # the queue's futures and events belong to one event loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._waiters = []
+            self._queued_per_user = {}
+            self._released = asyncio.Event()
+            self._dispatcher = None
+
+    async def _acquire(self, external_id, priority, timeout, on_queued):
+        self._bind_loop()
+        if not self._waiters:
+            holder = await self._try_acquire()
+            if holder is not None:
+                return holder
+
+        # rank = how many of this user's calls are already waiting, so users
+        # take turns instead of being served in plain arrival order
+        rank = self._queued_per_user.get(external_id, 0)
+        self._queued_per_user[external_id] = rank + 1
+        waiter = {"future": self._loop.create_future(), "external_id": external_id}
+        heapq.heappush(self._waiters, (priority, rank, next(self._seq), waiter))
+        self._stats["queued"] += 1
+        self._ensure_dispatcher()
+
+        queued_at = time.perf_counter()
+        future = waiter["future"]
+        acquired = False
+        try:
+            if on_queued is not None:
+                await on_queued(len(self._waiters))
+            holder = await asyncio.wait_for(asyncio.shield(future), timeout)
+            acquired = True
+            return holder
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise AdmissionTimeout(self._retry_after())
+        finally:
+            self._user_dequeued(external_id)
+            if not acquired:
+                if future.done() and not future.cancelled():
+                    await self._release(future.result())  # granted just as we gave up
+                else:
+                    future.cancel()
+            wait_ms = round((time.perf_counter() - queued_at) * 1000, 1)
+            self._stats["max_queue_wait_ms"] = max(self._stats["max_queue_wait_ms"], wait_ms)
+
+    def _user_dequeued(self, external_id):
+        left = self._queued_per_user.get(external_id, 1) - 1
+        if left > 0:
+            self._queued_per_user[external_id] = left
+        else:
+            self._queued_per_user.pop(external_id, None)
+
+    def _retry_after(self):
+        waiting = len(self._waiters)
+        return max(1, math.ceil(self._hold_ema * (waiting / self.max_concurrency + 1)))
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = self._loop.create_task(self._dispatch())
+
+    async def _dispatch(self):
+        """Hand free slots to waiters, best (priority, rank) first."""
+        while self._waiters:
+            _, _, _, waiter = self._waiters[0]
+            if waiter["future"].done():  # timed out or cancelled meanwhile
+                heapq.heappop(self._waiters)
+                continue
+
+            holder = await self._try_acquire()
+            if holder is None:
+                self._released.clear()
+                try:
+                    await asyncio.wait_for(self._released.wait(), ADMISSION_POLL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._waiters)
+            if waiter["future"].done():
+                await self._release(holder)
+            else:
+                waiter["future"].set_result(holder)
+
+    async def _try_acquire(self):
+        client = await self._client()
+        if client is not None:
+            holder = uuid.uuid4().hex
+            try:
+                ok = await self._scripts["acquire"](
+                    keys=[KEY_PREFIX + "slots"],
+                    args=[int(time.time() * 1000), self.max_concurrency, holder, int(self.slot_ttl * 1000)],
+                )
+                return ("redis", holder) if ok else None
+            except Exception as e:
+                self._redis_failed(e)
+
+        if self._local_in_flight < self.max_concurrency:
+            self._local_in_flight += 1
+            return ("local", None)
+        return None
+
+    async def _release(self, holder):
+        kind, holder_id = holder
+        if kind == "local":
+            self._local_in_flight -= 1
+        elif self._redis is not None:
+            try:
+                await self._redis.zrem(KEY_PREFIX + "slots", holder_id)
+            except Exception as e:
+                self._redis_failed(e)
+        if self._released is not None:
+            self._released.set()
+
+    async def _client(self):
+        # redis.asyncio connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._redis is not None and self._redis_loop is loop:
+            return self._redis
+        if not self.redis_url or time.monotonic() < self._redis_retry_at:
+            return None
+        try:
+            import redis.asyncio as aioredis
+            client = aioredis.Redis.from_url(self.redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+            await client.ping()
+            self._redis, self._redis_loop = client, loop
+            self._scripts = {
+                "take": client.register_script(_TAKE),
+                "acquire": client.register_script(_ACQUIRE),
+            }
+        except Exception as e:
+            self._redis_failed(e)
+        return self._redis
+
+    def _redis_failed(self, error):
+        self._stats["redis_errors"] += 1
+        logger.warning("Redis unavailable, limiting per process only: %s", error)
+        self._redis = None
+        self._redis_retry_at = time.monotonic() + REDIS_RETRY_SECONDS
+
+
+_admission = None
+
+
+def get_admission():
+    """Process-wide AdmissionController, configured from settings on first use."""
+    global _admission
+    if _admission is None:
+        from django.conf import settings
+        _admission = AdmissionController(
+            settings.REDIS_URL, enabled=os.getenv("ADMISSION_ENABLED", "1") == "1",
+        )
+    return _admission
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
+
+    def ready(self):
+        # drop cached WebSocket users when a token is blacklisted or the user changes
+        from .middleware import connect_signals
+        connect_signals()
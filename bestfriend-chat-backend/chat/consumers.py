@@ -1,16 +1,35 @@
 # chat/consumers.py
+import os
 import json
+import logging
+import math
+import time
 import asyncio
+import hashlib
+from collections import deque
+from django.utils import timezone
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
 
-from .utils_openai import get_openai_client, extract_text_from_response
+from .utils_openai import record_usage
+from .providers import get_provider
+from .prompting import (
+    pack_context, pack_recall, build_chat_input, estimate_tokens,
+    PROMPT_TOKEN_BUDGET, RECALL_TOKEN_BUDGET,
+)
 from memory.services import (
-    get_recent_messages_as_list,
-    append_message_to_memory,
-    summarize_memory_async,
-    analyze_message_async,
+    load_turn_context,
+    memory_group_name,
+    message_buffer,
 )
+from memory.scheduler import summary_scheduler
+from memory.recall import RECALL_ENABLED, collect_recall, start_recall
+from .turns import TurnBusy, get_turn_sequencer
+from .admission import AdmissionTimeout, get_admission
+from .resilience import CHAT_FIRST_TOKEN_TIMEOUT, CircuitOpen, is_rate_limit, resilient_events
+from .metrics import TurnTrace
+
+
+logger = logging.getLogger(__name__)
 
 # SYSTEM_INSTRUCTIONS = (
 #     "You are an assistant that has access to a short summary of the user's past conversations. "
@@ -22,18 +41,31 @@ SYSTEM_INSTRUCTIONS = (
     "- The 'Long-term memory summary' contains facts about the user (name, preferences, background).\n"
     "- Gently use those facts to make answers feel personal (e.g., greeting by name, referencing hobbies), "
     "but only if they are clearly relevant.\n"
-    "- Never claim to remember something that is not in the summary or current chat.\n"
+    "- Never claim to remember something that is not in the summary, the earlier conversation snippets or the current chat.\n"
     "- If the user corrects something, treat the correction as the most up-to-date information.\n"
     "- Keep your answers short and practical unless the user asks for depth.\n"
 )
 
+# Stream tokens to the browser as "delta" frames followed by one "done" frame.
+# A client can still ask for the old single "message" frame with {"stream": false}.
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "1") == "1"
+
+# Recent messages kept in memory per connection; pack_context() decides
+# how many of them actually fit into PROMPT_TOKEN_BUDGET each turn
+HOT_WINDOW_SIZE = int(os.getenv("HOT_WINDOW_SIZE", "40"))
+
+
+def _retry_after_header(error, default=5):
+    """Seconds from the provider's Retry-After header on a 429 (default if absent)."""
+    try:
+        return max(1, math.ceil(float(error.response.headers.get("retry-after"))))
+    except Exception:
+        return default
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
 
     async def connect(self):
-        print("[WS] New WebSocket connection")
-
         # Django user (from AuthMiddlewareStack)
         user = self.scope["user"]
         self.user = user
@@ -52,17 +84,45 @@ class ChatConsumer(AsyncWebsocketConsumer):
             self.external_id = f"path:{path_user_id}"
         else:
             self.external_id = f"anon:{self.channel_name}"
+        # a signed-in user's turns are ordered and superseded across tabs and
+        # workers, and rate-limited together; a path: id is shared by every
+        # visitor of that URL, so anonymous chats get all of that per connection
+        self.shared_turns = self.external_id.startswith("user:")
+        self.session_key = self.external_id if self.shared_turns else f"conn:{self.channel_name}"
+
+        # Load memory once; every turn after this works on the in-memory window
+        context = await load_turn_context(self.external_id, limit=HOT_WINDOW_SIZE)
+        self.user_memory_id = context["user_memory_id"]  # every write of this connection reuses it
+        self.summary_text = context["summary_text"]
+        self.window = deque(maxlen=HOT_WINDOW_SIZE)
+        self._next_seq = 0
+        for m in context["messages"]:
+            self._remember(m["role"], m["content"], m.get("tokens"))
+        self.history_start = None  # seq of the first history message in the prompt
+        self.turn_task = None      # the running _run_turn(), see _cancel_turn()
+        self.trace = None          # TurnTrace of the running turn
+
+        # same key for every turn of this user, so requests land on the same prompt cache
+        self.prompt_cache_key = "chat-" + hashlib.sha1(self.external_id.encode("utf-8")).hexdigest()[:32]
+
+        # background summaries for this user are pushed to this group
+        self.memory_group = memory_group_name(self.external_id)
+        try:
+            await self.channel_layer.group_add(self.memory_group, self.channel_name)
+        except Exception as e:
+            logger.warning("could not join memory group: %s", e)
 
         await self.accept()
-        print("[WS] Connection accepted, external_id =", self.external_id)
+        logger.info("connection accepted, external_id = %s", self.external_id)
 
     async def receive(self, text_data):
-        print("======== [WS RECEIVE] ==========")
-        print("[RAW DATA]:", text_data)
+        trace = TurnTrace()
+        logger.debug("received %s", text_data)
 
         # 1) USER SENDS A MESSAGE  ---------------------------
         try:
-            data = json.loads(text_data)
+            with trace.span("parse"):
+                data = json.loads(text_data)
         except Exception:
             await self.send(json.dumps({
                 "type": "error",
@@ -70,107 +130,284 @@ class ChatConsumer(AsyncWebsocketConsumer):
             }))
             return
 
+        # stop the reply that is being generated (nobody will read the rest)
+        if data.get("type") == "cancel":
+            await self._cancel_turn()
+            return
+
         user_msg = (data.get("message") or "").trim() if hasattr(str, "trim") else (data.get("message") or "").strip()
-        print("[USER MSG]:", user_msg)
+        logger.debug("user message: %s", user_msg)
 
         if not user_msg:
-            print("[ERROR] Empty message!")
             await self.send(json.dumps({
                 "type": "error",
                 "message": "Message cannot be empty",
             }))
             return
 
-        # 2) LOOK IN DATABASE: summary + recent messages -----
-        summary_text = await sync_to_async(self._get_summary_text)()
-        print("[MEMORY] Loaded summary:", summary_text)
+        # over the per-user / global rate: tell the client when to resend
+        # (checked before anything else, so it doesn't cancel the running turn)
+        retry_after = await get_admission().check_rate(self.session_key)
+        if retry_after:
+            await self._send_retry_after(retry_after)
+            return
 
-        recent_messages = await get_recent_messages_as_list(self.external_id, limit=25)
-        print("[MEMORY] Loaded recent messages:", recent_messages)
+        # a newer message supersedes the running turn, here and (signed-in
+        # users) in the user's other tabs on any worker; the turn lock then
+        # orders them
+        await self._cancel_turn()
+        if self.shared_turns:
+            try:
+                await self.channel_layer.group_send(self.memory_group, {
+                    "type": "chat.cancel",
+                    "origin": self.channel_name,
+                })
+            except Exception as e:
+                logger.warning("could not notify other tabs: %s", e)
+
+        self.turn_task = asyncio.ensure_future(self._run_turn(data, user_msg, trace))
+
+    async def _run_turn(self, data, user_msg, trace):
+        """One chat turn, serialized per session_key and cancellable (see _cancel_turn)."""
+        outcome = "error"
+        self.trace = trace
+        # embedding the message for recall runs while the turn waits and the
+        # prompt is packed; the reply never waits long for it
+        recall_task = start_recall(self.external_id, user_msg, exclude=[m["content"] for m in self.window])
+        try:
+            waiting_since = time.perf_counter()
+            async with get_turn_sequencer().turn(self.session_key, shared=self.shared_turns):
+                trace.add("turn_wait", time.perf_counter() - waiting_since)
+                outcome = await self._generate_reply(data, user_msg, trace, recall_task)
+        except TurnBusy:
+            outcome = "busy"
+            await self.send(json.dumps({
+                "type": "error",
+                "message": "Still answering your previous message, please try again",
+            }))
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            try:
+                await self.send(json.dumps({"type": "cancelled"}))
+            except Exception:
+                pass  # socket already gone
+            raise
+        finally:
+            if recall_task is not None:
+                recall_task.cancel()
+            self.trace = None
+            total_ms = trace.finish(outcome)
+            stages_ms = trace.as_ms()
+            logger.info(
+                "turn %s outcome=%s total_ms=%s %s", self.external_id, outcome, total_ms,
+                " ".join(f"{stage}_ms={ms}" for stage, ms in stages_ms.items()),
+                extra={"external_id": self.external_id, "outcome": outcome,
+                       "total_ms": total_ms, "stages_ms": stages_ms},
+            )
+
+    async def _generate_reply(self, data, user_msg, trace, recall_task=None):
+        """Returns the turn's outcome: "ok", "retry_after" or "error"."""
+        # persisted messages are ordered by these timestamps, taken under the turn lock
+        user_at = timezone.now()
+
+        # 2) MEMORY: summary + recent messages (loaded at connect, no DB here),
+        #    trimmed to the token budget, plus older snippets similar to this message
+        #    if the recall lookup started with the turn is done by now
+        budget = PROMPT_TOKEN_BUDGET - RECALL_TOKEN_BUDGET if RECALL_ENABLED else PROMPT_TOKEN_BUDGET
+        with trace.span("history_pack"):
+            summary_text, recent_messages, prompt_tokens, self.history_start = pack_context(
+                SYSTEM_INSTRUCTIONS, self.summary_text, list(self.window), user_msg,
+                budget=budget, start_seq=self.history_start,
+            )
+        with trace.span("recall"):
+            recalled = pack_recall(await collect_recall(recall_task, trace.started))
 
         # 3) USE MEMORY + NEW MESSAGE TO BUILD PROMPT --------
-        prompt_parts = [SYSTEM_INSTRUCTIONS]
-
-        if summary_text:
-            prompt_parts.append(f"Long-term memory summary:\n{summary_text}")
-
-        if recent_messages:
-            last_msgs = recent_messages[-10:]
-            history_lines = "\n".join(f"{m['role']}: {m['content']}" for m in last_msgs)
-            prompt_parts.append(f"Recent chat history:\n{history_lines}")
-
-        prompt_parts.append(f"User: {user_msg}")
-        prompt_parts.append("Assistant:")
-
-        full_prompt = "\n\n".join(prompt_parts)
-        print("[DEBUG] Final prompt sent to OpenAI:\n", full_prompt)
-
-        # Call OpenAI in a thread (non-blocking for event loop)
+        #    stable parts first so the provider can reuse the cached prefix
+        with trace.span("prompt_build"):
+            chat_input = build_chat_input(SYSTEM_INSTRUCTIONS, summary_text, recent_messages, user_msg, recalled)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "prompt (~%d tokens, %d/%d history messages, %d recalled): %s",
+                prompt_tokens, len(recent_messages), len(self.window), len(recalled), chat_input,
+            )
+
+        stream = data.get("stream", CHAT_STREAMING)
+
+        # Call OpenAI on the shared async client (pooled connections), once
+        # admission control hands out an upstream slot
+        started = time.perf_counter()
         try:
-            client = get_openai_client()
-            print("[DEBUG] OpenAI client created")
-
-            def _call_openai():
-                return client.responses.create(
-                    model="gpt-5-nano",
-                    input= full_prompt,
-                )
-
-            response = await asyncio.to_thread(_call_openai)
-            print("[DEBUG] Raw OpenAI response:", response)
-
-            ai_text = extract_text_from_response(response)
-            print("[DEBUG] Extracted AI text:", ai_text)
-
+            async with get_admission().slot(self.session_key, on_queued=self._send_queued):
+                trace.add("admission_wait", time.perf_counter() - started)
+                try:
+                    ai_text, first_token_at = await self._call_model(chat_input, stream, trace)
+                except asyncio.CancelledError:
+                    # replaced by a newer message: this one stays in the history
+                    self._persist_user_message(user_msg, user_at, trace)
+                    raise
+        except (AdmissionTimeout, CircuitOpen) as e:
+            await self._send_retry_after(e.retry_after)
+            return "retry_after"
         except Exception as e:
-            print("********** [OPENAI ERROR] **********")
-            print(str(e))
-            print("************************************")
+            if is_rate_limit(e):
+                logger.warning("rate limited (429): %s", e)
+                await self._send_retry_after(_retry_after_header(e))
+                return "retry_after"
+            logger.exception("chat call failed")
             await self.send(json.dumps({
                 "type": "error",
                 "message": f"Error talking to AI: {str(e)}",
             }))
-            return
+            return "error"
+
+        # only a turn that got an answer stores the user message: after an
+        # error or retry_after the client resends it
+        self._persist_user_message(user_msg, user_at, trace)
+
+        finished = time.perf_counter()
+        total_ms = round((finished - started) * 1000, 1)
+        ttft_ms = round((first_token_at - started) * 1000, 1) if first_token_at else total_ms
 
         # 4) CHATBOT REPLIES TO THE USER ---------------------
-        await self.send(json.dumps({
-            "type": "message",    # your frontend treats this as final assistant message
-            "message": ai_text,
-        }))
-        print("[WS] Sent AI response")
+        if stream:
+            await self.send(json.dumps({
+                "type": "done",      # full text, same as what gets persisted below
+                "message": ai_text,
+                "ttft_ms": ttft_ms,
+                "total_ms": total_ms,
+            }))
+        else:
+            await self.send(json.dumps({
+                "type": "message",    # your frontend treats this as final assistant message
+                "message": ai_text,
+            }))
 
-        # SAVE MESSAGES TO DB (so they become part of memory)
-        try:
-            await append_message_to_memory(self.external_id, "user", user_msg)
-            await append_message_to_memory(self.external_id, "assistant", ai_text)
-        except Exception as e:
-            print("[DB SAVE ERROR]", str(e))
+        # SAVE MESSAGES TO DB (write-behind, batched with other turns)
+        with trace.span("persist"):
+            ai_tokens = self._remember("assistant", ai_text)
+            message_buffer.add(
+                self.external_id, "assistant", ai_text, token_count=ai_tokens, user_memory_id=self.user_memory_id,
+            )
 
-        # BACKGROUND: analyze + update summary (for next time)
+        # BACKGROUND: once enough new messages piled up, one extraction job
+        # analyzes them and updates the summary (for next time)
         try:
-            asyncio.create_task(analyze_message_async(self.external_id, user_msg))
-            asyncio.create_task(summarize_memory_async(self.external_id))
+            summary_scheduler.note_messages(self.external_id, 1)
         except Exception as e:
-            print("[BACKGROUND TASK ERROR]", str(e))
-
-    
-   
+            logger.warning("could not schedule memory extraction: %s", e)
+        return "ok"
+
+    def _persist_user_message(self, user_msg, user_at, trace):
+        with trace.span("persist"):
+            user_tokens = self._remember("user", user_msg)
+            message_buffer.add(
+                self.external_id, "user", user_msg, token_count=user_tokens, created_at=user_at,
+                user_memory_id=self.user_memory_id,
+            )
+            summary_scheduler.note_messages(self.external_id, 1)
+
+    async def _call_model(self, chat_input, stream, trace):
+        """
+        One chat call under the turn deadline, with retries / fallback model /
+        hedging (see chat.resilience); returns (reply text, time of the first
+        token or None).
+        """
+        first_token_at = None
+        started = time.perf_counter()
+        provider = get_provider("chat")
+
+        def open_events(model):
+            return provider.events(
+                model, chat_input, stream=stream,
+                max_retries=0,  # resilient_events() retries
+                prompt_cache_key=self.prompt_cache_key,
+            )
+
+        ai_text = ""
+        async for kind, value in resilient_events(
+            open_events,
+            kind="stream" if stream else "full",
+            first_event_timeout=CHAT_FIRST_TOKEN_TIMEOUT if stream else None,
+        ):
+            if kind == "model":
+                trace.add("upstream_ttfb", time.perf_counter() - started)  # first event of the winning attempt
+                logger.debug("answering with %s", value)
+            elif kind == "delta":
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                await self.send(json.dumps({
+                    "type": "delta",
+                    "delta": value,
+                }))
+            elif kind == "usage":
+                record_usage("chat", value)
+            else:
+                ai_text = value
+        trace.add("upstream_total", time.perf_counter() - started)
+        logger.debug("reply: %s", ai_text)
+        return ai_text, first_token_at
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        # every frame of a turn counts towards its "send" stage
+        trace = getattr(self, "trace", None)
+        if trace is None:
+            return await super().send(text_data, bytes_data, close)
+        with trace.span("send"):
+            return await super().send(text_data, bytes_data, close)
+
+    async def _send_queued(self, position):
+        await self.send(json.dumps({
+            "type": "queued",       # waiting for an upstream slot; the reply follows
+            "position": position,
+        }))
 
+    async def _send_retry_after(self, seconds):
+        await self.send(json.dumps({
+            "type": "retry_after",  # not answered; the client may resend after `retry_after` seconds
+            "retry_after": seconds,
+            "message": f"Too many messages right now, please try again in {seconds}s",
+        }))
 
-    def _get_summary_text(self):
+    def _remember(self, role, content, tokens=None):
+        """Append to the hot window; `seq` lets pack_context() keep history append-only."""
+        if not tokens:
+            tokens = estimate_tokens(content)
+        self.window.append({"seq": self._next_seq, "role": role, "content": content, "tokens": tokens})
+        self._next_seq += 1
+        return tokens
+
+    async def _cancel_turn(self):
+        """Cancel the running turn (closes the upstream stream); True if there was one."""
+        task = getattr(self, "turn_task", None)
+        self.turn_task = None
+        if task is None or task.done():
+            return False
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    async def disconnect(self, close_code):
+        await self._cancel_turn()
+        # don't leave the tail of the conversation unsummarized
+        external_id = getattr(self, "external_id", None)
+        if external_id:
+            await message_buffer.flush()
+            summary_scheduler.flush(external_id)
+        if getattr(self, "memory_group", None):
+            try:
+                await self.channel_layer.group_discard(self.memory_group, self.channel_name)
+            except Exception as e:
+                logger.warning("could not leave memory group: %s", e)
+
+    async def memory_summary(self, event):
         """
-        Sync helper to fetch ConversationSummary.summary_text for this external_id.
-        Import models inside to avoid AppRegistryNotReady at import time.
+        A background summary for this user finished (on any worker):
+        use it from the next turn on.
         """
-        try:
-            from memory.models import UserMemory, ConversationSummary
-            um = UserMemory.objects.filter(external_id=self.external_id).first()
-            if not um:
-                return ""
-            cs = ConversationSummary.objects.filter(user_memory=um).first()
-            return cs.summary_text if cs else ""
-        except Exception as e:
-            print("[SUMMARY READ ERROR]", str(e))
-            return ""
-
+        self.summary_text = event.get("summary", "")
 
+    async def chat_cancel(self, event):
+        """The user sent a newer message from another tab: drop this tab's turn."""
+        if self.shared_turns and event.get("origin") != self.channel_name:
+            await self._cancel_turn()
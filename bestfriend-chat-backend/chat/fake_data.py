@@ -0,0 +1,32 @@
+# chat/fake_data.py
+"""
+Deterministic fake payloads shared by the fake LLM server (fake_llm.py) and
+the in-process MockProvider. Standard library only, so the mock provider
+does not pull in aiohttp.
+"""
+import random
+import hashlib
+
+
+def fake_json_document(schema, prompt):
+    """Smallest valid document for a (strict) JSON schema; arrays of objects get one item per [n] line."""
+    kind = schema.get("type")
+    if kind == "object":
+        return {k: fake_json_document(v, prompt) for k, v in (schema.get("properties") or {}).items()}
+    if kind == "array":
+        items = schema.get("items") or {}
+        if items.get("type") == "object":
+            count = str(prompt).count("\n[")
+            return [dict(fake_json_document(items, prompt), id=n) if "id" in (items.get("properties") or {})
+                    else fake_json_document(items, prompt) for n in range(1, count + 1)]
+        return ["fake"] if items.get("type") == "string" else []
+    if "enum" in schema:
+        return schema["enum"][0]
+    return {"string": "fake", "number": 0.0, "integer": 0, "boolean": False}.get(kind)
+
+
+def fake_embedding(text, dim):
+    """Deterministic pseudo-random vector for a text (same text, same vector)."""
+    seed = int.from_bytes(hashlib.sha256(str(text).encode("utf-8")).digest()[:8], "little")
+    rng = random.Random(seed)
+    return [rng.uniform(-1, 1) for _ in range(dim)]
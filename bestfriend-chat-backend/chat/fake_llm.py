@@ -0,0 +1,168 @@
+# chat/fake_llm.py
+"""
+Local stand-in for the OpenAI endpoints this app uses (Responses API,
+streaming and not, embeddings, model list), with injectable latency and
+errors. Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1.
+
+Run it with `python manage.py fake_llm_server`, or start it inside a test or
+benchmark with `await start_fake_llm(FakeLLMConfig(...))`.
+"""
+import json
+import time
+import random
+import asyncio
+
+from aiohttp import web
+
+from .fake_data import fake_embedding, fake_json_document
+
+
+class FakeLLMConfig:
+    """Latency / error knobs of the fake server."""
+
+    def __init__(self, first_token_ms=200.0, jitter_ms=50.0, slow_fraction=0.0, slow_ms=5000.0,
+                 tokens_per_second=50.0, reply_words=30, error_rate=0.0, error_status=500,
+                 model_first_token_ms=None, embedding_dim=256, seed=None):
+        self.first_token_ms = first_token_ms        # latency before the first byte of a reply
+        self.jitter_ms = jitter_ms                  # +/- uniform jitter on first_token_ms
+        self.slow_fraction = slow_fraction          # share of requests that get slow_ms instead (tail)
+        self.slow_ms = slow_ms
+        self.tokens_per_second = tokens_per_second  # streaming rate after the first token
+        self.reply_words = reply_words
+        self.error_rate = error_rate                # share of requests answered with error_status
+        self.error_status = error_status
+        # per-model overrides of first_token_ms, e.g. {"gpt-4.1-nano": 50}
+        self.model_first_token_ms = dict(model_first_token_ms or {})
+        self.embedding_dim = embedding_dim
+        self.seed = seed
+
+
+class FakeLLM:
+    """aiohttp handlers plus request counters (see `stats`)."""
+
+    def __init__(self, config):
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.stats = {"requests": 0, "streams": 0, "errors": 0, "disconnects": 0, "embeddings": 0}
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/v1/responses", self.responses)
+        app.router.add_post("/v1/embeddings", self.embeddings)
+        app.router.add_get("/v1/models", self.models)
+        return app
+
+    # handlers --------------------------------------------------------------
+
+    async def responses(self, request):
+        body = await request.json()
+        self.stats["requests"] += 1
+        model = body.get("model", "fake")
+
+        if self.random.random() < self.config.error_rate:
+            self.stats["errors"] += 1
+            return web.json_response(
+                {"error": {"message": "injected error", "type": "server_error", "code": None}},
+                status=self.config.error_status,
+            )
+
+        await asyncio.sleep(self._first_token_delay(model))
+        text = self._reply_text(body)
+        response = self._response_object(model, text, body)
+
+        if not body.get("stream"):
+            return web.json_response(response)
+
+        self.stats["streams"] += 1
+        stream = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        try:
+            await stream.prepare(request)
+            seq = 0
+            pause = 1.0 / self.config.tokens_per_second if self.config.tokens_per_second > 0 else 0
+            for word in self._chunks(text):
+                await self._event(stream, {
+                    "type": "response.output_text.delta", "delta": word, "item_id": "msg_fake",
+                    "output_index": 0, "content_index": 0, "sequence_number": seq, "logprobs": [],
+                })
+                seq += 1
+                if pause:
+                    await asyncio.sleep(pause)
+            await self._event(stream, {"type": "response.completed", "response": response, "sequence_number": seq})
+        except ConnectionResetError:
+            self.stats["disconnects"] += 1  # client gave up (cancel / timeout / hedge loser)
+        except asyncio.CancelledError:
+            self.stats["disconnects"] += 1
+            raise
+        return stream
+
+    async def embeddings(self, request):
+        body = await request.json()
+        self.stats["embeddings"] += 1
+        inputs = body.get("input")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        dim = body.get("dimensions") or self.config.embedding_dim
+        data = [
+            {"object": "embedding", "index": i, "embedding": fake_embedding(text, dim)}
+            for i, text in enumerate(inputs)
+        ]
+        tokens = sum(len(str(t).split()) for t in inputs)
+        return web.json_response({
+            "object": "list", "data": data, "model": body.get("model", "fake"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    async def models(self, request):
+        return web.json_response({"object": "list", "data": []})
+
+    # helpers --------------------------------------------------------------
+
+    def _first_token_delay(self, model):
+        base = self.config.model_first_token_ms.get(model, self.config.first_token_ms)
+        if self.config.slow_fraction and self.random.random() < self.config.slow_fraction:
+            base = self.config.slow_ms
+        jitter = self.random.uniform(-self.config.jitter_ms, self.config.jitter_ms)
+        return max(0.0, base + jitter) / 1000.0
+
+    def _reply_text(self, body):
+        text_format = ((body.get("text") or {}).get("format") or {})
+        if text_format.get("type") == "json_schema":
+            return json.dumps(fake_json_document(text_format.get("schema") or {}, body.get("input")))
+        return " ".join(["lorem"] * max(1, self.config.reply_words - 1) + ["ipsum."])
+
+    def _chunks(self, text):
+        words = text.split(" ")
+        return [w + (" " if i < len(words) - 1 else "") for i, w in enumerate(words)]
+
+    def _response_object(self, model, text, body):
+        input_tokens = max(1, len(json.dumps(body.get("input", ""))) // 4)
+        return {
+            "id": f"resp_fake_{int(time.time() * 1000)}", "object": "response", "created_at": int(time.time()),
+            "model": model, "status": "completed", "parallel_tool_calls": False, "tool_choice": "auto", "tools": [],
+            "output": [{
+                "type": "message", "id": "msg_fake", "role": "assistant", "status": "completed",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "usage": {
+                "input_tokens": input_tokens, "output_tokens": max(1, len(text) // 4),
+                "total_tokens": input_tokens + max(1, len(text) // 4),
+                "input_tokens_details": {"cached_tokens": 0}, "output_tokens_details": {"reasoning_tokens": 0},
+            },
+        }
+
+    async def _event(self, stream, event):
+        await stream.write(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode("utf-8"))
+
+
+async def start_fake_llm(config=None, host="127.0.0.1", port=0):
+    """
+    Start the fake server on the running loop. Returns (FakeLLM, base_url,
+    runner); call `await runner.cleanup()` to stop it. port=0 picks a free port.
+    """
+    fake = FakeLLM(config or FakeLLMConfig())
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return fake, f"http://{host}:{bound_port}/v1", runner
@@ -0,0 +1,242 @@
+# chat/llm_cache.py
+import logging
+import json
+import time
+import asyncio
+import hashlib
+
+from memory.cache import LRUCache
+
+
+logger = logging.getLogger(__name__)
+
+
+KEY_PREFIX = "llm:cache:"
+REDIS_RETRY_SECONDS = 30.0
+
+
+def parse_ttls(spec):
+    """'extraction=86400,embedding=604800' -> {"extraction": 86400.0, ...}"""
+    ttls = {}
+    for part in (spec or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            ttls[name.strip()] = float(value)
+    return ttls
+
+
+def request_key(call_type, model, **params):
+    """
+    Content address of one model call: sha256 over call type, model and every
+    parameter that shapes the output (prompt, schema, dimensions, ...).
+    """
+    payload = json.dumps({"type": call_type, "model": model, "params": params},
+                         sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResultCache:
+    """
+    Cache of model results addressed by request_key(): in-process LRU ->
+    Redis (optional, shared by all workers) -> the real call.
+
+    Only call types with a TTL in `ttls` are cached; the main chat reply has
+    none, so every chat turn still reaches the model. Concurrent misses for
+    the same key share one call. Values must be JSON-serializable.
+    """
+
+    def __init__(self, ttls, redis_url=None, enabled=True, local_max_entries=5000):
+        self.ttls = dict(ttls)
+        self.redis_url = redis_url
+        self.enabled = enabled
+        self.local = LRUCache(max_entries=local_max_entries)
+        self._redis = None
+        self._redis_retry_at = 0.0
+        self._inflight = {}  # key -> asyncio.Future of the running call
+        self._stats = {}     # call_type -> counters
+        self._redis_errors = 0
+
+    def ttl_for(self, call_type):
+        return self.ttls.get(call_type, 0) if self.enabled else 0
+
+    async def get_or_call(self, call_type, key, call):
+        """Cached result for `key`, or `await call()` (stored for this call type's TTL)."""
+        ttl = self.ttl_for(call_type)
+        if ttl <= 0:
+            return await call()
+
+        counters = self._counters(call_type)
+        value = self.local.get(key, LRUCache._MISSING)
+        if value is not LRUCache._MISSING:
+            counters["local_hits"] += 1
+            return value
+
+        running = self._inflight.get(key)
+        if running is not None:
+            counters["shared_calls"] += 1
+            return await asyncio.shield(running)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await self._redis_get(key)
+            if value is not LRUCache._MISSING:
+                counters["redis_hits"] += 1
+                self.local.set(key, value, ttl=ttl)
+            else:
+                counters["misses"] += 1
+                value = await call()
+                self.local.set(key, value, ttl=ttl)
+                await self._redis_set(key, value, ttl)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved: waiters get it, nobody else needs to
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    async def get_many(self, call_type, keys):
+        """
+        Batch lookup (e.g. one embedding per text): {key: value} of the hits,
+        local tier first, then one Redis MGET for the rest.
+        """
+        if self.ttl_for(call_type) <= 0:
+            return {}
+        counters = self._counters(call_type)
+        found = {}
+        for key in keys:
+            value = self.local.get(key, LRUCache._MISSING)
+            if value is not LRUCache._MISSING:
+                found[key] = value
+        counters["local_hits"] += len(found)
+
+        missing = [k for k in keys if k not in found]
+        if missing:
+            ttl = self.ttl_for(call_type)
+            for key, value in zip(missing, await self._redis_mget(missing)):
+                if value is not LRUCache._MISSING:
+                    found[key] = value
+                    self.local.set(key, value, ttl=ttl)
+                    counters["redis_hits"] += 1
+        counters["misses"] += len(keys) - len(found)
+        return found
+
+    async def set_many(self, call_type, items):
+        ttl = self.ttl_for(call_type)
+        if ttl <= 0 or not items:
+            return
+        for key, value in items.items():
+            self.local.set(key, value, ttl=ttl)
+        await self._redis_mset(items, ttl)
+
+    async def discard(self, key):
+        """Forget a stored result (e.g. output that turned out to be unusable)."""
+        self.local.delete(key)
+        if self.redis_url:
+            await asyncio.to_thread(self._redis_call, lambda client: client.delete(KEY_PREFIX + key), None)
+
+    def stats(self):
+        stats = {"enabled": self.enabled, "local_entries": len(self.local),
+                 "redis_connected": self._redis is not None, "redis_errors": self._redis_errors}
+        for call_type, counters in self._stats.items():
+            entry = dict(counters)
+            hits = entry["local_hits"] + entry["redis_hits"] + entry["shared_calls"]
+            lookups = hits + entry["misses"]
+            entry["hit_rate"] = round(hits / lookups, 4) if lookups else 0.0
+            stats[call_type] = entry
+        return stats
+
+    # internals ------------------------------------------------------------
+
+    def _counters(self, call_type):
+        return self._stats.setdefault(call_type, {
+            "local_hits": 0, "redis_hits": 0, "misses": 0, "shared_calls": 0,
+        })
+
+    def _client(self):
+        if not self.redis_url:
+            return None
+        if self._redis is not None:
+            return self._redis
+        if time.monotonic() < self._redis_retry_at:
+            return None
+        try:
+            import redis
+            client = redis.Redis.from_url(self.redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+            client.ping()
+            self._redis = client
+        except Exception as e:
+            self._redis_failed(e)
+        return self._redis
+
+    def _redis_failed(self, error):
+        logger.warning("Redis unavailable, using local cache only: %s", error)
+        self._redis_errors += 1
+        self._redis = None
+        self._redis_retry_at = time.monotonic() + REDIS_RETRY_SECONDS
+
+    def _redis_call(self, fn, default):
+        client = self._client()
+        if client is None:
+            return default
+        try:
+            return fn(client)
+        except Exception as e:
+            self._redis_failed(e)
+            return default
+
+    async def _redis_get(self, key):
+        values = await self._redis_mget([key])
+        return values[0]
+
+    async def _redis_mget(self, keys):
+        if not self.redis_url:
+            return [LRUCache._MISSING] * len(keys)
+
+        def mget(client):
+            raws = client.mget([KEY_PREFIX + k for k in keys])
+            return [json.loads(raw) if raw is not None else LRUCache._MISSING for raw in raws]
+
+        return await asyncio.to_thread(self._redis_call, mget, [LRUCache._MISSING] * len(keys))
+
+    async def _redis_set(self, key, value, ttl):
+        await self._redis_mset({key: value}, ttl)
+
+    async def _redis_mset(self, items, ttl):
+        if not self.redis_url:
+            return
+
+        def mset(client):
+            pipe = client.pipeline(transaction=False)
+            for key, value in items.items():
+                pipe.set(KEY_PREFIX + key, json.dumps(value), ex=max(1, int(ttl)))
+            pipe.execute()
+
+        await asyncio.to_thread(self._redis_call, mset, None)
+
+
+_llm_cache = None
+
+
+def get_llm_cache():
+    """Process-wide LLMResultCache, configured from settings on first use."""
+    global _llm_cache
+    if _llm_cache is None:
+        from django.conf import settings
+        conf = settings.LLM_CACHE
+        _llm_cache = LLMResultCache(
+            parse_ttls(conf["TTLS"]),
+            redis_url=settings.REDIS_URL if conf["REDIS"] else None,
+            enabled=conf["ENABLED"],
+            local_max_entries=conf["LOCAL_MAX_ENTRIES"],
+        )
+    return _llm_cache
+
+
+def get_llm_cache_stats():
+    return get_llm_cache().stats()
@@ -0,0 +1,374 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import resource
+import threading
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.fake_llm import FakeLLMConfig, start_fake_llm
+
+
+# set in the child started for --env, which already has the variables
+ENV_APPLIED_MARKER = "CHAT_LOADTEST_ENV_APPLIED"
+
+
+def _percentiles(values):
+    if not values:
+        return {"count": 0, "p50": None, "p90": None, "p99": None, "max": None}
+    ordered = sorted(values)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 1)
+
+    return {"count": len(ordered), "p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99),
+            "max": round(ordered[-1], 1)}
+
+
+class StatementCounter:
+    """Counts SQL statements on every DB connection (ORM threads included)."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self._lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self):
+        from django.db import connections
+        from django.db.backends.signals import connection_created
+        connection_created.connect(self._on_connection, weak=False, dispatch_uid="chat_loadtest_counter")
+        for conn in connections.all(initialized_only=True):
+            self._on_connection(None, conn)
+
+    def _on_connection(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+class InProcessClient:
+    """One WebSocket session against the ASGI app, in this process."""
+
+    def __init__(self, application, path):
+        from channels.testing import WebsocketCommunicator
+        self.communicator = WebsocketCommunicator(application, path)
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        return connected
+
+    async def send(self, text):
+        await self.communicator.send_to(text_data=text)
+
+    async def receive(self, timeout):
+        return await self.communicator.receive_from(timeout=timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteClient:
+    """One WebSocket session against a running server (--target)."""
+
+    def __init__(self, url):
+        self.url = url
+        self.socket = None
+
+    async def connect(self, timeout):
+        import websockets
+        self.socket = await asyncio.wait_for(websockets.connect(self.url, max_size=None), timeout)
+        return True
+
+    async def send(self, text):
+        await self.socket.send(text)
+
+    async def receive(self, timeout):
+        return await asyncio.wait_for(self.socket.recv(), timeout)
+
+    async def close(self):
+        if self.socket is not None:
+            await self.socket.close()
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive many simulated chat clients through ws/chat/<user_id>/ and print a JSON report "
+        "(throughput, time-to-first-byte and turn percentiles, DB statements per turn, peak RSS). "
+        "By default the app from backend/asgi.py runs in this process against a local fake LLM."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=200, help="concurrent WebSocket sessions")
+        parser.add_argument("--turns", type=int, default=3, help="messages sent by each client")
+        parser.add_argument("--ramp-seconds", type=float, default=5.0, help="spread client connects over this long")
+        parser.add_argument("--think-ms", type=float, default=500.0, help="pause between a reply and the next message")
+        parser.add_argument("--turn-timeout", type=float, default=60.0)
+        parser.add_argument("--no-stream", action="store_true", help="ask for single 'message' frames")
+        parser.add_argument("--target", default="",
+                            help="ws://host:port of a running server instead of the in-process app "
+                                 "(DB statements and RSS are then not measured)")
+        parser.add_argument("--provider", choices=("fake", "mock"), default="fake",
+                            help="model backend of the in-process app: the fake LLM server over HTTP, "
+                                 "or the in-process mock provider (no network; the fake LLM options "
+                                 "first-token-ms and tokens-per-second apply)")
+        parser.add_argument("--memory-layer", action="store_true",
+                            help="use the in-memory channel layer instead of the configured one")
+        parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                            help="environment variable for the app, e.g. ADMISSION_GLOBAL_BURST=1000; the "
+                                 "command restarts itself with them set, so settings read at import apply too")
+        parser.add_argument("--keep-data", action="store_true", help="don't delete the load-test users afterwards")
+        parser.add_argument("--output", default="", help="write the report to this file instead of stdout")
+        parser.add_argument("--seed", type=int, default=None)
+        # fake LLM
+        parser.add_argument("--first-token-ms", type=float, default=300.0)
+        parser.add_argument("--jitter-ms", type=float, default=100.0)
+        parser.add_argument("--tokens-per-second", type=float, default=60.0)
+        parser.add_argument("--reply-words", type=int, default=40)
+        parser.add_argument("--slow-fraction", type=float, default=0.0)
+        parser.add_argument("--slow-ms", type=float, default=5000.0)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+
+    def handle(self, *args, **options):
+        env = {}
+        for item in options["env"]:
+            key, sep, value = item.partition("=")
+            if not sep:
+                raise CommandError(f"--env expects KEY=VALUE, got {item!r}")
+            env[key] = value
+        if env and os.environ.get(ENV_APPLIED_MARKER) != "1":
+            # settings and the app modules read their environment when they are
+            # imported, which already happened here: run again in a new process
+            self._rerun_with(env)
+            return
+        report = asyncio.run(self._run(options))
+        text = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(text + "\n")
+            self.stdout.write(f"[LOADTEST] report written to {options['output']}")
+        else:
+            self.stdout.write(text)
+
+    @staticmethod
+    def _rerun_with(env):
+        if sys.argv[1:2] != ["chat_loadtest"]:
+            raise CommandError("--env only works from the command line (manage.py chat_loadtest ...)")
+        child_env = dict(os.environ, **env)
+        child_env[ENV_APPLIED_MARKER] = "1"
+        code = subprocess.call([sys.executable] + sys.argv, env=child_env)
+        if code:
+            raise CommandError(f"load test exited with status {code}")
+
+    async def _run(self, options):
+        rng = random.Random(options["seed"])
+        run_id = uuid.uuid4().hex[:8]
+        fake = runner = None
+        counter = None
+
+        if options["target"]:
+            base = options["target"].rstrip("/")
+
+            def make_client(user_id):
+                return RemoteClient(f"{base}/ws/chat/{user_id}/")
+        elif options["provider"] == "mock":
+            from django.conf import settings
+            from chat.providers import MockProvider, set_provider
+            settings.LLM_PROVIDERS = {call_type: "mock" for call_type in settings.LLM_PROVIDERS}
+            set_provider("mock", MockProvider(
+                first_token_ms=options["first_token_ms"],
+                tokens_per_second=options["tokens_per_second"],
+            ))
+        else:
+            fake, base_url, runner = await start_fake_llm(FakeLLMConfig(
+                first_token_ms=options["first_token_ms"],
+                jitter_ms=options["jitter_ms"],
+                tokens_per_second=options["tokens_per_second"],
+                reply_words=options["reply_words"],
+                slow_fraction=options["slow_fraction"],
+                slow_ms=options["slow_ms"],
+                error_rate=options["error_rate"],
+                seed=options["seed"],
+            ))
+            # every OpenAI call of the app goes to the fake (the shared client reads these when built)
+            os.environ["OPENAI_BASE_URL"] = base_url
+            os.environ.setdefault("OPENAI_API_KEY", "loadtest")
+            from chat.utils_openai import close_openai_client
+            await close_openai_client()
+
+        if not options["target"]:
+            if options["memory_layer"]:
+                from django.conf import settings
+                settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+            from backend.asgi import application
+
+            counter = StatementCounter()
+            counter.install()
+
+            def make_client(user_id):
+                return InProcessClient(application, f"/ws/chat/{user_id}/")
+
+        results = {"connect_ms": [], "ttfb_ms": [], "turn_ms": [], "outcomes": {}, "connect_failures": 0}
+        all_connected = asyncio.Event()
+        connected_count = [0]
+        release = asyncio.Event()
+
+        async def session(index):
+            await asyncio.sleep(options["ramp_seconds"] * index / max(1, options["clients"]))
+            client = make_client(f"loadtest-{run_id}-{index}")
+            started = time.perf_counter()
+            try:
+                if not await client.connect(options["turn_timeout"]):
+                    raise ConnectionError("rejected")
+            except Exception:
+                results["connect_failures"] += 1
+                self._count_connected(connected_count, options["clients"], all_connected)
+                return
+            results["connect_ms"].append((time.perf_counter() - started) * 1000)
+            self._count_connected(connected_count, options["clients"], all_connected)
+            await release.wait()  # hold every session open at once, then start talking
+            try:
+                for turn in range(options["turns"]):
+                    await self._turn(client, turn, options, results)
+                    await asyncio.sleep(options["think_ms"] / 1000 * rng.uniform(0.5, 1.5))
+            finally:
+                try:
+                    await client.close()
+                except Exception:
+                    pass
+
+        tasks = [asyncio.ensure_future(session(i)) for i in range(options["clients"])]
+        await all_connected.wait()
+        statements_before = counter.count if counter else None
+        measured_from = time.perf_counter()
+        release.set()
+        await asyncio.gather(*tasks)
+        duration = time.perf_counter() - measured_from
+
+        app_stats = {}
+        if not options["target"]:
+            from memory.services import message_buffer
+            await message_buffer.flush()  # the messages of the run are part of its DB work
+            app_stats = self._app_stats()
+
+        turns_ok = results["outcomes"].get("ok", 0)
+        turns_total = sum(results["outcomes"].values())
+        statements = counter.count - statements_before if counter else None
+        report = {
+            "config": {k: options[k] for k in (
+                "clients", "turns", "ramp_seconds", "think_ms", "target", "provider", "first_token_ms", "jitter_ms",
+                "tokens_per_second", "reply_words", "slow_fraction", "slow_ms", "error_rate",
+            )},
+            "stream": not options["no_stream"],
+            # the in-process app's admission control caps the load it lets through
+            "limits": self._limits() if not options["target"] else None,
+            "sessions_connected": len(results["connect_ms"]),
+            "connect_failures": results["connect_failures"],
+            "turns": dict(results["outcomes"], total=turns_total),
+            "duration_s": round(duration, 2),
+            "throughput_turns_per_s": round(turns_ok / duration, 2) if duration else None,
+            "connect_ms": _percentiles(results["connect_ms"]),
+            "ttfb_ms": _percentiles(results["ttfb_ms"]),
+            "turn_ms": _percentiles(results["turn_ms"]),
+            "db_statements": statements,
+            "db_statements_per_turn": round(statements / turns_total, 2) if statements is not None and turns_total else None,
+            # this process: the app plus the simulated clients (and the fake LLM)
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+            if not options["target"] else None,
+            "fake_llm": fake.stats if fake else None,
+            "app": app_stats,
+        }
+
+        if not options["target"]:
+            from backend.startup import shut_down
+            await shut_down()  # lets background memory jobs finish before their users are deleted
+            if not options["keep_data"]:
+                await self._delete_users(run_id)
+        if runner is not None:
+            await runner.cleanup()
+        return report
+
+    async def _turn(self, client, turn, options, results):
+        payload = {"message": f"load test message {turn}: how was your day?"}
+        if options["no_stream"]:
+            payload["stream"] = False
+        started = time.perf_counter()
+        first_byte = None
+        outcome = "timeout"
+        try:
+            await client.send(json.dumps(payload))
+            deadline = started + options["turn_timeout"]
+            while True:
+                frame = json.loads(await client.receive(max(0.01, deadline - time.perf_counter())))
+                kind = frame.get("type")
+                if kind in ("delta", "done", "message") and first_byte is None:
+                    first_byte = time.perf_counter()
+                if kind in ("done", "message"):
+                    outcome = "ok"
+                    break
+                if kind in ("error", "retry_after", "cancelled"):
+                    outcome = kind
+                    break
+        except (asyncio.TimeoutError, TimeoutError):
+            outcome = "timeout"
+        except Exception:
+            outcome = "disconnected"
+        results["outcomes"][outcome] = results["outcomes"].get(outcome, 0) + 1
+        if outcome == "ok":
+            results["ttfb_ms"].append((first_byte - started) * 1000)
+            results["turn_ms"].append((time.perf_counter() - started) * 1000)
+
+    @staticmethod
+    def _count_connected(counter, total, event):
+        counter[0] += 1
+        if counter[0] >= total:
+            event.set()
+
+    @staticmethod
+    def _limits():
+        from chat import admission
+        controller = admission.get_admission()
+        return {
+            "admission_enabled": controller.enabled,
+            "user_rate_per_min": controller.user_rate * 60,
+            "user_burst": controller.user_burst,
+            "global_rate_per_min": controller.global_rate * 60,
+            "global_burst": controller.global_burst,
+            "upstream_max_concurrency": controller.max_concurrency,
+            "chat_timeout_s": admission.ADMISSION_CHAT_TIMEOUT,
+        }
+
+    @staticmethod
+    def _app_stats():
+        from chat.admission import get_admission
+        from chat.turns import get_turn_sequencer
+        from chat.resilience import get_resilience_stats
+        from chat.utils_openai import get_pool_stats
+        from memory.services import message_buffer
+        from memory.db import get_db_executor
+        return {
+            "admission": get_admission().stats(),
+            "turns": get_turn_sequencer().stats(),
+            "upstream": get_resilience_stats(),
+            "openai_pool": get_pool_stats(),
+            "message_buffer": message_buffer.stats(),
+            "db_executor": get_db_executor().stats(),
+        }
+
+    @staticmethod
+    async def _delete_users(run_id):
+        from memory.db import run_db
+        from memory.models import UserMemory
+
+        def delete():
+            UserMemory.objects.filter(external_id__startswith=f"path:loadtest-{run_id}-").delete()
+
+        await run_db(delete)
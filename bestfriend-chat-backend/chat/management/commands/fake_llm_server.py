@@ -0,0 +1,54 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from chat.fake_llm import FakeLLMConfig, start_fake_llm
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local fake of the OpenAI endpoints with injectable latency and errors. "
+        "Start the app with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 to use it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--first-token-ms", type=float, default=200.0)
+        parser.add_argument("--jitter-ms", type=float, default=50.0)
+        parser.add_argument("--slow-fraction", type=float, default=0.0,
+                            help="share of requests delayed by --slow-ms (tail latency)")
+        parser.add_argument("--slow-ms", type=float, default=5000.0)
+        parser.add_argument("--tokens-per-second", type=float, default=50.0)
+        parser.add_argument("--reply-words", type=int, default=30)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--error-status", type=int, default=500)
+        parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=MS",
+                            help="first-token latency for one model, e.g. gpt-4.1-nano=50 (repeatable)")
+
+    def handle(self, *args, **options):
+        model_latency = {}
+        for item in options["model_latency"]:
+            model, _, ms = item.partition("=")
+            model_latency[model] = float(ms)
+
+        config = FakeLLMConfig(
+            first_token_ms=options["first_token_ms"],
+            jitter_ms=options["jitter_ms"],
+            slow_fraction=options["slow_fraction"],
+            slow_ms=options["slow_ms"],
+            tokens_per_second=options["tokens_per_second"],
+            reply_words=options["reply_words"],
+            error_rate=options["error_rate"],
+            error_status=options["error_status"],
+            model_first_token_ms=model_latency,
+        )
+        asyncio.run(self._serve(config, options["port"]))
+
+    async def _serve(self, config, port):
+        fake, base_url, runner = await start_fake_llm(config, port=port)
+        self.stdout.write(f"[FAKE LLM] listening on {base_url}")
+        try:
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            await runner.cleanup()
@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import subprocess
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def _parse_importtime(stderr):
+    """`python -X importtime` lines -> [(module, self_us, cumulative_us, depth)]."""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Import the ASGI app (or --module) in a fresh interpreter under `python -X importtime` "
+        "and report where worker start-up time goes, per package and per module."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--module", default="backend.asgi", help="module to import after django.setup()")
+        parser.add_argument("--top", type=int, default=20, help="rows per table")
+        parser.add_argument("--json", action="store_true", help="print the report as JSON")
+
+    def handle(self, *args, **options):
+        code = (
+            "import time; started = time.perf_counter()\n"
+            "import django; django.setup()\n"
+            f"import {options['module']}\n"
+            "print(round((time.perf_counter() - started) * 1000, 1))\n"
+        )
+        env = dict(os.environ, WARM_UP_PRELOAD="0")  # only what importing the app costs by itself
+        env.setdefault("DJANGO_SETTINGS_MODULE", os.environ.get("DJANGO_SETTINGS_MODULE", "backend.settings"))
+        proc = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True, text=True, env=env,
+        )
+        if proc.returncode != 0:
+            raise CommandError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "import failed")
+
+        rows = _parse_importtime(proc.stderr)
+        packages = {}
+        for name, self_us, _, _ in rows:
+            top = name.split(".", 1)[0]
+            entry = packages.setdefault(top, {"modules": 0, "self_ms": 0.0})
+            entry["modules"] += 1
+            entry["self_ms"] += self_us / 1000
+        by_package = sorted(
+            ({"package": k, "modules": v["modules"], "ms": round(v["self_ms"], 1)} for k, v in packages.items()),
+            key=lambda r: -r["ms"],
+        )
+        by_module = sorted(
+            ({"module": name, "cumulative_ms": round(cum / 1000, 1), "self_ms": round(own / 1000, 1)}
+             for name, own, cum, _ in rows),
+            key=lambda r: -r["cumulative_ms"],
+        )
+        report = {
+            "module": options["module"],
+            "wall_ms": float(proc.stdout.strip().splitlines()[-1]),
+            "modules_imported": len(rows),
+            "packages": by_package[:options["top"]],
+            "modules": by_module[:options["top"]],
+        }
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(
+            f"import of {report['module']} (django.setup() included): "
+            f"{report['wall_ms']}ms, {report['modules_imported']} modules"
+        )
+        self.stdout.write("\nby package (self time)")
+        for row in report["packages"]:
+            self.stdout.write(f"  {row['ms']:>9.1f}ms  {row['modules']:>5}  {row['package']}")
+        self.stdout.write("\nby module (cumulative)")
+        for row in report["modules"]:
+            self.stdout.write(f"  {row['cumulative_ms']:>9.1f}ms  {row['module']}")
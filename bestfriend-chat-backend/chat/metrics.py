@@ -0,0 +1,216 @@
+# chat/metrics.py
+"""
+Prometheus text-format metrics, without the client library: histograms
+that the code observes directly (per-turn stage timings) plus gauges that
+are read from the existing stats() snapshots at scrape time.
+"""
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+logger = logging.getLogger(__name__)
+
+# seconds; covers in-process stages (sub-ms) up to slow upstream replies
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_str(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Cumulative-bucket histogram; one series per label combination."""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for key, series in items:
+            labels = list(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets + (float("inf"),), series[:-2] + [series[-1]]):
+                lines.append(f"{self.name}_bucket{_label_str(labels + [('le', _format_value(bound))])} {count}")
+            lines.append(f"{self.name}_sum{_label_str(labels)} {_format_value(float(series[-2]))}")
+            lines.append(f"{self.name}_count{_label_str(labels)} {series[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Time spent in each stage of a chat turn (connect-time loads and persist flushes included).",
+    labelnames=("stage",),
+)
+TURN_SECONDS = Histogram(
+    "chat_turn_seconds",
+    "Wall time of a chat turn, from receiving the message to the final frame.",
+    labelnames=("outcome",),
+)
+_histograms = [STAGE_SECONDS, TURN_SECONDS]
+_collectors = []  # (prefix, callable returning a stats dict)
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+@contextmanager
+def timed_stage(stage):
+    """Observe the duration of the block as `stage` (works around awaits too)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+class TurnTrace:
+    """
+    Timing spans of one chat turn. Spans of the same stage add up (e.g. every
+    frame sent); finish() observes each stage once, plus the turn total.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_ms(self):
+        return {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()}
+
+    def finish(self, outcome):
+        for stage, seconds in self.stages.items():
+            observe_stage(stage, seconds)
+        total = self.elapsed()
+        TURN_SECONDS.observe(total, outcome=outcome)
+        return round(total * 1000, 1)
+
+
+def register_collector(prefix, collect):
+    """
+    Expose the numbers in `collect()` (a stats dict) as gauges named
+    `<prefix>_<key>`. One level of nested dicts becomes a `key` label.
+    """
+    _collectors.append((prefix, collect))
+
+
+def _gauge_lines(prefix, stats):
+    series = {}  # metric name -> [(labels, value)]
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            for sub_key, sub_value in value.items():
+                if isinstance(sub_value, dict):
+                    for leaf, leaf_value in sub_value.items():
+                        if _is_number(leaf_value):
+                            series.setdefault(f"{prefix}_{leaf}", []).append(([("key", sub_key)], leaf_value))
+                elif _is_number(sub_value):
+                    series.setdefault(f"{prefix}_{key}", []).append(([("key", sub_key)], sub_value))
+        elif _is_number(value):
+            series.setdefault(f"{prefix}_{key}", []).append(([], value))
+
+    lines = []
+    for name, values in series.items():
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in values:
+            lines.append(f"{name}{_label_str(labels)} {_format_value(float(value))}")
+    return lines
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, str)
+
+
+def render_metrics():
+    """Everything in the Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for histogram in _histograms:
+        lines.extend(histogram.render())
+    for prefix, collect in _collectors:
+        try:
+            lines.extend(_gauge_lines(prefix, collect() or {}))
+        except Exception:
+            logger.exception("metrics collector %s failed", prefix)
+    return "\n".join(lines) + "\n"
+
+
+def _register_default_collectors():
+    from .utils_openai import get_pool_stats, get_prompt_cache_stats
+    from .llm_cache import get_llm_cache_stats
+    from .admission import get_admission
+    from .turns import get_turn_sequencer
+    from .resilience import get_resilience_stats
+    from .middleware import get_ws_auth_stats
+    from memory.cache import get_memory_cache
+    from memory.services import message_buffer
+    from memory.scheduler import summary_scheduler
+    from memory.jobs import job_supervisor
+    from memory.db import get_db_executor
+
+    register_collector("openai_pool", get_pool_stats)
+    register_collector("openai_prompt_cache", get_prompt_cache_stats)
+    register_collector("llm_cache", get_llm_cache_stats)
+    register_collector("memory_cache", lambda: get_memory_cache().stats())
+    register_collector("message_buffer", message_buffer.stats)
+    register_collector("summary_scheduler", summary_scheduler.stats)
+    register_collector("memory_jobs", job_supervisor.stats)
+    register_collector("db_executor", lambda: get_db_executor().stats())
+    register_collector("admission", lambda: get_admission().stats())
+    register_collector("chat_turns", lambda: get_turn_sequencer().stats())
+    register_collector("chat_upstream", get_resilience_stats)
+    register_collector("ws_auth", get_ws_auth_stats)
+
+
+_defaults_registered = False
+
+
+def get_metrics_text():
+    global _defaults_registered
+    if not _defaults_registered:
+        _defaults_registered = True
+        _register_default_collectors()
+    return render_metrics()
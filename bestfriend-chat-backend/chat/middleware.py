@@ -1,37 +1,162 @@
-import jwt
+import os
+from urllib.parse import parse_qs
+
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
 from django.contrib.auth import get_user_model
 
-User = get_user_model()
+from memory.cache import LRUCache
+
+
+# How long a verified user is reused for reconnects without touching the DB.
+# Blacklisting a token or saving the user drops the entry at once in this
+# process; other workers pick it up within the TTL.
+WS_AUTH_CACHE_TTL = float(os.getenv("WS_AUTH_CACHE_TTL", "60"))                 # seconds
+WS_AUTH_CACHE_MAX_ENTRIES = int(os.getenv("WS_AUTH_CACHE_MAX_ENTRIES", "10000"))
+
+BLACKLIST_APP = "rest_framework_simplejwt.token_blacklist"
 
+# user id -> (user, jtis of tokens already checked against the blacklist)
+_user_cache = LRUCache(max_entries=WS_AUTH_CACHE_MAX_ENTRIES, ttl=WS_AUTH_CACHE_TTL)
+_stats = {"connects": 0, "anonymous": 0, "invalid_tokens": 0, "cache_hits": 0, "db_lookups": 0, "rejected": 0}
 
-@database_sync_to_async
-def get_user_from_token(token):
+
+def get_token_from_scope(scope):
+    """Access token from `?token=` or an `Authorization: Bearer` header (native clients)."""
+    query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+    token = (query.get("token") or [None])[0]
+    if token:
+        return token
+    for name, value in scope.get("headers", []):
+        if name == b"authorization":
+            scheme, _, credentials = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and credentials:
+                return credentials.strip()
+    return None
+
+
+def validate_token(raw_token):
+    """
+    Check signature, expiry and token type from the claims alone (no DB);
+    returns the AccessToken or None.
+    """
+    from rest_framework_simplejwt.exceptions import TokenError
+    from rest_framework_simplejwt.tokens import AccessToken
     try:
-        payload = jwt.decode(
-            token,
-            settings.SIMPLE_JWT["SIGNING_KEY"],
-            algorithms=["HS256"]
-        )
-        user_id = payload.get("user_id")
-        return User.objects.get(id=user_id)
-    except Exception:
+        return AccessToken(raw_token)
+    except TokenError:
+        return None
+
+
+def _load_user_sync(token, user_id):
+    """
+    Same rules as simplejwt's JWTAuthentication.get_user(), plus the
+    blacklist check TokenVerifySerializer does; None if any fails.
+    """
+    from rest_framework_simplejwt.settings import api_settings
+
+    if BLACKLIST_APP in settings.INSTALLED_APPS:
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        jti = token.get(api_settings.JTI_CLAIM)
+        if jti and BlacklistedToken.objects.filter(token__jti=jti).exists():
+            return None
+
+    User = get_user_model()
+    user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+    if user is None:
+        return None
+    if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+        return None
+    return user
+
+
+async def get_user_from_token(raw_token):
+    """
+    User for a WebSocket access token, or AnonymousUser.
+
+    Reconnects with a token that was already accepted are answered from
+    the in-process cache; a new token of a cached user only costs the
+    blacklist lookup the first time it is seen.
+    """
+    from rest_framework_simplejwt.settings import api_settings
+
+    token = validate_token(raw_token)
+    if token is None:
+        _stats["invalid_tokens"] += 1
+        return AnonymousUser()
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    if user_id is None:
+        _stats["invalid_tokens"] += 1
         return AnonymousUser()
+    user_id = str(user_id)  # the claim is a string in recent simplejwt versions
 
+    jti = token.get(api_settings.JTI_CLAIM)
+    entry = _user_cache.get(user_id)
+    if entry is not None and jti in entry[1]:
+        user = entry[0]
+        _stats["cache_hits"] += 1
+    else:
+        _stats["db_lookups"] += 1
+        user = await database_sync_to_async(_load_user_sync)(token, user_id)
+        if user is None:
+            _stats["rejected"] += 1
+            return AnonymousUser()
+        jtis = entry[1] if entry is not None else set()
+        jtis.add(jti)
+        _user_cache.set(user_id, (user, jtis))
 
-class JWTAuthMiddleware(BaseMiddleware):
-    async def __call__(self, scope, receive, send):
-        # Read the token from query string
-        query_string = scope.get("query_string", b"").decode()
+    if api_settings.CHECK_REVOKE_TOKEN:
+        from rest_framework_simplejwt.utils import get_md5_hash_password
+        if token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+            _stats["rejected"] += 1
+            return AnonymousUser()
+    return user
+
+
+def invalidate_user(user_id):
+    """Forget a cached user (and the tokens verified for it)."""
+    _user_cache.delete(str(user_id))
+
+
+def get_ws_auth_stats():
+    return dict(_stats, cached_users=len(_user_cache))
+
+
+def _on_token_blacklisted(sender, instance, **kwargs):
+    invalidate_user(instance.token.user_id)
 
-        token = None
-        if "token=" in query_string:
-            token = query_string.split("token=")[1]
 
-        # Set authenticated user in scope
-        scope["user"] = await get_user_from_token(token) if token else AnonymousUser()
+def _on_user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+def connect_signals():
+    """Called from ChatConfig.ready()."""
+    from django.db.models.signals import post_save, post_delete
+    User = get_user_model()
+    post_save.connect(_on_user_changed, sender=User, dispatch_uid="ws_auth_user_saved")
+    post_delete.connect(_on_user_changed, sender=User, dispatch_uid="ws_auth_user_deleted")
+    if BLACKLIST_APP in settings.INSTALLED_APPS:
+        from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+        post_save.connect(_on_token_blacklisted, sender=BlacklistedToken, dispatch_uid="ws_auth_token_blacklisted")
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Sets scope["user"] from a simplejwt access token. Goes inside
+    AuthMiddlewareStack: without a token the session user is kept.
+    """
+
+    async def __call__(self, scope, receive, send):
+        _stats["connects"] += 1
+        token = get_token_from_scope(scope)
+        if token:
+            scope = dict(scope, user=await get_user_from_token(token))
+        elif "user" not in scope:
+            scope = dict(scope, user=AnonymousUser())
+        if not getattr(scope["user"], "is_authenticated", False):
+            _stats["anonymous"] += 1
 
         return await super().__call__(scope, receive, send)
@@ -0,0 +1,139 @@
+# chat/prompting.py
+import os
+import re
+
+
+# Total input tokens we are willing to send per chat turn
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+# The summary may take at most this share of what is left after system + user message
+SUMMARY_BUDGET_SHARE = float(os.getenv("SUMMARY_BUDGET_SHARE", "0.4"))
+# When history overflows, trim it down to this share of its budget so the
+# following turns can append without moving the start of the history again
+HISTORY_REFILL_SHARE = float(os.getenv("HISTORY_REFILL_SHARE", "0.6"))
+# Formatting overhead per message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Tokens reserved for recalled snippets (taken off the budget before packing,
+# so recall never moves the history anchor)
+RECALL_TOKEN_BUDGET = int(os.getenv("RECALL_TOKEN_BUDGET", "300"))
+
+_PIECES = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def estimate_tokens(text):
+    """
+    Cheap local estimate of BPE tokens: each word costs ~1 token per 4
+    characters (at least 1), each punctuation mark/emoji costs 1.
+    Close enough for budgeting; never used for billing.
+    """
+    if not text:
+        return 0
+    total = 0
+    for piece in _PIECES.findall(text):
+        total += max(1, (len(piece) + 3) // 4)
+    return total
+
+
+def message_tokens(message):
+    """Token cost of a window entry, using the count stored at write time."""
+    tokens = message.get("tokens")
+    if not tokens:
+        tokens = estimate_tokens(message.get("content", ""))
+    return tokens + MESSAGE_OVERHEAD_TOKENS
+
+
+def _truncate_to_tokens(text, max_tokens):
+    if max_tokens <= 0:
+        return ""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    # estimate is roughly linear in length; cut, then trim until it fits
+    cut = text[: max(1, len(text) * max_tokens // tokens)]
+    while cut and estimate_tokens(cut) > max_tokens:
+        cut = cut[: int(len(cut) * 0.9)]
+    return cut.rstrip() + " …"
+
+
+def pack_context(system, summary, history, user_msg, budget=PROMPT_TOKEN_BUDGET, start_seq=None):
+    """
+    Fit a chat turn into `budget` tokens, keeping the prompt prefix stable.
+
+    System instructions and the new user message are always kept. The summary
+    gets up to SUMMARY_BUDGET_SHARE of the budget left after the system text
+    (truncated if longer); that cap does not depend on the user message, so
+    the summary block is byte-identical from turn to turn.
+
+    History is append-only: it starts at `start_seq` (the `seq` of the first
+    message used last turn) and only new messages are added at the end. Only
+    when that no longer fits, or the start fell out of the window, is the
+    start moved forward - far enough that history uses HISTORY_REFILL_SHARE of
+    its budget, which leaves room for several more turns before the next move.
+
+    Returns (summary, history, used_tokens, start_seq).
+    """
+    fixed = estimate_tokens(system) + MESSAGE_OVERHEAD_TOKENS
+
+    packed_summary = ""
+    if summary:
+        summary_cap = int(max(0, budget - fixed) * SUMMARY_BUDGET_SHARE)
+        packed_summary = _truncate_to_tokens(summary, summary_cap)
+    summary_cost = estimate_tokens(packed_summary) + MESSAGE_OVERHEAD_TOKENS if packed_summary else 0
+
+    user_cost = estimate_tokens(user_msg) + MESSAGE_OVERHEAD_TOKENS
+    history_budget = max(0, budget - fixed - summary_cost - user_cost)
+
+    anchor_lost = start_seq is not None and bool(history) and history[0].get("seq", 0) > start_seq
+    if start_seq is not None:
+        history = [m for m in history if m.get("seq", 0) >= start_seq]
+
+    costs = [message_tokens(m) for m in history]
+    total = sum(costs)
+    if total > history_budget or anchor_lost:
+        target = history_budget * HISTORY_REFILL_SHARE if total > history_budget else history_budget
+        drop = 0
+        while drop < len(history) and total > target:
+            total -= costs[drop]
+            drop += 1
+        history = history[drop:]
+
+    if history:
+        start_seq = history[0].get("seq", 0)
+
+    return packed_summary, history, fixed + summary_cost + user_cost + total, start_seq
+
+
+def pack_recall(snippets, budget=RECALL_TOKEN_BUDGET):
+    """Keep the best recalled snippets (they come best first) that fit `budget`."""
+    packed, used = [], MESSAGE_OVERHEAD_TOKENS
+    for s in snippets:
+        cost = estimate_tokens(s["content"]) + 2
+        if used + cost > budget:
+            break
+        packed.append(s)
+        used += cost
+    return packed
+
+
+def build_chat_input(system, summary, history, user_msg, recalled=None):
+    """
+    Structured Responses API input, ordered from most to least stable:
+
+      1. system instructions        (never changes)
+      2. long-term memory summary   (changes only when a new summary lands)
+      3. history                    (append-only, see pack_context)
+      4. recalled snippets          (different every turn, so after the cached part)
+      5. the new user message
+
+    Providers cache the longest previously seen prefix, so keeping the stable
+    parts first and byte-identical is what makes cached-token hits possible.
+    """
+    items = [{"role": "system", "content": system}]
+    if summary:
+        items.append({"role": "system", "content": f"Long-term memory summary:\n{summary}"})
+    for m in history:
+        items.append({"role": m["role"], "content": m["content"]})
+    if recalled:
+        lines = "\n".join(f"- {s['role']}: {s['content']}" for s in recalled)
+        items.append({"role": "system", "content": f"Possibly relevant earlier conversation:\n{lines}"})
+    items.append({"role": "user", "content": user_msg})
+    return items
@@ -0,0 +1,265 @@
+# chat/providers.py
+"""
+One interface for every model call the app makes, with swappable backends:
+
+  "openai"  the OpenAI API on the shared pooled client (default)
+  "local"   any OpenAI-compatible server at LLM_LOCAL_BASE_URL (vLLM, Ollama,
+            `manage.py fake_llm_server`, ...)
+  "mock"    in-process, deterministic scripted replies with injectable latency;
+            no network, for profiling and benchmarking the turn pipeline offline
+
+settings.LLM_PROVIDERS picks the backend per call type ("chat", "extraction",
+"embedding"); a dotted path to an LLMProvider subclass works as well.
+"""
+import os
+import re
+import json
+import asyncio
+import importlib
+import itertools
+from types import SimpleNamespace
+
+from .fake_data import fake_embedding, fake_json_document
+from .utils_openai import (
+    get_openai_client, close_openai_client, warm_up_openai_client,
+    stream_response, extract_text_from_response, _build_client, _retire_client,
+)
+
+
+# "local" backend
+LLM_LOCAL_BASE_URL = os.getenv("LLM_LOCAL_BASE_URL", "http://127.0.0.1:8765/v1")
+LLM_LOCAL_API_KEY = os.getenv("LLM_LOCAL_API_KEY", "local")
+LLM_LOCAL_MODEL = os.getenv("LLM_LOCAL_MODEL", "")   # serve every call with this model if set
+# "mock" backend
+LLM_MOCK_FIRST_TOKEN_MS = float(os.getenv("LLM_MOCK_FIRST_TOKEN_MS", "0"))
+LLM_MOCK_TOKENS_PER_SECOND = float(os.getenv("LLM_MOCK_TOKENS_PER_SECOND", "0"))  # 0: all at once
+LLM_MOCK_REPLIES_FILE = os.getenv("LLM_MOCK_REPLIES_FILE", "")  # JSON list of replies, used in turn
+
+CALL_TYPES = ("chat", "extraction", "embedding")
+
+
+class LLMProvider:
+    """
+    Backend interface. `input` is a Responses API input (a string or a list
+    of {"role", "content"} messages); `params` are Responses API options
+    (prompt_cache_key, text=json_schema format, ...) a backend may ignore.
+    """
+
+    name = "base"
+    # heavy modules the backend imports on first use (preloaded at startup)
+    modules = ()
+
+    def stream(self, model, input, max_retries=None, **params):
+        """Async iterator of ("delta", text), ("usage", usage), ("done", full_text)."""
+        raise NotImplementedError
+
+    async def complete(self, model, input, max_retries=None, **params):
+        """Whole reply at once: (text, usage or None)."""
+        raise NotImplementedError
+
+    async def embed(self, model, texts, dimensions=None):
+        """One vector (list of floats) per text."""
+        raise NotImplementedError
+
+    def events(self, model, input, stream=True, max_retries=None, **params):
+        """stream() or complete(), both as the same kind of event iterator."""
+        if stream:
+            return self.stream(model, input, max_retries=max_retries, **params)
+        return self._complete_events(model, input, max_retries=max_retries, **params)
+
+    async def _complete_events(self, model, input, **params):
+        text, usage = await self.complete(model, input, **params)
+        if usage is not None:
+            yield "usage", usage
+        yield "done", text
+
+    def cache_namespace(self, model):
+        """Model name as used in cache keys / vector space names: results of
+        different backends must never be mixed up."""
+        return model if self.name == "openai" else f"{self.name}/{model}"
+
+    async def warm_up(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class OpenAIProvider(LLMProvider):
+    """OpenAI Responses / Embeddings API on the process-wide pooled client."""
+
+    name = "openai"
+    modules = ("httpx", "openai")
+
+    def _client(self, max_retries=None):
+        if not os.getenv("OPENAI_API_KEY"):
+            raise RuntimeError("OPENAI_API_KEY not set")
+        client = get_openai_client()
+        return client if max_retries is None else client.with_options(max_retries=max_retries)
+
+    def _model(self, model):
+        return model
+
+    def stream(self, model, input, max_retries=None, **params):
+        return stream_response(self._client(max_retries), model=self._model(model), input=input, **params)
+
+    async def complete(self, model, input, max_retries=None, **params):
+        response = await self._client(max_retries).responses.create(model=self._model(model), input=input, **params)
+        return extract_text_from_response(response), getattr(response, "usage", None)
+
+    async def embed(self, model, texts, dimensions=None):
+        params = {"dimensions": dimensions} if dimensions else {}
+        response = await self._client().embeddings.create(model=self._model(model), input=list(texts), **params)
+        vectors = [None] * len(response.data)
+        for item in response.data:
+            vectors[item.index] = item.embedding
+        return vectors
+
+    async def warm_up(self):
+        await warm_up_openai_client(get_openai_client())  # no key needed to open the connection
+
+    async def close(self):
+        await close_openai_client()
+
+
+class LocalProvider(OpenAIProvider):
+    """An OpenAI-compatible server (own client and pool, same transport settings)."""
+
+    name = "local"
+
+    def __init__(self, base_url=LLM_LOCAL_BASE_URL, api_key=LLM_LOCAL_API_KEY, model=LLM_LOCAL_MODEL):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self._http = None
+        self._http_loop = None
+
+    def _client(self, max_retries=None):
+        # httpx connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._http is None or self._http_loop is not loop:
+            if self._http is not None:
+                _retire_client(self._http, self._http_loop)
+            self._http = _build_client(base_url=self.base_url, api_key=self.api_key)
+            self._http_loop = loop
+        return self._http if max_retries is None else self._http.with_options(max_retries=max_retries)
+
+    def _model(self, model):
+        return self.model or model
+
+    async def warm_up(self):
+        await warm_up_openai_client(self._client())
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+        self._http = None
+        self._http_loop = None
+
+
+class MockProvider(LLMProvider):
+    """
+    In-process stand-in: scripted replies (in turn), or an echo of the last
+    user message, after `first_token_ms` and at `tokens_per_second`.
+    JSON-schema requests get the smallest valid document and embeddings are
+    stable per text, so memory extraction and recall run unchanged.
+    """
+
+    name = "mock"
+
+    def __init__(self, replies=None, first_token_ms=LLM_MOCK_FIRST_TOKEN_MS,
+                 tokens_per_second=LLM_MOCK_TOKENS_PER_SECOND):
+        if replies is None and LLM_MOCK_REPLIES_FILE:
+            with open(LLM_MOCK_REPLIES_FILE) as f:
+                replies = json.load(f)
+        self._replies = itertools.cycle(replies) if replies else None
+        self.first_token_ms = first_token_ms
+        self.tokens_per_second = tokens_per_second
+        self.calls = {"stream": 0, "complete": 0, "embed": 0}
+
+    async def stream(self, model, input, max_retries=None, **params):
+        self.calls["stream"] += 1
+        text = self._reply(input, params)
+        await self._first_token_delay()
+        pause = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            yield "delta", word + (" " if i < len(words) - 1 else "")
+            if pause:
+                await asyncio.sleep(pause)
+        yield "usage", self._usage(input, text)
+        yield "done", text
+
+    async def complete(self, model, input, max_retries=None, **params):
+        self.calls["complete"] += 1
+        text = self._reply(input, params)
+        await self._first_token_delay()
+        if self.tokens_per_second > 0:
+            await asyncio.sleep(len(text.split(" ")) / self.tokens_per_second)
+        return text, self._usage(input, text)
+
+    async def embed(self, model, texts, dimensions=None):
+        self.calls["embed"] += 1
+        return [fake_embedding(text, dimensions or 256) for text in texts]
+
+    async def _first_token_delay(self):
+        if self.first_token_ms > 0:
+            await asyncio.sleep(self.first_token_ms / 1000)
+        else:
+            await asyncio.sleep(0)  # still yield to the loop, like a real call
+
+    def _reply(self, input, params):
+        text_format = (params.get("text") or {}).get("format") or {}
+        if text_format.get("type") == "json_schema":
+            return json.dumps(fake_json_document(text_format.get("schema") or {}, input))
+        if self._replies is not None:
+            return next(self._replies)
+        last = _last_user_text(input)
+        return f"(mock reply) You said: {last[:200]}" if last else "(mock reply)"
+
+    @staticmethod
+    def _usage(input, text):
+        input_tokens = max(1, len(json.dumps(input)) // 4)
+        return SimpleNamespace(
+            input_tokens=input_tokens,
+            output_tokens=max(1, len(text) // 4),
+            input_tokens_details=SimpleNamespace(cached_tokens=0),
+        )
+
+
+def _last_user_text(input):
+    if isinstance(input, str):
+        return re.sub(r"\s+", " ", input).strip()
+    for message in reversed(input or []):
+        if message.get("role") == "user":
+            return str(message.get("content", ""))
+    return ""
+
+
+BACKENDS = {"openai": OpenAIProvider, "local": LocalProvider, "mock": MockProvider}
+
+_providers = {}  # backend name -> instance (shared by the call types using it)
+
+
+def get_provider(call_type):
+    """The provider configured for `call_type` in settings.LLM_PROVIDERS."""
+    from django.conf import settings
+    backend = settings.LLM_PROVIDERS.get(call_type, "openai")
+    provider = _providers.get(backend)
+    if provider is None:
+        cls = BACKENDS.get(backend)
+        if cls is None:
+            module_name, _, attr = backend.rpartition(".")
+            cls = getattr(importlib.import_module(module_name), attr)
+        provider = _providers[backend] = cls()
+    return provider
+
+
+def set_provider(backend, provider):
+    """Use `provider` wherever `backend` is configured (tests, benchmarks)."""
+    _providers[backend] = provider
+
+
+async def close_providers():
+    for provider in list(_providers.values()):
+        await provider.close()
@@ -0,0 +1,346 @@
+# chat/resilience.py
+import logging
+import os
+import sys
+import time
+import random
+import asyncio
+from collections import deque
+
+from .utils_openai import MODEL_FOR_STREAM
+
+
+logger = logging.getLogger(__name__)
+
+
+CHAT_MODEL = MODEL_FOR_STREAM
+# Faster model used once CHAT_MODEL failed/timed out for this turn, or while its
+# circuit is open ("" disables the fallback)
+CHAT_FALLBACK_MODEL = os.getenv("CHAT_FALLBACK_MODEL", "gpt-4.1-nano")
+# Whole turn, retries included
+CHAT_TURN_DEADLINE = float(os.getenv("CHAT_TURN_DEADLINE", "45"))               # seconds
+# An attempt that produced nothing by then is abandoned (streaming: first token)
+CHAT_FIRST_TOKEN_TIMEOUT = float(os.getenv("CHAT_FIRST_TOKEN_TIMEOUT", "15"))   # seconds
+CHAT_MAX_ATTEMPTS = int(os.getenv("CHAT_MAX_ATTEMPTS", "3"))
+CHAT_RETRY_BASE = float(os.getenv("CHAT_RETRY_BASE", "0.25"))                   # seconds
+CHAT_RETRY_MAX = float(os.getenv("CHAT_RETRY_MAX", "2"))
+# Start a second, competing request when the first one is slower than the
+# recent p95 (never sooner than CHAT_HEDGE_MIN_DELAY); costs an extra call
+CHAT_HEDGE = os.getenv("CHAT_HEDGE", "0") == "1"
+CHAT_HEDGE_MIN_DELAY = float(os.getenv("CHAT_HEDGE_MIN_DELAY", "1.0"))           # seconds
+CHAT_HEDGE_MIN_SAMPLES = 20
+# Circuit breaker per model
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))        # consecutive failures to open
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "30"))
+
+
+def retryable_errors():
+    """
+    Errors worth another attempt; anything else (bad request, auth) is raised
+    at once. The SDK is only looked at once a backend has imported it: the
+    mock provider never does, so a worker does not pay for loading it.
+    """
+    openai = sys.modules.get("openai")
+    if openai is None:
+        return (asyncio.TimeoutError,)
+    return (
+        asyncio.TimeoutError,
+        openai.APIConnectionError,   # includes APITimeoutError
+        openai.RateLimitError,
+        openai.InternalServerError,
+    )
+
+
+def is_rate_limit(exc):
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(exc, openai.RateLimitError)
+
+
+class CircuitOpen(Exception):
+    """Every usable model's circuit is open; fail fast instead of waiting."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"upstream degraded, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failures` consecutive failures; open rejects calls
+    for `reset_seconds`, then half-open lets one probe through, whose result
+    closes or re-opens the circuit. Per process.
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self._stats = {"opened": 0, "rejected": 0, "successes": 0, "failures": 0}
+
+    def allow(self):
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+            self.state = "half_open"
+            self.probe_in_flight = False
+        if self.state == "closed":
+            return True
+        if self.state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        self._stats["rejected"] += 1
+        return False
+
+    def record_success(self):
+        self._stats["successes"] += 1
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self._stats["failures"] += 1
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+        if self.state == "half_open" or self.consecutive_failures >= self.failures:
+            if self.state != "open":
+                self._stats["opened"] += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release_probe(self):
+        """A call ended without a verdict (cancelled): let the next one probe."""
+        self.probe_in_flight = False
+
+    def retry_after(self):
+        if self.state != "open":
+            return 0
+        return max(1, int(self.reset_seconds - (time.monotonic() - self.opened_at)) + 1)
+
+    def stats(self):
+        return dict(self._stats, state=self.state, consecutive_failures=self.consecutive_failures)
+
+
+class LatencyTracker:
+    """Recent latencies (seconds) of one kind of call, for the hedging threshold."""
+
+    def __init__(self, size=500):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+_breakers = {}
+_latency = {"stream": LatencyTracker(), "full": LatencyTracker()}
+_stats = {"turns": 0, "retries": 0, "fallbacks": 0, "hedges": 0, "hedge_wins": 0, "deadline_exceeded": 0}
+
+
+def get_breaker(model):
+    breaker = _breakers.get(model)
+    if breaker is None:
+        breaker = _breakers[model] = CircuitBreaker(model)
+    return breaker
+
+
+def get_resilience_stats():
+    stats = dict(_stats)
+    stats["breakers"] = {model: b.stats() for model, b in _breakers.items()}
+    for kind, tracker in _latency.items():
+        p95 = tracker.percentile(0.95)
+        stats[f"{kind}_first_event_p95_ms"] = round(p95 * 1000, 1) if p95 is not None else None
+    return stats
+
+
+def _backoff(attempt):
+    """Full jitter: uniform(0, min(max, base * 2^attempt))."""
+    return random.uniform(0, min(CHAT_RETRY_MAX, CHAT_RETRY_BASE * (2 ** attempt)))
+
+
+def _pick_model(attempt):
+    """Attempt 0 uses CHAT_MODEL, later ones the fallback; skip models whose circuit is open."""
+    order = [CHAT_MODEL]
+    if CHAT_FALLBACK_MODEL and CHAT_FALLBACK_MODEL != CHAT_MODEL:
+        order = [CHAT_MODEL, CHAT_FALLBACK_MODEL] if attempt == 0 else [CHAT_FALLBACK_MODEL, CHAT_MODEL]
+    for model in order:
+        if get_breaker(model).allow():
+            return model
+    return None
+
+
+class _Attempt:
+    """One upstream call: its event iterator and the task fetching its first event."""
+
+    def __init__(self, open_events, model):
+        self.model = model
+        self.started = time.perf_counter()
+        self.events = None
+        # opening the call happens in the task too, so its errors surface there
+        self.first = asyncio.ensure_future(self._open(open_events))
+
+    async def _open(self, open_events):
+        self.events = open_events(self.model)
+        return await self.events.__anext__()
+
+    async def close(self):
+        if not self.first.done():
+            self.first.cancel()
+        await asyncio.gather(self.first, return_exceptions=True)
+        if self.events is None:
+            return
+        try:
+            await self.events.aclose()  # closes the HTTP stream: the provider stops generating
+        except Exception:
+            pass
+
+
+async def _first_event(attempts, timeout):
+    """Wait until one attempt yields its first event; returns (attempt, event) or raises."""
+    pending = {a.first: a for a in attempts}
+    done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    if not done:
+        raise asyncio.TimeoutError()
+    for task in done:
+        if task.exception() is None:
+            return pending[task], task.result()
+    # all finished ones failed; if another is still running, give it the rest of the time
+    failed = [pending[t] for t in done]
+    running = [a for a in attempts if a not in failed]
+    if running:
+        for a in failed:
+            await a.close()
+        return await _first_event(running, timeout)
+    raise next(iter(done)).exception()
+
+
+async def resilient_events(open_events, kind="stream", deadline=CHAT_TURN_DEADLINE,
+                           first_event_timeout=CHAT_FIRST_TOKEN_TIMEOUT):
+    """
+    Run one chat call with tail-latency controls. `open_events(model)`
+    returns the call's async iterator of (kind, value) events (see
+    utils_openai.stream_response). Yields ("model", name) once an attempt
+    wins, then that attempt's events.
+
+    - the whole turn must finish within `deadline` seconds
+    - an attempt without a first event within `first_event_timeout` (or one
+      that fails with a retryable error) is abandoned and retried after a
+      jittered backoff, on CHAT_FALLBACK_MODEL after the first failure
+    - with CHAT_HEDGE, a second attempt is started once the first is slower
+      than the recent p95; the first one to produce an event wins
+    - models whose circuit breaker is open are skipped; CircuitOpen is raised
+      when none is left
+
+    Only the time before the first event is retried: once text has reached
+    the client, the attempt is committed to.
+    """
+    _stats["turns"] += 1
+    turn_started = time.perf_counter()
+    tracker = _latency[kind]
+    last_error = None
+
+    for attempt_no in range(max(1, CHAT_MAX_ATTEMPTS)):
+        remaining = deadline - (time.perf_counter() - turn_started)
+        if remaining <= 0:
+            break
+        model = _pick_model(attempt_no)
+        if model is None:
+            raise CircuitOpen(min(get_breaker(m).retry_after() or 1 for m in _breakers) if _breakers else 1)
+        if attempt_no:
+            _stats["retries"] += 1
+            if model != CHAT_MODEL:
+                _stats["fallbacks"] += 1
+
+        attempts = [_Attempt(open_events, model)]
+        timeout = min(first_event_timeout or remaining, remaining)
+        try:
+            winner, event = await _race(attempts, open_events, tracker, timeout)
+        except retryable_errors() as e:
+            last_error = e
+            await _abandon(attempts, failed=True)
+            logger.warning("attempt %d on %s failed: %s: %s", attempt_no + 1, model, type(e).__name__, e)
+            pause = min(_backoff(attempt_no), max(0.0, deadline - (time.perf_counter() - turn_started)))
+            await asyncio.sleep(pause)
+            continue
+        except BaseException:
+            await _abandon(attempts, failed=False)
+            raise
+
+        await _abandon([a for a in attempts if a is not winner], failed=False)
+        tracker.add(time.perf_counter() - winner.started)
+
+        try:
+            yield "model", winner.model
+            yield event
+            while True:
+                remaining = deadline - (time.perf_counter() - turn_started)
+                if remaining <= 0:
+                    _stats["deadline_exceeded"] += 1
+                    raise asyncio.TimeoutError()
+                try:
+                    event = await asyncio.wait_for(winner.events.__anext__(), remaining)
+                except StopAsyncIteration:
+                    break
+                yield event
+        except BaseException as e:
+            await _abandon([winner], failed=isinstance(e, retryable_errors()))
+            raise
+        get_breaker(winner.model).record_success()
+        return
+
+    if last_error is None:
+        _stats["deadline_exceeded"] += 1
+        last_error = asyncio.TimeoutError()
+    raise last_error
+
+
+async def _abandon(attempts, failed):
+    """
+    Close attempts that will not be read any further. A retryable error
+    (timeout, connection error, 429, 5xx) counts against their models'
+    breakers; otherwise (client error, cancelled, lost a hedge race) there is
+    no verdict and only a half-open probe they held is given back. Breakers
+    are settled before closing, so even a cancelled close cannot leave a
+    probe marked in flight.
+    """
+    for a in attempts:
+        breaker = get_breaker(a.model)
+        if failed:
+            breaker.record_failure()
+        else:
+            breaker.release_probe()
+    for a in attempts:
+        await a.close()
+
+
+async def _race(attempts, open_events, tracker, timeout):
+    """First event of attempts[0], hedged with a second attempt if enabled and slow."""
+    if not CHAT_HEDGE:
+        return await _first_event(attempts, timeout)
+
+    p95 = tracker.percentile(0.95) if len(tracker.samples) >= CHAT_HEDGE_MIN_SAMPLES else None
+    hedge_after = max(CHAT_HEDGE_MIN_DELAY, p95) if p95 is not None else None
+    if hedge_after is None or hedge_after >= timeout:
+        return await _first_event(attempts, timeout)
+
+    started = time.perf_counter()
+    try:
+        return await _first_event(attempts, hedge_after)
+    except asyncio.TimeoutError:
+        pass
+
+    # still nothing after the p95: race a second request (on the fallback
+    # model if there is one, it is usually the faster one)
+    hedge_model = _pick_model(1) or attempts[0].model
+    attempts.append(_Attempt(open_events, hedge_model))
+    _stats["hedges"] += 1
+    winner, event = await _first_event(attempts, max(0.0, timeout - (time.perf_counter() - started)))
+    if winner is not attempts[0]:
+        _stats["hedge_wins"] += 1
+    return winner, event
@@ -1,3 +1,307 @@
-from django.test import TestCase
+import time
+import asyncio
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from . import resilience
+from .admission import PRIORITY_BACKGROUND, AdmissionController, AdmissionTimeout, TokenBucket
+from .prompting import MESSAGE_OVERHEAD_TOKENS, estimate_tokens, pack_context, pack_recall
+from .providers import MockProvider
+from .resilience import (
+    CHAT_FALLBACK_MODEL, CHAT_MODEL, CircuitBreaker, CircuitOpen, LatencyTracker,
+    get_breaker, resilient_events,
+)
+
+
+def _history(*contents):
+    return [{"seq": i, "role": "user", "content": c, "tokens": estimate_tokens(c)} for i, c in enumerate(contents)]
+
+
+class PackContextTests(SimpleTestCase):
+    def test_everything_fits(self):
+        history = _history("hello there", "how are you")
+        summary, packed, used, start = pack_context("system", "likes tea", history, "hi", budget=1000)
+        self.assertEqual(summary, "likes tea")
+        self.assertEqual(packed, history)
+        self.assertEqual(start, 0)
+        self.assertEqual(used, sum(estimate_tokens(t) + MESSAGE_OVERHEAD_TOKENS
+                                   for t in ("system", "likes tea", "hi", "hello there", "how are you")))
+
+    def test_overflow_drops_oldest_and_stays_within_budget(self):
+        history = _history(*[f"message number {i} with a few more words" for i in range(40)])
+        _, packed, used, start = pack_context("system", "", history, "hi", budget=120)
+        self.assertLessEqual(used, 120)
+        self.assertTrue(packed)
+        self.assertEqual(packed[-1], history[-1])
+        self.assertEqual(start, packed[0]["seq"])
+
+    def test_history_start_is_kept_while_it_fits(self):
+        history = _history(*[f"message number {i} with a few more words" for i in range(40)])
+        _, first, _, start = pack_context("system", "", history, "hi", budget=200)
+        history.append({"seq": 40, "role": "user", "content": "one more", "tokens": 2})
+        _, second, _, second_start = pack_context("system", "", history, "hi", budget=200, start_seq=start)
+        self.assertEqual(second_start, start)
+        self.assertEqual(second[:len(first)], first)
+
+    def test_summary_is_capped_independently_of_the_user_message(self):
+        summary = "fact " * 500
+        short = pack_context("system", summary, [], "hi", budget=300)[0]
+        long = pack_context("system", summary, [], "word " * 100, budget=300)[0]
+        self.assertEqual(short, long)
+        self.assertLess(estimate_tokens(short), 300)
+
+    def test_pack_recall_keeps_best_snippets_within_budget(self):
+        snippets = [{"content": "word " * 20}, {"content": "word " * 20}, {"content": "short"}]
+        packed = pack_recall(snippets, budget=40)
+        self.assertEqual(packed, snippets[:1])
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_refill(self):
+        now = [100.0]
+        with mock.patch("chat.admission.time.monotonic", lambda: now[0]):
+            bucket = TokenBucket(rate_per_second=2, burst=3)
+            self.assertEqual(bucket.wait_for(3), 0.0)
+            bucket.tokens -= 3
+            self.assertAlmostEqual(bucket.wait_for(1), 0.5)
+            now[0] += 0.5
+            self.assertEqual(bucket.wait_for(1), 0.0)
+            now[0] += 60
+            bucket.refill()
+            self.assertEqual(bucket.tokens, 3)
+
+
+class AdmissionTests(SimpleTestCase):
+    async def test_rate_limit_per_key(self):
+        admission = AdmissionController("", user_rate=60, user_burst=2)
+        self.assertEqual(await admission.check_rate("conn:a"), 0)
+        self.assertEqual(await admission.check_rate("conn:a"), 0)
+        self.assertGreaterEqual(await admission.check_rate("conn:a"), 1)
+        self.assertEqual(await admission.check_rate("conn:b"), 0)
+        self.assertEqual(admission.stats()["rate_limited"], 1)
+
+    async def test_slot_queues_chat_before_background(self):
+        admission = AdmissionController("", max_concurrency=1)
+        order, queued = [], []
+
+        async def call(name, priority, external_id):
+            async def on_queued(position):
+                queued.append(name)
+            async with admission.slot(external_id, priority=priority, on_queued=on_queued):
+                order.append(name)
+                await asyncio.sleep(0.01)
+
+        async with admission.slot("user:1"):
+            tasks = [asyncio.ensure_future(call("background", PRIORITY_BACKGROUND, "user:2"))]
+            await asyncio.sleep(0.01)
+            tasks.append(asyncio.ensure_future(call("chat", 0, "user:3")))
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(sorted(queued), ["background", "chat"])
+        self.assertEqual(order, ["chat", "background"])
+        self.assertEqual(admission.stats()["in_flight"], 0)
+
+    async def test_slot_timeout(self):
+        admission = AdmissionController("", max_concurrency=1)
+        async with admission.slot("user:1"):
+            with self.assertRaises(AdmissionTimeout) as raised:
+                async with admission.slot("user:2", timeout=0.05):
+                    pass
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+        async with admission.slot("user:2", timeout=0.05):
+            pass
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def test_transitions(self):
+        breaker = CircuitBreaker("m", failures=2, reset_seconds=30)
+        now = [1000.0]
+        with mock.patch("chat.resilience.time.monotonic", lambda: now[0]):
+            breaker.record_failure()
+            self.assertEqual(breaker.state, "closed")
+            breaker.record_failure()
+            self.assertEqual(breaker.state, "open")
+            self.assertFalse(breaker.allow())
+            self.assertGreaterEqual(breaker.retry_after(), 1)
+
+            now[0] += 30
+            self.assertTrue(breaker.allow())           # the probe
+            self.assertEqual(breaker.state, "half_open")
+            self.assertFalse(breaker.allow())          # only one at a time
+            breaker.record_failure()
+            self.assertEqual(breaker.state, "open")
+
+            now[0] += 30
+            self.assertTrue(breaker.allow())
+            breaker.record_success()
+            self.assertEqual(breaker.state, "closed")
+            self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.stats()["opened"], 2)
+
+
+async def _collect(events):
+    return [event async for event in events]
+
+
+class ResilientEventsTests(SimpleTestCase):
+    def setUp(self):
+        resilience._breakers.clear()
+        self.addCleanup(resilience._breakers.clear)
+        patcher = mock.patch.dict(resilience._latency, {"stream": LatencyTracker()})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch("chat.resilience._backoff", return_value=0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _open(self, providers):
+        def open_events(model):
+            return providers[model].events(model, [{"role": "user", "content": "hi"}])
+        return open_events
+
+    async def test_streams_the_primary_model(self):
+        provider = MockProvider(replies=["hello there"])
+        events = await _collect(resilient_events(self._open({CHAT_MODEL: provider})))
+        self.assertEqual(events[0], ("model", CHAT_MODEL))
+        self.assertEqual("".join(v for k, v in events if k == "delta"), "hello there")
+        self.assertEqual(events[-1], ("done", "hello there"))
+        self.assertEqual(get_breaker(CHAT_MODEL).stats()["successes"], 1)
+
+    async def test_slow_first_token_falls_back(self):
+        providers = {
+            CHAT_MODEL: MockProvider(replies=["slow"], first_token_ms=2000),
+            CHAT_FALLBACK_MODEL: MockProvider(replies=["fast"]),
+        }
+        events = await _collect(resilient_events(self._open(providers), first_event_timeout=0.05))
+        self.assertEqual(events[0], ("model", CHAT_FALLBACK_MODEL))
+        self.assertEqual(events[-1], ("done", "fast"))
+        self.assertEqual(get_breaker(CHAT_MODEL).stats()["failures"], 1)
+
+    async def test_retryable_error_is_retried(self):
+        calls = []
+        provider = MockProvider(replies=["ok"])
+
+        def open_events(model):
+            calls.append(model)
+            if len(calls) == 1:
+                raise asyncio.TimeoutError()
+            return provider.events(model, "hi")
+
+        events = await _collect(resilient_events(open_events))
+        self.assertEqual(calls, [CHAT_MODEL, CHAT_FALLBACK_MODEL])
+        self.assertEqual(events[-1], ("done", "ok"))
+
+    async def test_hedge_wins_against_a_slow_attempt(self):
+        for _ in range(resilience.CHAT_HEDGE_MIN_SAMPLES):
+            resilience._latency["stream"].add(0.01)
+        providers = {
+            CHAT_MODEL: MockProvider(replies=["slow"], first_token_ms=2000),
+            CHAT_FALLBACK_MODEL: MockProvider(replies=["hedged"]),
+        }
+        hedges = resilience._stats["hedge_wins"]
+        with mock.patch("chat.resilience.CHAT_HEDGE", True), \
+                mock.patch("chat.resilience.CHAT_HEDGE_MIN_DELAY", 0.05):
+            events = await _collect(resilient_events(self._open(providers)))
+        self.assertEqual(events[0], ("model", CHAT_FALLBACK_MODEL))
+        self.assertEqual(events[-1], ("done", "hedged"))
+        self.assertEqual(resilience._stats["hedge_wins"], hedges + 1)
+        self.assertFalse(get_breaker(CHAT_MODEL).probe_in_flight)
+
+    async def test_all_circuits_open(self):
+        for model in (CHAT_MODEL, CHAT_FALLBACK_MODEL):
+            breaker = get_breaker(model)
+            breaker.state, breaker.opened_at = "open", time.monotonic()
+        with self.assertRaises(CircuitOpen) as raised:
+            await _collect(resilient_events(self._open({})))
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+
+
+def _half_open(model):
+    breaker = get_breaker(model)
+    breaker.state = "open"
+    breaker.opened_at = time.monotonic() - breaker.reset_seconds
+    return breaker
+
+
+class ResilientEventsProbeTests(SimpleTestCase):
+    def setUp(self):
+        resilience._breakers.clear()
+        self.addCleanup(resilience._breakers.clear)
+
+    async def test_cancelled_probe_is_released(self):
+        breaker = _half_open(CHAT_MODEL)
+        opened = asyncio.Event()
+
+        async def hanging(model):
+            opened.set()
+            await asyncio.sleep(3600)
+            yield "done", ""
+
+        async def consume():
+            async for _ in resilient_events(hanging):
+                pass
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.wait_for(opened.wait(), 1)
+        self.assertTrue(breaker.probe_in_flight)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.assertFalse(breaker.probe_in_flight)
+        self.assertEqual(breaker.state, "half_open")
+        self.assertTrue(breaker.allow())
+
+    async def test_failed_probe_reopens_the_circuit(self):
+        breaker = _half_open(CHAT_MODEL)
+
+        async def timing_out(model):
+            raise asyncio.TimeoutError()
+            yield
+
+        with mock.patch("chat.resilience._backoff", return_value=0):
+            with self.assertRaises(asyncio.TimeoutError):
+                async for _ in resilient_events(timing_out):
+                    pass
+
+        self.assertFalse(breaker.probe_in_flight)
+        self.assertEqual(breaker.state, "open")
+
+    async def test_client_error_is_not_a_breaker_failure(self):
+        breaker = _half_open(CHAT_MODEL)
+
+        async def bad_request(model):
+            raise ValueError("bad request")
+            yield
+
+        with self.assertRaises(ValueError):
+            async for _ in resilient_events(bad_request):
+                pass
+        # the probe is given back without a verdict
+        self.assertFalse(breaker.probe_in_flight)
+        self.assertEqual(breaker.state, "half_open")
+
+        # and however often it happens, a closed breaker stays closed
+        resilience._breakers.clear()
+        closed = get_breaker(CHAT_MODEL)
+        for _ in range(closed.failures + 1):
+            with self.assertRaises(ValueError):
+                await _collect(resilient_events(bad_request))
+        self.assertEqual(closed.state, "closed")
+        self.assertEqual(closed.stats()["failures"], 0)
+
+
+class MetricsEndpointTests(SimpleTestCase):
+    def test_closed_without_a_token(self):
+        with mock.patch("chat.views.METRICS_TOKEN", ""):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+
+    def test_bearer_token(self):
+        with mock.patch("chat.views.METRICS_TOKEN", "s3cret"):
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"# TYPE", response.content)
@@ -0,0 +1,161 @@
+# chat/turns.py
+import logging
+import os
+import time
+import uuid
+import asyncio
+from contextlib import asynccontextmanager
+
+
+logger = logging.getLogger(__name__)
+
+
+# A turn holds the per-user lock at most this long (covers a slow upstream
+# call; a crashed worker's lock simply expires)
+TURN_LOCK_TTL = float(os.getenv("TURN_LOCK_TTL", "90"))       # seconds
+# How long a new turn waits for the previous one of the same user
+TURN_LOCK_WAIT = float(os.getenv("TURN_LOCK_WAIT", "15"))     # seconds
+TURN_LOCK_POLL = 0.02
+REDIS_RETRY_SECONDS = 30.0
+KEY_PREFIX = "chat:turn:"
+
+# Delete the lock only if we still own it
+_RELEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class TurnBusy(Exception):
+    """The previous turn of this user did not finish within TURN_LOCK_WAIT."""
+
+
+class TurnSequencer:
+    """
+    Runs the chat turns of one key (a signed-in user's external_id, or a
+    single connection for anonymous chats) one at a time, across tabs and
+    workers: an asyncio.Lock per user orders turns within this process (in
+    arrival order), a Redis lock (SET NX PX + compare-and-delete) serializes
+    them between processes. Everything a turn persists is timestamped while it
+    holds the lock, so ConversationMessage order is turn order.
+
+    Without Redis only the in-process lock applies (single-worker setups),
+    and Redis is retried after REDIS_RETRY_SECONDS.
+    """
+
+    def __init__(self, redis_url, lock_ttl=TURN_LOCK_TTL, wait=TURN_LOCK_WAIT):
+        self.redis_url = redis_url
+        self.lock_ttl = lock_ttl
+        self.wait = wait
+        self._local = {}         # external_id -> [asyncio.Lock, users]
+        self._redis = None
+        self._redis_loop = None
+        self._redis_retry_at = 0.0
+        self._release = None
+        self._stats = {"turns": 0, "waited": 0, "busy": 0, "redis_errors": 0, "max_wait_ms": 0.0}
+
+    @asynccontextmanager
+    async def turn(self, external_id, shared=True):
+        """
+        Hold the user's turn for the duration of the block (raises TurnBusy).
+        shared=False: the key never leaves this process (one connection), so
+        the Redis lock is skipped.
+        """
+        started = time.perf_counter()
+        entry = self._local.setdefault(external_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), self.wait)
+            except asyncio.TimeoutError:
+                self._stats["busy"] += 1
+                raise TurnBusy(external_id)
+            try:
+                token = await self._acquire_remote(external_id, started) if shared else None
+                waited_ms = round((time.perf_counter() - started) * 1000, 1)
+                self._stats["turns"] += 1
+                if waited_ms > 5:
+                    self._stats["waited"] += 1
+                self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], waited_ms)
+                try:
+                    yield
+                finally:
+                    if token is not None:
+                        await self._release_remote(external_id, token)
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._local.pop(external_id, None)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["users_active"] = len(self._local)
+        stats["redis_connected"] = self._redis is not None
+        return stats
+
+    # internals ------------------------------------------------------------
+
+    async def _acquire_remote(self, external_id, started):
+        client = await self._client()
+        if client is None:
+            return None
+        token = uuid.uuid4().hex
+        key = KEY_PREFIX + external_id
+        try:
+            while True:
+                if await client.set(key, token, nx=True, px=int(self.lock_ttl * 1000)):
+                    return token
+                if time.perf_counter() - started > self.wait:
+                    self._stats["busy"] += 1
+                    raise TurnBusy(external_id)
+                await asyncio.sleep(TURN_LOCK_POLL)
+        except TurnBusy:
+            raise
+        except Exception as e:
+            self._redis_failed(e)
+            return None
+
+    async def _release_remote(self, external_id, token):
+        try:
+            await self._release(keys=[KEY_PREFIX + external_id], args=[token])
+        except Exception as e:
+            self._redis_failed(e)
+
+    async def _client(self):
+        # redis.asyncio connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._redis is not None and self._redis_loop is loop:
+            return self._redis
+        if not self.redis_url or time.monotonic() < self._redis_retry_at:
+            return None
+        try:
+            import redis.asyncio as aioredis
+            client = aioredis.Redis.from_url(self.redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+            await client.ping()
+            self._redis, self._redis_loop = client, loop
+            self._release = client.register_script(_RELEASE)
+        except Exception as e:
+            self._redis_failed(e)
+        return self._redis
+
+    def _redis_failed(self, error):
+        self._stats["redis_errors"] += 1
+        logger.warning("Redis unavailable, serializing turns per process only: %s", error)
+        self._redis = None
+        self._redis_retry_at = time.monotonic() + REDIS_RETRY_SECONDS
+
+
+_turn_sequencer = None
+
+
+def get_turn_sequencer():
+    """Process-wide TurnSequencer, configured from settings on first use."""
+    global _turn_sequencer
+    if _turn_sequencer is None:
+        from django.conf import settings
+        _turn_sequencer = TurnSequencer(settings.REDIS_URL)
+    return _turn_sequencer
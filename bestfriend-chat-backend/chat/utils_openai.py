@@ -1,18 +1,228 @@
 # utils_openai.py
+import logging
 import os
+import time
 import asyncio
-from openai import OpenAI
 
 
-MODEL_FOR_STREAM = os.getenv("CHAT_MODEL", "gpt-4.1-mini")
+logger = logging.getLogger(__name__)
+
+
+MODEL_FOR_STREAM = os.getenv("CHAT_MODEL", "gpt-5-nano")
 PERSONALITY_PROMPT = (
     "You are Aira, the user's caring best friend. Warm, empathetic, funny in a light way. "
     "Always validate emotions, avoid judgement, avoid long explanations, and use short comforting examples and gentle guidance. "
     "You may use 1-2 light emojis to convey tone."
 )
 
+# Connection pool for the shared client (one per process)
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "120"))
+OPENAI_HTTP2 = os.getenv("OPENAI_HTTP2", "1") == "1"
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+_client = None
+_client_loop = None
+# close() tasks of clients replaced after an event loop change
+_retiring = set()
+
+# Input tokens served from the provider's prompt cache, per call type
+_usage_counters = {}
+
+_pool_counters = {
+    "requests_total": 0,
+    "requests_in_flight": 0,
+    "tcp_connects": 0,
+    "tls_handshakes": 0,
+}
+
+
+async def _trace(event_name, info):
+    """httpcore trace hook: count real connection setups (not reused ones)."""
+    if event_name == "connection.connect_tcp.complete":
+        _pool_counters["tcp_connects"] += 1
+    elif event_name == "connection.start_tls.complete":
+        _pool_counters["tls_handshakes"] += 1
+
+
+_transport_class = None
+
+
+def _counting_transport_class():
+    # defined on first use: httpx (and the OpenAI SDK below) are only
+    # imported once a client is built, not when a worker boots
+    global _transport_class
+    if _transport_class is None:
+        import httpx
+
+        class _CountingTransport(httpx.AsyncHTTPTransport):
+            async def handle_async_request(self, request):
+                request.extensions.setdefault("trace", _trace)
+                _pool_counters["requests_total"] += 1
+                _pool_counters["requests_in_flight"] += 1
+                try:
+                    return await super().handle_async_request(request)
+                finally:
+                    _pool_counters["requests_in_flight"] -= 1
+
+        _transport_class = _CountingTransport
+    return _transport_class
+
+
+def _http2_available():
+    if not OPENAI_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        logger.info("h2 not installed, falling back to HTTP/1.1")
+        return False
+
+
+def _build_client(base_url=None, api_key=None):
+    import httpx
+    from openai import AsyncOpenAI
+
+    transport = _counting_transport_class()(
+        http2=_http2_available(),
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        ),
+    )
+    http_client = httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+    )
+    return AsyncOpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"), base_url=base_url, http_client=http_client)
+
+
+def _retire_client(client, loop):
+    """
+    Close a client that was built on another event loop. Its connections
+    belong to that loop, so the close runs there while it is still running
+    (another thread); otherwise it is attempted here and failures are only
+    logged, the pool is dropped either way.
+    """
+    if loop is not None and loop.is_running() and not loop.is_closed():
+        asyncio.run_coroutine_threadsafe(client.close(), loop)
+        return
+    task = asyncio.ensure_future(_close_quietly(client))
+    _retiring.add(task)
+    task.add_done_callback(_retiring.discard)
+
+
+async def _close_quietly(client):
+    try:
+        await client.close()
+    except Exception as e:
+        logger.debug("closing a client of a finished event loop failed: %s", e)
+
+
 def get_openai_client():
-    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    """
+    Return the process-wide AsyncOpenAI client.
+
+    Every caller (chat reply, summary, analysis) shares one httpx pool, so
+    keep-alive / HTTP/2 connections are reused across turns instead of paying
+    a TLS handshake per call. httpx connections are tied to the event loop that
+    opened them, so the client is rebuilt if it is used from a different loop
+    (e.g. a management command calling asyncio.run() more than once) and the
+    old one is closed.
+    """
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client_loop is not loop:
+        if _client is not None:
+            _retire_client(_client, _client_loop)
+        _client = _build_client()
+        _client_loop = loop
+    return _client
+
+
+async def close_openai_client():
+    global _client, _client_loop
+    if _client is not None:
+        await _client.close()
+    _client = None
+    _client_loop = None
+
+
+async def warm_up_openai_client(client=None):
+    """
+    Open the first pooled connection before real traffic arrives.
+
+    Any HTTP response (even 401 without a key) means DNS, TCP and TLS are done
+    and the connection is parked in the pool for the first chat turn.
+    """
+    client = client or get_openai_client()
+    started = time.perf_counter()
+    try:
+        await client.with_options(max_retries=0, timeout=10.0).models.with_raw_response.list()
+    except Exception as e:
+        logger.warning("warm-up request failed: %s", e)
+    logger.info("pool warm-up took %.1fms", (time.perf_counter() - started) * 1000)
+
+
+def record_usage(call_type, usage):
+    """Accumulate response.usage, splitting input tokens into cached / uncached."""
+    if usage is None:
+        return
+    input_tokens = getattr(usage, "input_tokens", 0) or 0
+    details = getattr(usage, "input_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", 0) or 0) if details is not None else 0
+
+    counters = _usage_counters.setdefault(call_type, {
+        "responses": 0,
+        "input_tokens": 0,
+        "cached_input_tokens": 0,
+        "uncached_input_tokens": 0,
+        "output_tokens": 0,
+    })
+    counters["responses"] += 1
+    counters["input_tokens"] += input_tokens
+    counters["cached_input_tokens"] += cached
+    counters["uncached_input_tokens"] += input_tokens - cached
+    counters["output_tokens"] += getattr(usage, "output_tokens", 0) or 0
+
+
+def get_prompt_cache_stats():
+    """{call_type: counters + cached_ratio} for every call type seen so far."""
+    stats = {}
+    for call_type, counters in _usage_counters.items():
+        entry = dict(counters)
+        entry["cached_ratio"] = (
+            round(entry["cached_input_tokens"] / entry["input_tokens"], 4) if entry["input_tokens"] else 0.0
+        )
+        stats[call_type] = entry
+    return stats
+
+
+def get_pool_stats():
+    """
+    Snapshot of the shared client's connection pool.
+    `tcp_connects` / `tls_handshakes` only grow when a connection could not be
+    reused, so compare them against `requests_total`.
+    """
+    stats = dict(_pool_counters)
+    stats.update({"connections": 0, "connections_idle": 0, "connections_active": 0, "http2": False})
+    if _client is None:
+        return stats
+
+    transport = getattr(_client._client, "_transport", None)
+    pool = getattr(transport, "_pool", None)
+    stats["http2"] = bool(getattr(pool, "_http2", False))
+    for conn in getattr(pool, "connections", []) or []:
+        stats["connections"] += 1
+        if conn.is_idle():
+            stats["connections_idle"] += 1
+        else:
+            stats["connections_active"] += 1
+    return stats
+
 
 def extract_text_from_response(resp):
     """
@@ -41,3 +251,50 @@ def extract_text_from_response(resp):
 
     # Last resort: stringified response
     return str(resp)
+
+
+def extract_delta_from_event(event):
+    """
+    Return the text delta carried by a streaming event, or "" for events
+    that don't carry assistant text (created, in_progress, item.added, ...).
+    """
+    if getattr(event, "type", None) == "response.output_text.delta":
+        return getattr(event, "delta", "") or ""
+    return ""
+
+
+async def stream_response(client, **kwargs):
+    """
+    Async generator over a streaming Responses API call. Yields:
+      ("delta", text)       for every output_text delta, as it arrives
+      ("usage", usage)      once, if the completed response reports usage
+      ("done", final_text)  once, at the end
+
+    `final_text` is taken from the completed response with
+    extract_text_from_response(), so it matches the non-streaming path;
+    the joined deltas are only used if no completed response was seen.
+    """
+    chunks = []
+    completed = None
+
+    stream = await client.responses.create(stream=True, **kwargs)
+    try:
+        async for event in stream:
+            delta = extract_delta_from_event(event)
+            if delta:
+                chunks.append(delta)
+                yield "delta", delta
+            elif getattr(event, "type", None) == "response.completed":
+                completed = getattr(event, "response", None)
+    finally:
+        # also runs when the consumer stops early (disconnect / error),
+        # which releases the pooled connection instead of leaking it
+        await stream.close()
+
+    if completed is not None:
+        if getattr(completed, "usage", None) is not None:
+            yield "usage", completed.usage
+        yield "done", extract_text_from_response(completed)
+    else:
+        yield "done", "".join(chunks)
+
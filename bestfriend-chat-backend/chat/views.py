@@ -1,3 +1,21 @@
-from django.shortcuts import render
+import os
+import hmac
 
-# Create your views here.
+from django.http import HttpResponse, HttpResponseForbidden
+
+from .metrics import get_metrics_text
+
+
+# Scrapers must send "Authorization: Bearer <METRICS_TOKEN>"; without a
+# token configured the endpoint is closed
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+async def metrics(request):
+    """Prometheus scrape endpoint (process-local: one target per worker)."""
+    if not METRICS_TOKEN:
+        return HttpResponseForbidden()
+    supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not hmac.compare_digest(supplied, METRICS_TOKEN):
+        return HttpResponseForbidden()
+    return HttpResponse(get_metrics_text(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,12 +1,14 @@
 from django.contrib import admin
 
 # Register your models here.
-from .models import UserMemory, ConversationMessage, ConversationSummary
+from .models import UserMemory, ConversationMessage, ConversationSummary, UserMemoryStats, RecallSegment
 
 
 
 admin.site.register(UserMemory)
 admin.site.register(ConversationMessage)
 admin.site.register(ConversationSummary)    
+admin.site.register(UserMemoryStats)
+admin.site.register(RecallSegment)
 
 # Register your models here.    
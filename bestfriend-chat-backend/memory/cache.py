@@ -0,0 +1,235 @@
+# memory/cache.py
+import logging
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+INVALIDATION_CHANNEL = "memory:cache:invalidate"
+KEY_PREFIX = "memory:cache:"
+REDIS_RETRY_SECONDS = 30.0
+
+
+class LRUCache:
+    """
+    Small thread-safe LRU with a per-entry TTL.
+    Used from the event loop and from ORM worker threads.
+    """
+
+    _MISSING = object()
+
+    def __init__(self, max_entries=10000, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, self._MISSING)
+            if item is self._MISSING:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class MemoryCache:
+    """
+    Read-through cache for per-user memory (summary text, UserMemory.facts):
+    in-process LRU -> Redis -> loader (the database).
+
+    Writers call set(), which updates Redis and the local LRU and publishes
+    the key on INVALIDATION_CHANNEL; every other worker drops its local copy
+    and re-reads it from Redis on next use. If Redis is unreachable the cache
+    degrades to local-only and the loader, and reconnects after
+    REDIS_RETRY_SECONDS (local entries may then be stale for up to local_ttl).
+    """
+
+    def __init__(self, redis_url, enabled=True, local_max_entries=10000, local_ttl=300.0, redis_ttl=86400):
+        self.redis_url = redis_url
+        self.enabled = enabled
+        self.redis_ttl = redis_ttl
+        self.local = LRUCache(max_entries=local_max_entries, ttl=local_ttl)
+        self._origin = uuid.uuid4().hex  # ignore our own invalidations
+        self._redis = None
+        self._redis_retry_at = 0.0
+        self._subscriber = None
+        self._init_lock = threading.Lock()
+        self._stats = {
+            "local_hits": 0,
+            "redis_hits": 0,
+            "misses": 0,
+            "sets": 0,
+            "invalidations_received": 0,
+            "redis_errors": 0,
+        }
+
+    # public API ---------------------------------------------------------
+
+    def get(self, kind, external_id, loader):
+        """
+        Return the cached value for (kind, external_id), calling `loader()`
+        (and caching its result) on a miss.
+        """
+        if not self.enabled:
+            return loader()
+
+        key = self._key(kind, external_id)
+        value = self.local.get(key, LRUCache._MISSING)
+        if value is not LRUCache._MISSING:
+            self._stats["local_hits"] += 1
+            return value
+
+        client = self._client()
+        if client is not None:
+            try:
+                raw = client.get(key)
+                if raw is not None:
+                    value = json.loads(raw)
+                    self.local.set(key, value)
+                    self._stats["redis_hits"] += 1
+                    return value
+            except Exception as e:
+                self._redis_failed(e)
+
+        self._stats["misses"] += 1
+        value = loader()
+        self._store(key, value, publish=False)
+        return value
+
+    def set(self, kind, external_id, value):
+        """Write-through after the database was updated."""
+        if not self.enabled:
+            return
+        self._stats["sets"] += 1
+        self._store(self._key(kind, external_id), value, publish=True)
+
+    def invalidate(self, kind, external_id):
+        if not self.enabled:
+            return
+        key = self._key(kind, external_id)
+        self.local.delete(key)
+        client = self._client()
+        if client is not None:
+            try:
+                client.delete(key)
+                self._publish(client, key)
+            except Exception as e:
+                self._redis_failed(e)
+
+    def stats(self):
+        stats = dict(self._stats)
+        lookups = stats["local_hits"] + stats["redis_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["local_hits"] + stats["redis_hits"]) / lookups, 4) if lookups else 0.0
+        stats["local_entries"] = len(self.local)
+        stats["redis_connected"] = self._redis is not None
+        return stats
+
+    # internals ------------------------------------------------------------
+
+    def _key(self, kind, external_id):
+        return f"{KEY_PREFIX}{kind}:{external_id}"
+
+    def _store(self, key, value, publish):
+        self.local.set(key, value)
+        client = self._client()
+        if client is None:
+            return
+        try:
+            client.set(key, json.dumps(value), ex=self.redis_ttl)
+            if publish:
+                self._publish(client, key)
+        except Exception as e:
+            self._redis_failed(e)
+
+    def _publish(self, client, key):
+        client.publish(INVALIDATION_CHANNEL, json.dumps({"origin": self._origin, "key": key}))
+
+    def _client(self):
+        if self._redis is not None:
+            return self._redis
+        if time.monotonic() < self._redis_retry_at:
+            return None
+        with self._init_lock:
+            if self._redis is None and time.monotonic() >= self._redis_retry_at:
+                try:
+                    import redis
+                    client = redis.Redis.from_url(
+                        self.redis_url, socket_timeout=0.5, socket_connect_timeout=0.5,
+                    )
+                    client.ping()
+                    self._redis = client
+                    self._start_subscriber(client)
+                except Exception as e:
+                    self._redis_failed(e)
+        return self._redis
+
+    def _start_subscriber(self, client):
+        if self._subscriber is not None:
+            self._subscriber.stop()
+        # own connection without the short read timeout: it blocks on listen()
+        pubsub = client.__class__.from_url(self.redis_url).pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: self._on_invalidation})
+        self._subscriber = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def _on_invalidation(self, message):
+        try:
+            payload = json.loads(message["data"])
+        except Exception:
+            return
+        if payload.get("origin") == self._origin:
+            return
+        self._stats["invalidations_received"] += 1
+        self.local.delete(payload.get("key"))
+
+    def _redis_failed(self, error):
+        self._stats["redis_errors"] += 1
+        logger.warning("Redis unavailable, using local cache only: %s", error)
+        self._redis = None
+        self._redis_retry_at = time.monotonic() + REDIS_RETRY_SECONDS
+
+
+_memory_cache = None
+
+
+def get_memory_cache():
+    """Process-wide MemoryCache, configured from settings on first use."""
+    global _memory_cache
+    if _memory_cache is None:
+        from django.conf import settings
+        _memory_cache = MemoryCache(
+            settings.REDIS_URL,
+            enabled=settings.MEMORY_CACHE["ENABLED"],
+            local_max_entries=settings.MEMORY_CACHE["LOCAL_MAX_ENTRIES"],
+            local_ttl=settings.MEMORY_CACHE["LOCAL_TTL"],
+            redis_ttl=settings.MEMORY_CACHE["REDIS_TTL"],
+        )
+    return _memory_cache
@@ -0,0 +1,120 @@
+# memory/db.py
+"""
+Dedicated, bounded thread pool for ORM work called from async code.
+
+asyncio.to_thread() runs on the loop's default executor, whose threads are
+shared with everything else and each keep their own Django connection
+forever (nothing calls close_old_connections() outside the request cycle).
+Here a fixed set of DB_EXECUTOR_THREADS threads does all the DB work, so a
+worker holds at most that many connections; each one is reused across jobs
+for CONN_MAX_AGE and health-checked (CONN_HEALTH_CHECKS) before the first
+query of a job, the same lifecycle Django gives a connection per request.
+"""
+import os
+import time
+import logging
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from chat.metrics import observe_stage
+
+
+logger = logging.getLogger(__name__)
+
+
+DB_EXECUTOR_THREADS = int(os.getenv("DB_EXECUTOR_THREADS", "8"))
+
+
+class DBExecutor:
+    def __init__(self, max_workers=DB_EXECUTOR_THREADS):
+        self.max_workers = max(1, max_workers)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._open = {}  # executor thread id -> has an open connection
+        self._stats = {
+            "jobs": 0,
+            "errors": 0,
+            "in_flight": 0,
+            "queued": 0,
+            "connections_opened": 0,
+            "max_wait_ms": 0.0,
+        }
+
+    async def run(self, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) on a DB thread and await its result."""
+        loop = asyncio.get_running_loop()
+        submitted = time.perf_counter()
+        with self._lock:
+            self._stats["queued"] += 1
+        return await loop.run_in_executor(self._get_executor(), self._call, submitted, fn, args, kwargs)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["connections_open"] = sum(1 for is_open in self._open.values() if is_open)
+        stats["threads"] = self.max_workers
+        return stats
+
+    def shutdown(self):
+        """Close the threads' connections and stop the pool (process exit)."""
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        for _ in range(self.max_workers):
+            executor.submit(self._close_connections)
+        executor.shutdown(wait=True)
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="db")
+        return self._executor
+
+    def _call(self, submitted, fn, args, kwargs):
+        from django.db import close_old_connections, connection
+
+        wait = time.perf_counter() - submitted
+        observe_stage("db_queue_wait", wait)
+        with self._lock:
+            self._stats["queued"] -= 1
+            self._stats["in_flight"] += 1
+            self._stats["max_wait_ms"] = max(self._stats["max_wait_ms"], round(wait * 1000, 1))
+        # drops a connection past CONN_MAX_AGE or left broken by the last job,
+        # and arms the health check for the first query of this one
+        close_old_connections()
+        was_open = connection.connection is not None
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        finally:
+            close_old_connections()
+            is_open = connection.connection is not None
+            with self._lock:
+                self._stats["jobs"] += 1
+                self._stats["in_flight"] -= 1
+                if is_open and not was_open:
+                    self._stats["connections_opened"] += 1
+                self._open[threading.get_ident()] = is_open
+
+    def _close_connections(self):
+        from django.db import connections
+        connections.close_all()
+        with self._lock:
+            self._open[threading.get_ident()] = False
+
+
+_db_executor = DBExecutor()
+
+
+def get_db_executor():
+    return _db_executor
+
+
+async def run_db(fn, *args, **kwargs):
+    """`await run_db(sync_fn, ...)`: the ORM counterpart of asyncio.to_thread()."""
+    return await _db_executor.run(fn, *args, **kwargs)
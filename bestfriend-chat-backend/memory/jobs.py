@@ -0,0 +1,235 @@
+# memory/jobs.py
+import logging
+import os
+import time
+import heapq
+import asyncio
+import itertools
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+# Lower number runs first
+PRIORITY_HIGH = 0     # latency-critical: persisting the messages of live turns
+PRIORITY_NORMAL = 5   # memory extraction triggered by the message threshold
+PRIORITY_LOW = 9      # idle / disconnect flushes
+
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "1000"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+# Per-type limits, e.g. "extraction=4,persist=2"; unlisted types share JOB_WORKERS
+JOB_CONCURRENCY = os.getenv("JOB_CONCURRENCY", "extraction=4,persist=2")
+JOB_DRAIN_TIMEOUT = float(os.getenv("JOB_DRAIN_TIMEOUT", "30"))
+
+
+class JobDropped(Exception):
+    """The job was rejected or evicted because the queue was full or draining."""
+
+
+def _parse_limits(spec):
+    limits = {}
+    for part in spec.split(","):
+        if "=" in part:
+            name, value = part.split("=", 1)
+            limits[name.strip()] = int(value)
+    return limits
+
+
+class _Job:
+    __slots__ = ("job_type", "key", "fn", "args", "priority", "seq", "future", "enqueued_at")
+
+    def __init__(self, job_type, key, fn, args, priority, seq, future):
+        self.job_type = job_type
+        self.key = key
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class JobSupervisor:
+    """
+    Bounded, supervised pool for background memory work.
+
+    - one bounded queue, served by JOB_WORKERS worker tasks in priority order
+    - per-job-type concurrency limits, so e.g. slow extraction calls can't
+      hold every worker while message persistence waits
+    - a job with the same (type, key) as one already queued is merged into
+      it instead of queued twice
+    - when the queue is full, a new job evicts the lowest-priority queued job
+      if it is more important, otherwise it is dropped (JobDropped)
+    - drain() stops intake and waits for queued and running jobs on shutdown
+    """
+
+    def __init__(self, max_queue=JOB_QUEUE_MAX, workers=JOB_WORKERS, limits=None):
+        self.max_queue = max_queue
+        self.workers = workers
+        self.limits = _parse_limits(JOB_CONCURRENCY) if limits is None else limits
+        self._heap = []
+        self._queued = {}     # (job_type, key) -> _Job
+        self._running = {}    # job_type -> count
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._worker_tasks = []
+        self._accepting = True
+        self._metrics = {
+            "submitted": 0,
+            "merged": 0,
+            "dropped": 0,
+            "evicted": 0,
+            "completed": 0,
+            "failed": 0,
+        }
+        self._wait_ms = deque(maxlen=1000)   # queue wait per job
+        self._run_ms = deque(maxlen=1000)    # run time per job
+
+    def submit(self, job_type, key, fn, *args, priority=PRIORITY_NORMAL):
+        """
+        Queue `await fn(*args)`. Returns a future with its result; the future
+        fails with JobDropped if the job is rejected or evicted.
+        """
+        self._ensure_workers()
+        loop = asyncio.get_running_loop()
+
+        existing = self._queued.get((job_type, key))
+        if existing is not None:
+            self._metrics["merged"] += 1
+            if priority < existing.priority:
+                # re-queue the merged job at the more urgent priority
+                existing.priority = priority
+                heapq.heapify(self._heap)
+            return existing.future
+
+        future = loop.create_future()
+        future.add_done_callback(_mark_retrieved)
+        if not self._accepting:
+            self._metrics["dropped"] += 1
+            future.set_exception(JobDropped("supervisor is draining"))
+            return future
+
+        if len(self._heap) >= self.max_queue:
+            worst = max(self._heap)
+            if priority >= worst.priority:
+                self._metrics["dropped"] += 1
+                future.set_exception(JobDropped(f"queue full ({self.max_queue})"))
+                return future
+            self._heap.remove(worst)
+            heapq.heapify(self._heap)
+            self._queued.pop((worst.job_type, worst.key), None)
+            self._metrics["evicted"] += 1
+            if not worst.future.done():
+                worst.future.set_exception(JobDropped("evicted by higher-priority job"))
+
+        job = _Job(job_type, key, fn, args, priority, next(self._seq), future)
+        heapq.heappush(self._heap, job)
+        self._queued[(job_type, key)] = job
+        self._metrics["submitted"] += 1
+        self._wakeup.set()
+        return future
+
+    async def drain(self, timeout=JOB_DRAIN_TIMEOUT):
+        """Stop accepting jobs and wait until queued and running jobs finish."""
+        self._accepting = False
+        deadline = time.monotonic() + timeout
+        while (self._heap or any(self._running.values())) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        for job in self._heap:
+            if not job.future.done():
+                job.future.set_exception(JobDropped("not finished before shutdown"))
+        self._heap.clear()
+        self._queued.clear()
+
+    def stats(self):
+        depth = {}
+        for job in self._heap:
+            depth[job.job_type] = depth.get(job.job_type, 0) + 1
+        stats = dict(self._metrics)
+        stats.update({
+            "queue_depth": len(self._heap),
+            "queue_depth_by_type": depth,
+            "running_by_type": {k: v for k, v in self._running.items() if v},
+            "wait_ms_p50": _percentile(self._wait_ms, 50),
+            "wait_ms_p95": _percentile(self._wait_ms, 95),
+            "run_ms_p50": _percentile(self._run_ms, 50),
+            "run_ms_p95": _percentile(self._run_ms, 95),
+        })
+        return stats
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        alive = [t for t in self._worker_tasks if not t.done() and t.get_loop() is loop]
+        if len(alive) == self.workers:
+            return
+        self._wakeup = asyncio.Event()
+        self._worker_tasks = alive + [
+            asyncio.ensure_future(self._worker()) for _ in range(self.workers - len(alive))
+        ]
+
+    def _next_runnable(self):
+        """Highest-priority queued job whose type still has a free slot."""
+        for job in sorted(self._heap):
+            limit = self.limits.get(job.job_type, self.workers)
+            if self._running.get(job.job_type, 0) < limit:
+                self._heap.remove(job)
+                heapq.heapify(self._heap)
+                self._queued.pop((job.job_type, job.key), None)
+                return job
+        return None
+
+    async def _worker(self):
+        while True:
+            job = self._next_runnable()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            self._running[job.job_type] = self._running.get(job.job_type, 0) + 1
+            started = time.perf_counter()
+            self._wait_ms.append((started - job.enqueued_at) * 1000)
+            try:
+                result = await job.fn(*job.args)
+                self._metrics["completed"] += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                if not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as e:
+                self._metrics["failed"] += 1
+                logger.error("job %s %s failed: %s", job.job_type, job.key, e)
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._run_ms.append((time.perf_counter() - started) * 1000)
+                self._running[job.job_type] -= 1
+                # a type slot was freed: other workers may now have runnable jobs
+                self._wakeup.set()
+
+
+def _mark_retrieved(future):
+    # callers may fire and forget; failures are already logged by the worker
+    if not future.cancelled():
+        future.exception()
+
+
+def _percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 1)
+
+
+job_supervisor = JobSupervisor()
@@ -0,0 +1,95 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from memory.models import ConversationMessage, UserMemory
+from memory.services import get_latest_messages_sync
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Time 'latest N messages' reads as one user's history grows: keyset "
+        "(get_latest_messages_sync) vs. the old COUNT + OFFSET query. "
+        "All rows are created inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="100,1000,10000,100000",
+                            help="comma-separated history lengths")
+        parser.add_argument("--limit", type=int, default=25)
+        parser.add_argument("--repeat", type=int, default=50)
+        parser.add_argument("--json", action="store_true", help="print a JSON report")
+
+    def handle(self, *args, **options):
+        sizes = [int(x) for x in options["sizes"].split(",") if x.strip()]
+        limit = options["limit"]
+        repeat = options["repeat"]
+
+        results = []
+        try:
+            with transaction.atomic():
+                um = UserMemory.objects.create(external_id="bench:recent-messages")
+                created = 0
+                for size in sorted(sizes):
+                    self._grow(um, size - created)
+                    created = size
+                    results.append(self._measure(um, size, limit, repeat))
+                raise _Rollback()
+        except _Rollback:
+            pass
+
+        if options["json"]:
+            self.stdout.write(json.dumps({
+                "vendor": connection.vendor, "limit": limit, "repeat": repeat, "results": results,
+            }, indent=2))
+            return
+
+        self.stdout.write(f"{connection.vendor}, limit={limit}, repeat={repeat} (ms per call)")
+        self.stdout.write(f"{'history':>10} {'keyset':>10} {'offset':>10} {'oldest page':>12}")
+        for r in results:
+            self.stdout.write(
+                f"{r['history']:>10} {r['keyset_ms']:>10.3f} {r['offset_ms']:>10.3f} {r['oldest_page_ms']:>12.3f}"
+            )
+
+    def _grow(self, um, count, batch=5000):
+        while count > 0:
+            n = min(batch, count)
+            ConversationMessage.objects.bulk_create([
+                ConversationMessage(user_memory=um, role="user" if i % 2 == 0 else "assistant",
+                                    content=f"benchmark message {i}")
+                for i in range(n)
+            ])
+            count -= n
+
+    def _measure(self, um, size, limit, repeat):
+        def timed(fn):
+            started = time.perf_counter()
+            for _ in range(repeat):
+                fn()
+            return (time.perf_counter() - started) * 1000 / repeat
+
+        def old_offset():
+            qs = ConversationMessage.objects.filter(user_memory=um).order_by("created_at")
+            total = qs.count()
+            return list(qs[max(total - limit, 0):])
+
+        # cursor pointing just above the oldest page: the deepest keyset read
+        oldest = (
+            ConversationMessage.objects.filter(user_memory=um)
+            .order_by("created_at", "id")[limit:limit + 1]
+            .first()
+        )
+        cursor = f"{oldest.created_at.isoformat()}|{oldest.pk}" if oldest else None
+
+        return {
+            "history": size,
+            "keyset_ms": round(timed(lambda: get_latest_messages_sync(um.pk, limit=limit)), 3),
+            "offset_ms": round(timed(old_offset), 3),
+            "oldest_page_ms": round(timed(lambda: get_latest_messages_sync(um.pk, limit=limit, before=cursor)), 3),
+        }
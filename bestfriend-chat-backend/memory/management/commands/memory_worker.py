@@ -0,0 +1,128 @@
+import logging
+import asyncio
+import os
+import signal
+import socket
+import uuid
+
+from django.core.management.base import BaseCommand
+
+from memory.queue import JOB_LEASE_SECONDS, get_job_queue
+from memory.recall import index_messages_async
+from memory.scheduler import extract_and_index
+
+
+logger = logging.getLogger(__name__)
+
+
+# job type -> coroutine(external_id, **payload)
+HANDLERS = {
+    "extraction": extract_and_index,
+    "recall_index": index_messages_async,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Run memory jobs (extraction, recall indexing) from the Redis job queue. Start the web "
+        "tier with MEMORY_JOB_BACKEND=redis so it enqueues instead of running them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=int(os.getenv("MEMORY_WORKER_CONCURRENCY", "8")),
+                            help="users processed in parallel by this worker")
+
+    def handle(self, *args, **options):
+        asyncio.run(self._main(options["concurrency"]))
+
+    async def _main(self, concurrency):
+        queue = get_job_queue()
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        stopping = asyncio.Event()
+
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stopping.set)
+            except NotImplementedError:
+                pass
+
+        self.stdout.write(f"[MEMORY WORKER] {worker_id} started, concurrency={concurrency}")
+        consumers = [asyncio.ensure_future(self._consume(queue, worker_id, stopping)) for _ in range(concurrency)]
+        housekeeping = asyncio.ensure_future(self._housekeeping(queue, stopping))
+
+        await stopping.wait()
+        self.stdout.write("[MEMORY WORKER] stopping, finishing in-flight jobs")
+        await asyncio.gather(*consumers, return_exceptions=True)
+        housekeeping.cancel()
+        await asyncio.gather(housekeeping, return_exceptions=True)
+        await queue.close()
+
+    async def _consume(self, queue, worker_id, stopping):
+        while not stopping.is_set():
+            try:
+                taken = await queue.take(worker_id, timeout=2)
+            except Exception as e:
+                logger.warning("queue error: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if taken is None:
+                continue
+
+            external_id, job = taken
+            if stopping.is_set():
+                await queue.give_back(external_id)
+                return
+
+            handler = HANDLERS.get(job.get("type"))
+            heartbeat = asyncio.ensure_future(self._heartbeat(queue, external_id, worker_id))
+            try:
+                if handler is None:
+                    raise ValueError(f"unknown job type {job.get('type')!r}")
+                await handler(external_id, **job.get("payload", {}))
+            except Exception as e:
+                error = e
+            else:
+                error = None
+            finally:
+                heartbeat.cancel()
+
+            # settling the job talks to Redis too; if that fails the lease
+            # expires and reap() hands the job out again
+            try:
+                if error is None:
+                    if not await queue.ack(external_id, job, worker_id):
+                        logger.warning("lease on %s lost before %s finished; it will run again",
+                                       external_id, job.get("type"))
+                else:
+                    retried = await queue.retry_or_dead(external_id, job, error, worker_id)
+                    logger.warning(
+                        "%s for %s failed (attempt %d): %s - %s", job.get("type"), external_id,
+                        job.get("attempts", 0) + 1, error, "retrying" if retried else "moved to dead-letter list",
+                    )
+            except Exception as e:
+                logger.warning("queue error settling %s for %s: %s", job.get("type"), external_id, e)
+                await asyncio.sleep(1)
+
+    async def _heartbeat(self, queue, external_id, worker_id):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                if not await queue.renew_lease(external_id, worker_id):
+                    logger.warning("lease on %s expired while its job was running", external_id)
+            except Exception as e:
+                # keep trying: the lease only expires after JOB_LEASE_SECONDS
+                logger.warning("could not renew lease on %s: %s", external_id, e)
+
+    async def _housekeeping(self, queue, stopping):
+        suspects = set()
+        ticks = 0
+        while not stopping.is_set():
+            try:
+                await queue.promote_delayed()
+                ticks += 1
+                if ticks % 10 == 0:
+                    suspects = await queue.reap(suspects)
+            except Exception as e:
+                logger.warning("housekeeping error: %s", e)
+            await asyncio.sleep(1)
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='conversationmessage',
+            options={},
+        ),
+        migrations.AddIndex(
+            model_name='conversationmessage',
+            index=models.Index(fields=['user_memory', '-created_at', '-id'], name='convmsg_user_recent_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0002_conversationmessage_recent_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationmessage',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0003_conversationmessage_token_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationsummary',
+            name='last_message_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
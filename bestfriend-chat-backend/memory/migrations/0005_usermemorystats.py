@@ -0,0 +1,27 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:49
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0004_conversationsummary_last_message_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserMemoryStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('analyzed_messages', models.PositiveIntegerField(default=0)),
+                ('topic_counts', models.JSONField(blank=True, default=dict)),
+                ('sentiment_counts', models.JSONField(blank=True, default=dict)),
+                ('sentiment_sum', models.FloatField(default=0.0)),
+                ('sentiment_rolling', models.FloatField(default=0.0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user_memory', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='memory.usermemory')),
+            ],
+        ),
+    ]
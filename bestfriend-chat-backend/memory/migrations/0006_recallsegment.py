@@ -0,0 +1,31 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0005_usermemorystats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecallSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('embedder', models.CharField(max_length=64)),
+                ('dim', models.PositiveSmallIntegerField()),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('vectors', models.BinaryField(default=bytes)),
+                ('entries', models.JSONField(default=list)),
+                ('last_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user_memory', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recall_segments', to='memory.usermemory')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_memory', 'embedder', 'id'], name='recallseg_user_idx')],
+            },
+        ),
+    ]
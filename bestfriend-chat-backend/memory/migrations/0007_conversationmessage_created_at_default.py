@@ -0,0 +1,19 @@
+# Generated by Django 5.2.9 on 2026-10-18 19:59
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('memory', '0006_recallsegment'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversationmessage',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
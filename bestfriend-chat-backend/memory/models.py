@@ -1,6 +1,7 @@
 
 from django.db import models
 from django.conf import settings  # <- use this instead of get_user_model
+from django.utils import timezone
 
 class UserMemory(models.Model):
     """
@@ -24,11 +25,18 @@ class ConversationMessage(models.Model):
     user_memory = models.ForeignKey(UserMemory, on_delete=models.CASCADE, related_name="messages")
     role = models.CharField(max_length=32)  # "user" or "assistant" or "system"
     content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # set by the chat turn (under its per-user lock), not at insert time:
+    # write-behind batches from different workers may land out of order
+    created_at = models.DateTimeField(default=timezone.now)
     metadata = models.JSONField(default=dict, blank=True)  # e.g. sentiment, topics
+    token_count = models.PositiveIntegerField(default=0)  # estimated once at write time
 
     class Meta:
-        ordering = ["created_at"]
+        # No default ordering: every query orders explicitly, newest-first
+        # reads walk this index instead of sorting.
+        indexes = [
+            models.Index(fields=["user_memory", "-created_at", "-id"], name="convmsg_user_recent_idx"),
+        ]
 
 
 class ConversationSummary(models.Model):
@@ -38,6 +46,55 @@ class ConversationSummary(models.Model):
     user_memory = models.OneToOneField(UserMemory, on_delete=models.CASCADE, related_name="summary")
     summary_text = models.TextField(blank=True, default="")
     last_updated = models.DateTimeField(auto_now=True)
+    # id of the newest ConversationMessage already covered by an extraction
+    last_message_id = models.BigIntegerField(default=0)
 
     def __str__(self):
         return f"Summary for {self.user_memory_id}"
+
+
+class UserMemoryStats(models.Model):
+    """
+    Per-user aggregates of message analysis, updated incrementally by each
+    memory extraction so readers never have to scan messages.
+    """
+    user_memory = models.OneToOneField(UserMemory, on_delete=models.CASCADE, related_name="stats")
+    analyzed_messages = models.PositiveIntegerField(default=0)
+    topic_counts = models.JSONField(default=dict, blank=True)      # topic -> count
+    sentiment_counts = models.JSONField(default=dict, blank=True)  # positive/neutral/negative -> count
+    sentiment_sum = models.FloatField(default=0.0)                 # for the lifetime mean
+    sentiment_rolling = models.FloatField(default=0.0)             # exponential moving average
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Stats for {self.user_memory_id}"
+
+    @property
+    def sentiment_mean(self):
+        return self.sentiment_sum / self.analyzed_messages if self.analyzed_messages else 0.0
+
+
+class RecallSegment(models.Model):
+    """
+    Block of message embeddings for semantic recall: float32 vectors stored
+    as one blob, with the snippets they were computed from. New vectors go
+    to a small tail segment (RECALL_TAIL_SIZE rows); full tails are merged
+    into segments of about RECALL_SEGMENT_SIZE rows. A user's index is read
+    segment by segment and searched with NumPy, never row by row.
+    """
+    user_memory = models.ForeignKey(UserMemory, on_delete=models.CASCADE, related_name="recall_segments")
+    embedder = models.CharField(max_length=64)  # vectors of different embedders are never mixed
+    dim = models.PositiveSmallIntegerField()
+    size = models.PositiveIntegerField(default=0)
+    vectors = models.BinaryField(default=bytes)        # size x dim float32, row-major
+    entries = models.JSONField(default=list)           # [[message_id, role, snippet], ...] per row
+    last_message_id = models.BigIntegerField(default=0)  # newest message this index has seen
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_memory", "embedder", "id"], name="recallseg_user_idx"),
+        ]
+
+    def __str__(self):
+        return f"RecallSegment({self.user_memory_id}, {self.embedder}, {self.size})"
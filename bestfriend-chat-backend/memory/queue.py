@@ -0,0 +1,287 @@
+# memory/queue.py
+import logging
+import os
+import json
+import time
+import uuid
+import random
+
+
+logger = logging.getLogger(__name__)
+
+
+# "inline": memory jobs run in the web process (JobSupervisor)
+# "redis":  the web process only enqueues; `manage.py memory_worker` runs them
+MEMORY_JOB_BACKEND = os.getenv("MEMORY_JOB_BACKEND", "inline")
+
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "2"))
+JOB_RETRY_MAX_SECONDS = float(os.getenv("JOB_RETRY_MAX_SECONDS", "300"))
+
+PREFIX = "memory:jobs:"
+
+
+# Append a job to the user's list and mark the user ready (once).
+# A job identical to the last one still waiting behind the head is skipped.
+_ENQUEUE = """
+local len = redis.call('LLEN', KEYS[1])
+if len >= 2 then
+  local tail = cjson.decode(redis.call('LINDEX', KEYS[1], -1))
+  if tail['dedupe'] == ARGV[3] then return 0 end
+end
+redis.call('RPUSH', KEYS[1], ARGV[1])
+if redis.call('SADD', KEYS[2], ARGV[2]) == 1 then
+  redis.call('LPUSH', KEYS[3], ARGV[2])
+end
+return 1
+"""
+
+# Head job of the user is done (ack, or moved to the dead-letter list):
+# release the user and make it ready again if more jobs are waiting.
+# Only the worker holding the lease may do this, and only the job it ran
+# (ARGV[3]) is removed; a worker whose lease expired changes nothing.
+_RELEASE = """
+if redis.call('GET', KEYS[5]) ~= ARGV[4] then return 0 end
+local head = redis.call('LINDEX', KEYS[1], 0)
+if head and cjson.decode(head)['id'] == ARGV[3] then
+  redis.call('LPOP', KEYS[1])
+  if ARGV[2] ~= '' then
+    redis.call('RPUSH', KEYS[6], ARGV[2])
+  end
+end
+redis.call('LREM', KEYS[4], 1, ARGV[1])
+redis.call('DEL', KEYS[5])
+if redis.call('LLEN', KEYS[1]) > 0 then
+  redis.call('LPUSH', KEYS[3], ARGV[1])
+else
+  redis.call('SREM', KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+# Head job failed but may be retried: store the new attempt count and park
+# the user in the delayed set until the backoff has passed. Same lease and
+# job id checks as _RELEASE.
+_RETRY = """
+if redis.call('GET', KEYS[3]) ~= ARGV[5] then return 0 end
+local head = redis.call('LINDEX', KEYS[1], 0)
+if head and cjson.decode(head)['id'] == ARGV[4] then
+  redis.call('LSET', KEYS[1], 0, ARGV[2])
+end
+redis.call('LREM', KEYS[2], 1, ARGV[1])
+redis.call('DEL', KEYS[3])
+redis.call('ZADD', KEYS[4], ARGV[3], ARGV[1])
+return 1
+"""
+
+# Extend the lease, but only if this worker still holds it.
+_RENEW = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then return 0 end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+class RedisJobQueue:
+    """
+    Reliable per-user job queue on Redis.
+
+    Layout (all keys under PREFIX):
+      user:<external_id>  list of that user's jobs, oldest first; the head is
+                          the job being worked on and is only removed once it
+                          succeeds (at-least-once delivery)
+      active              set of users that currently have jobs
+      ready               list of users whose head job can be taken
+      processing          users taken by a worker; each holds lease:<user>
+      delayed             zset of users waiting for a retry backoff
+      dead                dead-letter list of jobs that used up their attempts
+
+    A user is in `ready` / `processing` / `delayed` at most once, so one
+    user's jobs run strictly in order, one at a time, on any worker, while
+    different users run in parallel. A worker that dies loses its lease and
+    the reaper puts its user back into `ready`.
+    """
+
+    def __init__(self, redis_url, prefix=PREFIX):
+        self.redis_url = redis_url
+        self.prefix = prefix
+        self._redis = None
+        self._scripts = {}
+
+    def _client(self):
+        if self._redis is None:
+            import redis.asyncio as aioredis
+            self._redis = aioredis.Redis.from_url(self.redis_url, decode_responses=True)
+            self._scripts = {
+                "enqueue": self._redis.register_script(_ENQUEUE),
+                "release": self._redis.register_script(_RELEASE),
+                "retry": self._redis.register_script(_RETRY),
+                "renew": self._redis.register_script(_RENEW),
+            }
+        return self._redis
+
+    def _key(self, name):
+        return self.prefix + name
+
+    def _user_key(self, external_id):
+        return self.prefix + "user:" + external_id
+
+    def _lease_key(self, external_id):
+        return self.prefix + "lease:" + external_id
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+        self._redis = None
+
+    # producer --------------------------------------------------------------
+
+    async def enqueue(self, job_type, external_id, **payload):
+        """Queue a job for `external_id`. Returns False if it merged into a queued one."""
+        self._client()
+        job = {
+            "id": uuid.uuid4().hex,
+            "type": job_type,
+            "external_id": external_id,
+            "payload": payload,
+            "attempts": 0,
+            "enqueued_at": time.time(),
+            "dedupe": f"{job_type}:{json.dumps(payload, sort_keys=True)}",
+        }
+        added = await self._scripts["enqueue"](
+            keys=[self._user_key(external_id), self._key("active"), self._key("ready")],
+            args=[json.dumps(job), external_id, job["dedupe"]],
+        )
+        return bool(added)
+
+    # consumer --------------------------------------------------------------
+
+    async def take(self, worker_id, timeout=5):
+        """
+        Block until a user is ready; returns (external_id, job) or None.
+        The caller must finish with ack(), retry_or_dead() or give_back().
+        """
+        client = self._client()
+        external_id = await client.blmove(
+            self._key("ready"), self._key("processing"), timeout, "RIGHT", "LEFT"
+        )
+        if external_id is None:
+            return None
+        await client.set(self._lease_key(external_id), worker_id, ex=JOB_LEASE_SECONDS)
+        raw = await client.lindex(self._user_key(external_id), 0)
+        if raw is None:
+            # nothing left for this user (already handled elsewhere)
+            await self._scripts["release"](
+                keys=self._release_keys(external_id), args=[external_id, "", "", worker_id]
+            )
+            return None
+        return external_id, json.loads(raw)
+
+    async def renew_lease(self, external_id, worker_id):
+        """Returns False if the lease expired and may belong to another worker now."""
+        self._client()
+        renewed = await self._scripts["renew"](
+            keys=[self._lease_key(external_id)], args=[worker_id, JOB_LEASE_SECONDS]
+        )
+        return bool(renewed)
+
+    async def ack(self, external_id, job, worker_id):
+        """Remove the finished head job. Returns False if the lease was lost meanwhile."""
+        released = await self._scripts["release"](
+            keys=self._release_keys(external_id), args=[external_id, "", job["id"], worker_id]
+        )
+        return bool(released)
+
+    async def retry_or_dead(self, external_id, job, error, worker_id):
+        """
+        Schedule a retry with jittered exponential backoff, or dead-letter the
+        job. Returns True if it will be retried.
+        """
+        job_id = job["id"]
+        job = dict(job)
+        job["attempts"] = job.get("attempts", 0) + 1
+        job["last_error"] = str(error)[:500]
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            job["failed_at"] = time.time()
+            await self._scripts["release"](
+                keys=self._release_keys(external_id), args=[external_id, json.dumps(job), job_id, worker_id]
+            )
+            return False
+
+        backoff = min(JOB_RETRY_MAX_SECONDS, JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1))
+        due = time.time() + random.uniform(backoff / 2, backoff)
+        await self._scripts["retry"](
+            keys=[self._user_key(external_id), self._key("processing"),
+                  self._lease_key(external_id), self._key("delayed")],
+            args=[external_id, json.dumps(job), due, job_id, worker_id],
+        )
+        return True
+
+    async def give_back(self, external_id):
+        """Return a taken user to `ready` without running its job (shutdown)."""
+        client = self._client()
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.lrem(self._key("processing"), 1, external_id)
+            pipe.delete(self._lease_key(external_id))
+            pipe.rpush(self._key("ready"), external_id)
+            await pipe.execute()
+
+    # housekeeping ----------------------------------------------------------
+
+    async def promote_delayed(self):
+        """Move users whose retry backoff has passed back to `ready`."""
+        client = self._client()
+        due = await client.zrangebyscore(self._key("delayed"), "-inf", time.time())
+        for external_id in due:
+            if await client.zrem(self._key("delayed"), external_id):
+                await client.lpush(self._key("ready"), external_id)
+        return len(due)
+
+    async def reap(self, suspects):
+        """
+        Requeue users in `processing` whose lease expired. `suspects` are the
+        lease-less users seen by the previous call; a user is only requeued if
+        it is lease-less twice in a row, which skips the short window between
+        BLMOVE and the lease being set. Returns the new suspects.
+        """
+        client = self._client()
+        now_suspect = set()
+        for external_id in await client.lrange(self._key("processing"), 0, -1):
+            if await client.exists(self._lease_key(external_id)):
+                continue
+            if external_id in suspects:
+                if await client.lrem(self._key("processing"), 1, external_id):
+                    await client.lpush(self._key("ready"), external_id)
+                    logger.warning("requeued stale job for %s", external_id)
+            else:
+                now_suspect.add(external_id)
+        return now_suspect
+
+    async def stats(self):
+        client = self._client()
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.llen(self._key("ready"))
+            pipe.llen(self._key("processing"))
+            pipe.zcard(self._key("delayed"))
+            pipe.llen(self._key("dead"))
+            pipe.scard(self._key("active"))
+            ready, processing, delayed, dead, active = await pipe.execute()
+        return {"ready": ready, "processing": processing, "delayed": delayed, "dead": dead, "active_users": active}
+
+    def _release_keys(self, external_id):
+        return [
+            self._user_key(external_id), self._key("active"), self._key("ready"),
+            self._key("processing"), self._lease_key(external_id), self._key("dead"),
+        ]
+
+
+_job_queue = None
+
+
+def get_job_queue():
+    global _job_queue
+    if _job_queue is None:
+        from django.conf import settings
+        _job_queue = RedisJobQueue(settings.REDIS_URL)
+    return _job_queue
@@ -0,0 +1,474 @@
+# memory/recall.py
+import logging
+import os
+import re
+import time
+import asyncio
+import hashlib
+import importlib
+
+from .cache import LRUCache, get_memory_cache
+from chat.llm_cache import get_llm_cache, request_key
+from .db import run_db
+from .services import get_or_create_user_memory_sync, message_buffer
+from chat.admission import get_admission
+from chat.providers import get_provider
+
+
+logger = logging.getLogger(__name__)
+
+
+# Configuration
+# Off by default: it costs an embedding call per indexed batch and per turn
+RECALL_ENABLED = os.getenv("RECALL_ENABLED", "0") == "1"
+# "provider" (the LLM_PROVIDERS "embedding" backend; "openai" is an alias),
+# "hashing" or a dotted path to an Embedder subclass
+RECALL_EMBEDDER = os.getenv("RECALL_EMBEDDER", "provider")
+RECALL_EMBEDDING_MODEL = os.getenv("RECALL_EMBEDDING_MODEL", "text-embedding-3-small")
+RECALL_DIM = int(os.getenv("RECALL_DIM", "256"))
+RECALL_TOP_K = int(os.getenv("RECALL_TOP_K", "4"))
+# Cosine similarity below which a snippet is not worth the prompt tokens
+RECALL_MIN_SCORE = float(os.getenv("RECALL_MIN_SCORE", "0.3"))
+# Upper bound for a lookup running in the background of a turn
+RECALL_QUERY_TIMEOUT = float(os.getenv("RECALL_QUERY_TIMEOUT", "0.3"))  # seconds
+# How long after the message arrived the prompt waits for that lookup before
+# going without it. The lookup overlaps the turn wait and prompt packing, so
+# only what is left of this budget is added to the reply latency
+RECALL_QUERY_WAIT = float(os.getenv("RECALL_QUERY_WAIT", str(RECALL_QUERY_TIMEOUT)))  # seconds
+# New vectors go to a small tail segment; full tails are merged into
+# RECALL_SEGMENT_SIZE segments, so an append never rewrites a large blob
+RECALL_TAIL_SIZE = int(os.getenv("RECALL_TAIL_SIZE", "64"))
+RECALL_SEGMENT_SIZE = int(os.getenv("RECALL_SEGMENT_SIZE", "1024"))
+# Only the newest segments covering this many rows are loaded and searched:
+# older history of very long conversations is not recalled (logged per load)
+RECALL_MAX_ROWS = int(os.getenv("RECALL_MAX_ROWS", "20000"))
+RECALL_INDEX_BATCH = int(os.getenv("RECALL_INDEX_BATCH", "256"))
+RECALL_EMBED_BATCH = int(os.getenv("RECALL_EMBED_BATCH", "128"))
+RECALL_MIN_CHARS = int(os.getenv("RECALL_MIN_CHARS", "12"))      # "ok", "thanks" are not indexed
+RECALL_SNIPPET_CHARS = int(os.getenv("RECALL_SNIPPET_CHARS", "300"))
+RECALL_EMBED_CHARS = 2000
+# Loaded (and concatenated) per-user matrices kept in this process
+RECALL_CACHE_ENTRIES = int(os.getenv("RECALL_CACHE_ENTRIES", "256"))
+RECALL_CACHE_TTL = float(os.getenv("RECALL_CACHE_TTL", "600"))
+
+
+# -------------------------
+# Embedders
+# -------------------------
+
+class Embedder:
+    """
+    Turns texts into an (n, dim) float32 matrix of L2-normalized rows, so a
+    dot product is the cosine similarity. `name` identifies the vector space:
+    stored vectors are only compared with queries from the same embedder.
+    """
+
+    name = "base"
+    dim = 0
+    upstream = False  # calls an API (admission control applies)
+
+    async def embed(self, texts):
+        raise NotImplementedError
+
+
+def _normalize_rows(matrix):
+    import numpy as np
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32, copy=False)
+
+
+class HashingEmbedder(Embedder):
+    """
+    Deterministic local embedder (feature hashing of words and word pairs).
+    No network and no model, so tests and offline setups get stable vectors;
+    it matches shared words, not meaning.
+    """
+
+    _WORDS = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self, dim=RECALL_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed_sync(self, texts):
+        import numpy as np
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            words = self._WORDS.findall((text or "").lower())
+            features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            for feature in features:
+                h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                matrix[row, h % self.dim] += 1.0 if (h >> 63) & 1 else -1.0
+        return _normalize_rows(matrix)
+
+    async def embed(self, texts):
+        return self.embed_sync(texts)
+
+
+class ProviderEmbedder(Embedder):
+    """
+    Embeddings from the "embedding" LLM provider, shortened to `dim`
+    dimensions. Vectors go through the LLM result cache per text, so
+    repeated queries ("hi", "thanks") skip the API call.
+    """
+
+    upstream = True  # query embeddings go through admission control
+
+    def __init__(self, model=RECALL_EMBEDDING_MODEL, dim=RECALL_DIM):
+        self.provider = get_provider("embedding")
+        self.model = model
+        self.dim = dim
+        # stored vectors of another backend live in another space
+        self.name = f"{self.provider.cache_namespace(model)}-{dim}"[:64]
+
+    async def embed(self, texts):
+        import numpy as np
+        texts = list(texts)
+        llm_cache = get_llm_cache()
+        namespace = self.provider.cache_namespace(self.model)
+        keys = [request_key("embedding", namespace, input=t, dimensions=self.dim) for t in texts]
+        found = await llm_cache.get_many("embedding", keys)
+
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        if missing:
+            vectors = await self.provider.embed(self.model, [texts[i] for i in missing], dimensions=self.dim)
+            fresh = {keys[i]: vector for i, vector in zip(missing, vectors)}
+            found.update(fresh)
+            await llm_cache.set_many("embedding", fresh)
+
+        return _normalize_rows(np.asarray([found[key] for key in keys], dtype=np.float32))
+
+
+_embedder = None
+
+
+def get_embedder():
+    """Process-wide embedder selected by RECALL_EMBEDDER."""
+    global _embedder
+    if _embedder is None:
+        if RECALL_EMBEDDER == "hashing":
+            _embedder = HashingEmbedder()
+        elif RECALL_EMBEDDER in ("provider", "openai"):
+            _embedder = ProviderEmbedder()
+        else:
+            module_name, _, attr = RECALL_EMBEDDER.rpartition(".")
+            _embedder = getattr(importlib.import_module(module_name), attr)()
+    return _embedder
+
+
+# -------------------------
+# Similarity search
+# -------------------------
+
+def top_k(matrix, queries, k):
+    """
+    Batched cosine top-k: `matrix` is (n, dim), `queries` (q, dim), both
+    normalized. Returns (indices, scores), each (q, min(k, n)), best first.
+    argpartition keeps this O(n) per query instead of a full sort.
+    """
+    import numpy as np
+    queries = np.atleast_2d(queries)
+    n = matrix.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty((queries.shape[0], 0), dtype=np.int64), np.empty((queries.shape[0], 0), dtype=np.float32)
+
+    scores = queries @ matrix.T  # (q, n)
+    if k < n:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.tile(np.arange(n), (queries.shape[0], 1))
+    part = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-part, axis=1)
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(part, order, axis=1)
+
+
+class RecallIndex:
+    """One user's loaded index: the newest segments concatenated into one matrix."""
+
+    def __init__(self, matrix, entries, version, segments=None):
+        self.matrix = matrix      # (n, dim) float32
+        self.entries = entries    # n x [message_id, role, snippet]
+        self.version = version    # index version (newest message id) it was loaded at
+        self.segments = segments or {}  # segment id -> (size, block, entries), reused on reload
+
+    def search(self, query_vectors, k=RECALL_TOP_K, min_score=RECALL_MIN_SCORE):
+        idx, scores = top_k(self.matrix, query_vectors, k)
+        results = []
+        for row_idx, row_scores in zip(idx, scores):
+            hits = []
+            for i, score in zip(row_idx, row_scores):
+                if score < min_score:
+                    break
+                message_id, role, snippet = self.entries[i]
+                hits.append({"message_id": message_id, "role": role, "content": snippet, "score": float(score)})
+            results.append(hits)
+        return results
+
+
+_EMPTY_VERSION = 0
+_index_cache = LRUCache(max_entries=RECALL_CACHE_ENTRIES, ttl=RECALL_CACHE_TTL)
+
+
+def _cache_key(external_id, embedder):
+    return f"{embedder.name}:{external_id}"
+
+
+def _index_version_sync(external_id, embedder):
+    """
+    Newest message id covered by the user's index. Goes through the memory
+    cache (kind "recall"), which the indexer updates on every write, so a
+    worker notices a stale matrix without reading the segments.
+    """
+    from .models import RecallSegment
+
+    def load():
+        last = (
+            RecallSegment.objects.filter(user_memory__external_id=external_id, embedder=embedder.name)
+            .order_by("-id").values_list("last_message_id", flat=True).first()
+        )
+        return last or _EMPTY_VERSION
+
+    return get_memory_cache().get("recall", _cache_key(external_id, embedder), load)
+
+
+def load_index_sync(external_id, embedder):
+    """
+    The user's RecallIndex: cached in-process, reloaded when the version
+    moved. A reload reads the segment list first and fetches only the blobs
+    of segments that are new or grew since (usually just the tail).
+    """
+    import numpy as np
+    from .models import RecallSegment
+
+    key = _cache_key(external_id, embedder)
+    version = _index_version_sync(external_id, embedder)
+    index = _index_cache.get(key)
+    if index is not None and index.version == version:
+        return index
+
+    segments = RecallSegment.objects.filter(user_memory__external_id=external_id, embedder=embedder.name)
+    wanted, rows, skipped = [], 0, 0
+    for segment_id, size in segments.order_by("-id").values_list("id", "size"):
+        if skipped or (rows + size > RECALL_MAX_ROWS and wanted):
+            skipped += size
+            continue
+        wanted.append((segment_id, size))
+        rows += size
+    wanted.reverse()
+    if skipped:
+        logger.info("recall for %s searches the newest %d rows only, %d older rows skipped (RECALL_MAX_ROWS)",
+                    external_id, rows, skipped)
+
+    cached = index.segments if index is not None else {}
+    loaded = {sid: cached[sid] for sid, size in wanted if sid in cached and cached[sid][0] == size}
+    missing = [sid for sid, size in wanted if sid not in loaded]
+    if missing:
+        for sid, size, vectors, segment_entries in segments.filter(id__in=missing).values_list(
+                "id", "size", "vectors", "entries"):
+            block = np.frombuffer(bytes(vectors), dtype=np.float32).reshape(size, embedder.dim)
+            loaded[sid] = (size, block, segment_entries)
+
+    blocks, entries = [], []
+    for sid, _ in wanted:
+        size, block, segment_entries = loaded[sid]
+        if size:
+            blocks.append(block)
+            entries.extend(segment_entries)
+
+    matrix = np.concatenate(blocks) if blocks else np.empty((0, embedder.dim), dtype=np.float32)
+    index = RecallIndex(matrix, entries, version, loaded)
+    _index_cache.set(key, index)
+    return index
+
+
+# -------------------------
+# Indexing
+# -------------------------
+
+def _load_unindexed_sync(external_id, embedder, limit=RECALL_INDEX_BATCH):
+    """
+    (UserMemory, messages worth indexing, newest message id scanned) for the
+    oldest `limit` messages the index has not seen yet.
+    """
+    from .models import ConversationMessage, RecallSegment
+
+    um = get_or_create_user_memory_sync(external_id)
+    cursor = (
+        RecallSegment.objects.filter(user_memory=um, embedder=embedder.name)
+        .order_by("-id").values_list("last_message_id", flat=True).first()
+    ) or 0
+    scanned = list(
+        ConversationMessage.objects.filter(user_memory=um, id__gt=cursor)
+        .order_by("id").values_list("id", "role", "content")[:limit]
+    )
+    newest_id = scanned[-1][0] if scanned else cursor
+    messages = [m for m in scanned if m[1] in ("user", "assistant") and len(m[2].strip()) >= RECALL_MIN_CHARS]
+    return um, messages, newest_id, len(scanned)
+
+
+def _append_vectors_sync(um, embedder, vectors, entries, last_message_id):
+    """
+    Fill the user's tail segment up to RECALL_TAIL_SIZE rows, then open new
+    tails, and merge full tails into one segment once they add up to
+    RECALL_SEGMENT_SIZE rows. Returns the index version (newest message id
+    covered).
+    """
+    import numpy as np
+    from django.db import transaction
+    from .models import RecallSegment
+
+    with transaction.atomic():
+        segment = (
+            RecallSegment.objects.select_for_update()
+            .filter(user_memory=um, embedder=embedder.name).order_by("-id").first()
+        )
+        if segment is not None and segment.last_message_id >= last_message_id:
+            return segment.last_message_id  # a concurrent run already indexed these
+
+        offset = 0
+        while True:
+            if segment is None or (segment.size >= RECALL_TAIL_SIZE and entries):
+                segment = RecallSegment(user_memory=um, embedder=embedder.name, dim=embedder.dim,
+                                        vectors=b"", entries=[])
+            room = RECALL_TAIL_SIZE - segment.size
+            chunk = vectors[offset:offset + room]
+            segment.vectors = bytes(segment.vectors) + np.ascontiguousarray(chunk, dtype=np.float32).tobytes()
+            segment.entries = list(segment.entries) + entries[offset:offset + room]
+            segment.size += len(chunk)
+            segment.last_message_id = last_message_id
+            segment.save()
+            offset += len(chunk)
+            if offset >= len(entries):
+                break
+
+        _merge_tails_sync(um, embedder, tail_id=segment.id)
+
+    get_memory_cache().set("recall", _cache_key(um.external_id, embedder), last_message_id)
+    return last_message_id
+
+
+def _merge_tails_sync(um, embedder, tail_id):
+    """
+    Merge the full tail segments (everything below RECALL_SEGMENT_SIZE rows
+    except the open tail) into the oldest of them once they fill a segment.
+    They always sit after the merged segments, so row order is kept.
+    """
+    from .models import RecallSegment
+
+    tails = list(
+        RecallSegment.objects.filter(user_memory=um, embedder=embedder.name,
+                                     size__lt=RECALL_SEGMENT_SIZE, id__lt=tail_id)
+        .order_by("id").values_list("id", "size")
+    )
+    if sum(size for _, size in tails) < RECALL_SEGMENT_SIZE:
+        return
+
+    merged = list(RecallSegment.objects.filter(id__in=[sid for sid, _ in tails]).order_by("id"))
+    target = merged[0]
+    target.vectors = b"".join(bytes(s.vectors) for s in merged)
+    target.entries = [entry for s in merged for entry in s.entries]
+    target.size = sum(s.size for s in merged)
+    target.last_message_id = merged[-1].last_message_id
+    target.save()
+    RecallSegment.objects.filter(id__in=[s.id for s in merged[1:]]).delete()
+
+
+async def index_messages_async(external_id):
+    """
+    Embed every message of this user the index has not seen yet, in batches,
+    and append the vectors to their segments. Runs as a background memory job
+    (next to extraction), well before MAX_RAW_MESSAGES_KEEP prunes the rows,
+    so recall still reaches messages that are gone from ConversationMessage.
+
+    Returns the number of messages embedded.
+    """
+    import numpy as np
+    embedder = get_embedder()
+    await message_buffer.flush()
+
+    indexed = 0
+    while True:
+        um, messages, newest_id, scanned = await run_db(_load_unindexed_sync, external_id, embedder)
+        if not scanned:
+            return indexed
+
+        entries = [[mid, role, content.strip()[:RECALL_SNIPPET_CHARS]] for mid, role, content in messages]
+        texts = [content[:RECALL_EMBED_CHARS] for _, _, content in messages]
+        blocks = []
+        for start in range(0, len(texts), RECALL_EMBED_BATCH):
+            blocks.append(await embedder.embed(texts[start:start + RECALL_EMBED_BATCH]))
+        vectors = np.concatenate(blocks) if blocks else np.empty((0, embedder.dim), dtype=np.float32)
+
+        await run_db(_append_vectors_sync, um, embedder, vectors, entries, newest_id)
+        indexed += len(entries)
+        if scanned < RECALL_INDEX_BATCH:
+            return indexed
+
+
+# -------------------------
+# Query
+# -------------------------
+
+async def recall_snippets(external_id, query, k=RECALL_TOP_K, exclude=()):
+    """
+    Top-k past snippets relevant to `query`, best first, skipping texts in
+    `exclude` (what the prompt already contains). Returns [] when recall is
+    off, the index is empty, or embedding the query exceeds RECALL_QUERY_TIMEOUT.
+    """
+    if not RECALL_ENABLED or not query:
+        return []
+    embedder = get_embedder()
+    try:
+        index = await run_db(load_index_sync, external_id, embedder)
+        if not index.entries:
+            return []
+        query_vector = await asyncio.wait_for(_embed_query(external_id, embedder, query), RECALL_QUERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.info("query embedding timed out, answering without recall")
+        return []
+    except Exception as e:
+        logger.warning("lookup failed: %s", e)
+        return []
+
+    skip = {text.strip()[:RECALL_SNIPPET_CHARS] for text in exclude}
+    hits = index.search(query_vector, k=k + len(skip))[0]
+    return [h for h in hits if h["content"] not in skip][:k]
+
+
+async def _embed_query(external_id, embedder, query):
+    if not getattr(embedder, "upstream", False):
+        return await embedder.embed([query])
+    # an API call like any other: it waits for an upstream slot
+    async with get_admission().slot(external_id, timeout=RECALL_QUERY_TIMEOUT):
+        return await embedder.embed([query])
+
+
+def start_recall(external_id, query, k=RECALL_TOP_K, exclude=()):
+    """
+    Run recall_snippets() in the background of a turn, next to the context
+    load and the turn wait. Returns the task, or None when recall is off.
+    """
+    if not RECALL_ENABLED or not query:
+        return None
+    return asyncio.ensure_future(recall_snippets(external_id, query, k=k, exclude=exclude))
+
+
+async def collect_recall(task, started, wait=RECALL_QUERY_WAIT):
+    """
+    The snippets of a start_recall() task if it finishes within `wait`
+    seconds of `started` (a time.perf_counter() value, when the message
+    arrived), else [] (the task is cancelled: the reply goes without recall).
+    """
+    if task is None:
+        return []
+    if not task.done():
+        await asyncio.wait([task], timeout=max(0.0, started + wait - time.perf_counter()))
+    if not task.done():
+        task.cancel()
+        logger.info("recall not ready, answering without it")
+        return []
+    if task.cancelled():
+        return []
+    return task.result()
@@ -0,0 +1,137 @@
+# memory/scheduler.py
+import logging
+import os
+import asyncio
+
+from .services import SUMMARIZE_AFTER_MESSAGES, extract_memory_async, message_buffer
+from .jobs import job_supervisor, JobDropped, PRIORITY_NORMAL, PRIORITY_LOW
+from .queue import MEMORY_JOB_BACKEND, get_job_queue
+from .recall import RECALL_ENABLED, index_messages_async
+
+
+logger = logging.getLogger(__name__)
+
+
+# Summarize pending messages after this many seconds without new ones
+SUMMARY_IDLE_SECONDS = float(os.getenv("SUMMARY_IDLE_SECONDS", "120"))
+
+
+class SummaryScheduler:
+    """
+    Decides when a user's conversation gets re-summarized (and its new
+    messages analyzed: both happen in one extraction job).
+
+    - a summary only runs once `threshold` new messages have arrived
+      since the last one (instead of after every message)
+    - at most one summary job is in flight per external_id; requests that
+      arrive meanwhile collapse into a single follow-up run
+    - pending messages are flushed when the user goes idle or disconnects,
+      so short conversations still end up in long-term memory
+
+    Jobs run on the bounded JobSupervisor; if it drops one (queue full) the
+    messages stay pending and are retried on the next trigger.
+    """
+
+    def __init__(self, job, threshold=SUMMARIZE_AFTER_MESSAGES, idle_seconds=SUMMARY_IDLE_SECONDS,
+                 supervisor=job_supervisor):
+        self.job = job
+        self.threshold = max(1, threshold)
+        self.idle_seconds = idle_seconds
+        self.supervisor = supervisor
+        self._pending = {}      # external_id -> new messages since last summary
+        self._running = {}      # external_id -> asyncio.Future from the supervisor
+        self._rerun = set()     # external_ids that got more work while running
+        self._idle_timers = {}  # external_id -> asyncio.TimerHandle
+
+    def note_messages(self, external_id, count=1):
+        """Record `count` newly stored messages for this user."""
+        self._pending[external_id] = self._pending.get(external_id, 0) + count
+        self._reset_idle_timer(external_id)
+        if self._pending[external_id] >= self.threshold:
+            self._start(external_id, PRIORITY_NORMAL)
+
+    def flush(self, external_id):
+        """Summarize now if anything is pending. Returns the job's future, if any."""
+        self._cancel_idle_timer(external_id)
+        if self._pending.get(external_id):
+            return self._start(external_id, PRIORITY_LOW)
+        return self._running.get(external_id)
+
+    def flush_all(self):
+        """Submit a job for every user with pending messages (shutdown)."""
+        for external_id in list(self._pending):
+            self.flush(external_id)
+
+    def stats(self):
+        return {
+            "pending_users": sum(1 for n in self._pending.values() if n),
+            "pending_messages": sum(self._pending.values()),
+            "running": len(self._running),
+        }
+
+    def _start(self, external_id, priority):
+        if external_id in self._running:
+            # the running job may not see the newest messages; run once more after it
+            self._rerun.add(external_id)
+            return self._running[external_id]
+
+        # the job reads the latest messages itself, so everything pending is covered
+        pending = self._pending.pop(external_id, 0)
+        self._cancel_idle_timer(external_id)
+        future = self.supervisor.submit("extraction", external_id, self.job, external_id, priority=priority)
+        self._running[external_id] = future
+        future.add_done_callback(lambda f: self._finished(external_id, pending, f))
+        return future
+
+    def _finished(self, external_id, pending, future):
+        self._running.pop(external_id, None)
+        rerun = external_id in self._rerun
+        self._rerun.discard(external_id)
+        if not future.cancelled() and isinstance(future.exception(), JobDropped):
+            # not run: keep the messages pending for the next trigger
+            self._pending[external_id] = self._pending.get(external_id, 0) + pending
+            self._reset_idle_timer(external_id)
+            return
+        if rerun and self._pending.get(external_id):
+            self._start(external_id, PRIORITY_NORMAL)
+
+    def _reset_idle_timer(self, external_id):
+        self._cancel_idle_timer(external_id)
+        loop = asyncio.get_running_loop()
+        self._idle_timers[external_id] = loop.call_later(
+            self.idle_seconds, self.flush, external_id
+        )
+
+    def _cancel_idle_timer(self, external_id):
+        handle = self._idle_timers.pop(external_id, None)
+        if handle is not None:
+            handle.cancel()
+
+
+async def extract_and_index(external_id):
+    """
+    Recall indexing of the new messages (first: it is cheap and must happen
+    before pruning removes them), then extraction.
+    """
+    if RECALL_ENABLED:
+        try:
+            await index_messages_async(external_id)
+        except Exception as e:
+            # the next run picks up where the index stopped
+            logger.warning("recall indexing failed for %s: %s", external_id, e)
+    await extract_memory_async(external_id)
+
+
+async def run_extraction(external_id):
+    """
+    Extraction job for the scheduler: run it here, or with
+    MEMORY_JOB_BACKEND=redis hand it to `manage.py memory_worker`.
+    """
+    if MEMORY_JOB_BACKEND == "redis":
+        await message_buffer.flush()  # the worker reads the messages from the DB
+        await get_job_queue().enqueue("extraction", external_id)
+    else:
+        await extract_and_index(external_id)
+
+
+summary_scheduler = SummaryScheduler(run_extraction)
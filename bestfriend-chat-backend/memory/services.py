@@ -1,139 +1,695 @@
 # memory/services.py
+import logging
 import os
+import time
+import atexit
 import asyncio
+import hashlib
 from django.utils import timezone
-from openai import OpenAI
-from chat.utils_openai import extract_text_from_response
+from channels.layers import get_channel_layer
+from .cache import LRUCache, get_memory_cache
+from chat.utils_openai import record_usage
+from chat.providers import get_provider
+from chat.llm_cache import get_llm_cache, request_key
+from chat.admission import PRIORITY_BACKGROUND, get_admission
+from chat.prompting import estimate_tokens
+from chat.metrics import timed_stage
+from .db import run_db
+
+
+logger = logging.getLogger(__name__)
 
 
 # Configuration
 SUMMARIZE_AFTER_MESSAGES = int(os.getenv("SUMMARIZE_AFTER_MESSAGES", "25"))
 MAX_RAW_MESSAGES_KEEP = int(os.getenv("MAX_RAW_MESSAGES_KEEP", "200"))
 MEMORY_MODEL = os.getenv("MEMORY_MODEL", "gpt-5-nano")
-ANALYSIS_MODEL = os.getenv("ANALYSIS_MODEL", "gpt-5-nano")
-
-
-def get_client():
-    """Create OpenAI client (blocking)."""
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        raise RuntimeError("OPENAI_API_KEY not set")
-    return OpenAI(api_key=api_key)
+# Most pending user messages analyzed in one extraction call
+EXTRACTION_MAX_PENDING = int(os.getenv("EXTRACTION_MAX_PENDING", "20"))
+# Weight of the newest message in UserMemoryStats.sentiment_rolling
+SENTIMENT_EMA_ALPHA = float(os.getenv("SENTIMENT_EMA_ALPHA", "0.2"))
+# Most distinct topics kept per user (least frequent are dropped)
+TOPIC_COUNTS_MAX = int(os.getenv("TOPIC_COUNTS_MAX", "200"))
+
+# Write-behind persistence of chat messages
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.5"))  # seconds
+PERSIST_MAX_BATCH = int(os.getenv("PERSIST_MAX_BATCH", "500"))
+PRUNE_EVERY_INSERTS = int(os.getenv("PRUNE_EVERY_INSERTS", "50"))
+# A message the database keeps rejecting is dropped after this many flushes
+PERSIST_MAX_ATTEMPTS = int(os.getenv("PERSIST_MAX_ATTEMPTS", "5"))
+# Most queued messages while the database is unreachable (oldest are dropped)
+PERSIST_MAX_PENDING = int(os.getenv("PERSIST_MAX_PENDING", "50000"))
+
+# external_id -> UserMemory pk, so writes and reads skip the get_or_create
+_user_memory_ids = LRUCache(max_entries=int(os.getenv("USER_MEMORY_ID_CACHE_SIZE", "100000")), ttl=3600)
 
 
 # -------------------------
 # Synchronous DB helpers
-# -------------------------'
-
-
-    """
-    Safely extract assistant text from a Responses API response.
-
-    Looks for the first output item of type 'message', then returns
-    its first content.text. Falls back to string(resp) if needed.
-    """
-    try:
-        # New Responses API: resp.output is a list of items
-        # We want the one with type == "message"
-        for item in getattr(resp, "output", []) or []:
-            if getattr(item, "type", None) == "message":
-                content_list = getattr(item, "content", []) or []
-                if content_list and hasattr(content_list[0], "text"):
-                    return content_list[0].text
-
-        # Fallback: try the last output item
-        if getattr(resp, "output", None):
-            last = resp.output[-1]
-            content_list = getattr(last, "content", []) or []
-            if content_list and hasattr(content_list[0], "text"):
-                return content_list[0].text
-    except Exception:
-        pass
-
-    # Last resort: stringified response
-    return str(resp)
+# -------------------------
 
 def get_or_create_user_memory_sync(external_id):
     from .models import UserMemory
     um, _ = UserMemory.objects.get_or_create(external_id=external_id)
+    _user_memory_ids.set(external_id, um.pk)
     return um
 
 
+def get_user_memory_id_sync(external_id):
+    """UserMemory pk of `external_id` (created on first use), cached per process."""
+    pk = _user_memory_ids.get(external_id)
+    if pk is None:
+        pk = get_or_create_user_memory_sync(external_id).pk
+    return pk
+
+
 def append_message_to_memory_sync(external_id, role, content, metadata=None):
     """
     Create a ConversationMessage and prune old ones.
     """
     from .models import ConversationMessage
-    um = get_or_create_user_memory_sync(external_id)
+    user_memory_id = get_user_memory_id_sync(external_id)
 
     msg = ConversationMessage.objects.create(
-        user_memory=um,
+        user_memory_id=user_memory_id,
         role=role,
         content=content,
         metadata=metadata or {},
+        token_count=estimate_tokens(content),
     )
 
-    # prune older messages, keep newest MAX_RAW_MESSAGES_KEEP
-    qs = ConversationMessage.objects.filter(user_memory=um).order_by('-created_at')
-    if qs.count() > MAX_RAW_MESSAGES_KEEP:
-        to_delete = qs[MAX_RAW_MESSAGES_KEEP:]
-        ConversationMessage.objects.filter(id__in=[m.id for m in to_delete]).delete()
-
+    prune_messages_sync(user_memory_id)
     return msg
 
 
+def prune_messages_sync(user_memory_id, keep=MAX_RAW_MESSAGES_KEEP):
+    """
+    Keep only the newest `keep` messages of one user, in a single DELETE.
+    """
+    from django.db.models import Subquery
+    from .models import ConversationMessage
+
+    newest = (
+        ConversationMessage.objects.filter(user_memory_id=user_memory_id)
+        .order_by('-created_at', '-id')
+        .values('id')[:keep]
+    )
+    deleted, _ = (
+        ConversationMessage.objects.filter(user_memory_id=user_memory_id)
+        .exclude(id__in=Subquery(newest))
+        .delete()
+    )
+    return deleted
+
+
+class MessageWriteBuffer:
+    """
+    Write-behind buffer for chat messages.
+
+    Messages are queued in memory and written with one bulk_create per flush
+    (every PERSIST_FLUSH_INTERVAL seconds, or sooner once PERSIST_MAX_BATCH
+    are waiting), across all users on this worker. UserMemory ids are
+    resolved once per external_id and pruning runs at most every
+    PRUNE_EVERY_INSERTS inserts per user instead of on every message.
+
+    While the database is unreachable the whole batch is kept for the next
+    flush (up to PERSIST_MAX_PENDING messages). Rows the database rejects
+    (e.g. a deleted user) are found by writing each user's rows on their
+    own; they are retried PERSIST_MAX_ATTEMPTS times, then dropped, so they
+    never hold up other users' messages.
+
+    Anything that reads messages back from the DB (summaries) must
+    `await flush()` first.
+    """
+
+    def __init__(self, flush_interval=PERSIST_FLUSH_INTERVAL, max_batch=PERSIST_MAX_BATCH,
+                 prune_every=PRUNE_EVERY_INSERTS, max_attempts=PERSIST_MAX_ATTEMPTS,
+                 max_pending=PERSIST_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.prune_every = max(1, prune_every)
+        self.max_attempts = max(1, max_attempts)
+        self.max_pending = max_pending
+        # (external_id, role, content, metadata, token_count, enqueued_at, created_at,
+        #  user_memory_id, failed_attempts)
+        self._pending = []
+        self._inserts_since_prune = {}  # UserMemory pk -> count
+        self._flush_handle = None
+        self._lock = asyncio.Lock()
+        self._stats = {
+            "flushes": 0,
+            "messages_written": 0,
+            "prunes": 0,
+            "prune_errors": 0,
+            "errors": 0,
+            "dropped": 0,
+            "last_flush_lag_ms": 0.0,
+            "max_flush_lag_ms": 0.0,
+        }
+
+    def add(self, external_id, role, content, metadata=None, token_count=None, created_at=None,
+            user_memory_id=None):
+        """
+        Queue a message; it is persisted by the next flush. `created_at`
+        (default: now) is what orders it among the user's messages. Callers
+        that know the UserMemory pk (see load_turn_context) pass it along.
+        """
+        if token_count is None:
+            token_count = estimate_tokens(content)
+        self._pending.append((
+            external_id, role, content, metadata or {}, token_count,
+            time.perf_counter(), created_at or timezone.now(), user_memory_id, 0,
+        ))
+        if len(self._pending) >= self.max_batch:
+            self._schedule_flush(0)
+        else:
+            self._schedule_flush(self.flush_interval)
+
+    async def flush(self):
+        """Write everything queued so far."""
+        async with self._lock:
+            self._cancel_scheduled_flush()
+            batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+            try:
+                with timed_stage("persist_flush"):
+                    written, rejected = await run_db(self._write_sync, batch)
+            except Exception as e:
+                # database unreachable: keep the messages, the next flush retries them
+                self._stats["errors"] += 1
+                self._requeue(batch, count_attempt=False)
+                logger.error("saving messages failed: %s", e)
+                return 0
+            if rejected:
+                self._stats["errors"] += 1
+                self._requeue(rejected, count_attempt=True)
+            return written
+
+    def flush_sync(self):
+        """Flush without an event loop (interpreter shutdown)."""
+        batch, self._pending = self._pending, []
+        if batch:
+            self._write_sync(batch)
+
+    def _requeue(self, items, count_attempt):
+        kept = []
+        for item in items:
+            attempts = item[8] + 1 if count_attempt else item[8]
+            if attempts >= self.max_attempts:
+                self._stats["dropped"] += 1
+                logger.error("dropping a message of %s rejected %d times", item[0], attempts)
+                continue
+            # a rejected row may carry a stale UserMemory pk: resolve it again
+            kept.append(item[:7] + (None if count_attempt else item[7], attempts))
+        self._pending = kept + self._pending
+        overflow = len(self._pending) - self.max_pending
+        if overflow > 0:
+            self._pending = self._pending[overflow:]
+            self._stats["dropped"] += overflow
+            logger.error("message buffer full, dropped the %d oldest messages", overflow)
+        if self._pending:
+            self._schedule_flush(self.flush_interval)
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["pending"] = len(self._pending)
+        stats["oldest_pending_ms"] = (
+            round((time.perf_counter() - self._pending[0][5]) * 1000, 1) if self._pending else 0.0
+        )
+        return stats
+
+    def _schedule_flush(self, delay):
+        if self._flush_handle is not None:
+            if delay > 0:
+                return
+            self._cancel_scheduled_flush()
+        loop = asyncio.get_running_loop()
+        self._flush_handle = loop.call_later(delay, self._submit_flush)
+
+    def _submit_flush(self):
+        from .jobs import job_supervisor, PRIORITY_HIGH
+        self._flush_handle = None
+        # latency-critical; merged with any flush that is already queued
+        job_supervisor.submit("persist", "message_buffer", self.flush, priority=PRIORITY_HIGH)
+
+    def _cancel_scheduled_flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def _write_sync(self, batch):
+        """
+        Insert the batch; returns (messages written, rejected items). Raises
+        only when the database itself fails (nothing was written then).
+        """
+        from django.db import DatabaseError, DataError, IntegrityError
+
+        pks = {}
+        try:
+            self._insert_sync(batch, pks)
+            written, rejected = batch, []
+        except (IntegrityError, DataError) as e:
+            # some row is bad: write each user's rows on their own to find it
+            logger.warning("batch insert rejected (%s), retrying per user", e)
+            groups = {}
+            for item in batch:
+                groups.setdefault(item[0], []).append(item)
+            written, rejected = [], []
+            for external_id, items in groups.items():
+                try:
+                    self._insert_sync(items, pks)
+                    written.extend(items)
+                except (IntegrityError, DataError) as e:
+                    logger.error("saving messages of %s failed: %s", external_id, e)
+                    _user_memory_ids.delete(external_id)
+                    rejected.extend(items)
+
+        if written:
+            now = time.perf_counter()
+            lag_ms = round((now - min(item[5] for item in written)) * 1000, 1)
+            self._stats["flushes"] += 1
+            self._stats["messages_written"] += len(written)
+            self._stats["last_flush_lag_ms"] = lag_ms
+            self._stats["max_flush_lag_ms"] = max(self._stats["max_flush_lag_ms"], lag_ms)
+
+        # the messages are committed: a failing prune must not get them written twice
+        for item in written:
+            pk = pks[item[0]]
+            self._inserts_since_prune[pk] = self._inserts_since_prune.get(pk, 0) + 1
+        for pk, count in list(self._inserts_since_prune.items()):
+            if count >= self.prune_every:
+                try:
+                    prune_messages_sync(pk)
+                except DatabaseError as e:
+                    self._stats["prune_errors"] += 1
+                    logger.warning("pruning messages of user memory %s failed: %s", pk, e)
+                    continue
+                self._inserts_since_prune[pk] = 0
+                self._stats["prunes"] += 1
+
+        return len(written), rejected
+
+    def _insert_sync(self, items, pks):
+        from django.db import transaction
+        from .models import ConversationMessage
+
+        for item in items:
+            if item[0] not in pks:
+                pks[item[0]] = item[7] or get_user_memory_id_sync(item[0])
+
+        with transaction.atomic():
+            ConversationMessage.objects.bulk_create([
+                ConversationMessage(
+                    user_memory_id=pks[external_id],
+                    role=role,
+                    content=content,
+                    metadata=metadata,
+                    token_count=token_count,
+                    created_at=created_at,
+                )
+                for external_id, role, content, metadata, token_count, _, created_at, *_ in items
+            ])
+
+
+message_buffer = MessageWriteBuffer()
+atexit.register(message_buffer.flush_sync)
+
+
+def _encode_cursor(message):
+    return f"{message.created_at.isoformat()}|{message.pk}"
+
+
+def _decode_cursor(cursor):
+    from datetime import datetime
+    created_at, pk = cursor.rsplit("|", 1)
+    return datetime.fromisoformat(created_at), int(pk)
+
+
+def get_latest_messages_sync(user_memory_id, limit=50, before=None):
+    """
+    Keyset-paginated history for one user.
+
+    Returns (messages, next_cursor): up to `limit` messages ordered oldest to
+    newest, and a cursor for the page of older messages (None when there is
+    nothing older). Pass that cursor back as `before` to page further back.
+
+    Rows are read newest-first straight off convmsg_user_recent_idx and
+    reversed here, so the cost depends on `limit`, not on history length.
+    """
+    from django.db.models import Q
+    from .models import ConversationMessage
+
+    qs = ConversationMessage.objects.filter(user_memory_id=user_memory_id)
+    if before:
+        created_at, pk = _decode_cursor(before)
+        # the created_at__lte bound lets the index seek; the OR only breaks ties
+        qs = qs.filter(created_at__lte=created_at).filter(Q(created_at__lt=created_at) | Q(id__lt=pk))
+
+    rows = list(
+        qs.order_by('-created_at', '-id')
+        .only('id', 'role', 'content', 'created_at', 'token_count')[:limit + 1]
+    )
+    next_cursor = _encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    rows = rows[:limit]
+    rows.reverse()
+
+    messages = [
+        {
+            "id": m.pk,
+            "role": m.role,
+            "content": m.content,
+            "tokens": m.token_count,
+            "created_at": m.created_at.isoformat(),
+        }
+        for m in rows
+    ]
+    return messages, next_cursor
+
+
 def get_recent_messages_as_list_sync(external_id, limit=50):
     """
     Return list of dicts:
       [{"role": "...", "content": "..."}, ...]
     ordered from oldest to newest, limited to last `limit`.
     """
-    from .models import ConversationMessage
-    um = get_or_create_user_memory_sync(external_id)
-    qs = ConversationMessage.objects.filter(user_memory=um).order_by('created_at')
-    total = qs.count()
-    if total > limit:
-        qs = qs[total - limit:]
-    return [{"role": m.role, "content": m.content} for m in qs]
+    messages, _ = get_latest_messages_sync(get_user_memory_id_sync(external_id), limit=limit)
+    return [{"role": m["role"], "content": m["content"]} for m in messages]
 
 
-def _summarize_memory_sync(external_id):
+def _load_user_memory_sync(external_id):
     """
-    Read recent messages, summarize with OpenAI,
-    store in ConversationSummary + UserMemory.facts.
+    (UserMemory with its summary joined in, created): one query for known
+    users, created if missing.
+    """
+    from .models import UserMemory
+    um = (
+        UserMemory.objects.select_related("summary")
+        .only("id", "external_id", "facts", "summary__id", "summary__summary_text")
+        .filter(external_id=external_id)
+        .first()
+    )
+    created = um is None
+    if created:
+        from django.db import IntegrityError, transaction
+        try:
+            with transaction.atomic():
+                um = UserMemory.objects.create(external_id=external_id)
+        except IntegrityError:  # another connection created it meanwhile
+            um, created = UserMemory.objects.get(external_id=external_id), False
+    _user_memory_ids.set(external_id, um.pk)
+    return um, created
+
+
+def _summary_text_of(um):
+    from django.core.exceptions import ObjectDoesNotExist
+    try:
+        return um.summary.summary_text
+    except ObjectDoesNotExist:
+        return ""
+
+
+def load_turn_context_sync(external_id, limit=10):
+    """
+    Everything a connection needs to build prompts, in at most two queries:
+
+      {"user_memory_id": pk, "summary_text": str, "facts": dict,
+       "messages": [{"role": ..., "content": ..., "tokens": ...}, ...]}
+
+    with messages ordered oldest to newest, limited to the last `limit`.
+    UserMemory and its summary come from one joined query, skipped entirely
+    when the pk, summary and facts are all cached; the last one reads the
+    messages off convmsg_user_recent_idx (not needed for a new user).
+    """
+    cache = get_memory_cache()
+    loaded = []  # (UserMemory, created), once needed
+
+    def user_memory():
+        if not loaded:
+            loaded.append(_load_user_memory_sync(external_id))
+        return loaded[0][0]
+
+    def load_summary():
+        um = user_memory()
+        return "" if loaded[0][1] else _summary_text_of(um)
+
+    with timed_stage("summary_load"):
+        summary_text = cache.get("summary", external_id, load_summary)
+        facts = cache.get("facts", external_id, lambda: user_memory().facts)
+        user_memory_id = _user_memory_ids.get(external_id) or user_memory().pk
+
+    with timed_stage("history_load"):
+        created = bool(loaded) and loaded[0][1]
+        latest = [] if created else get_latest_messages_sync(user_memory_id, limit=limit)[0]
+    return {
+        "user_memory_id": user_memory_id,
+        "summary_text": summary_text,
+        "facts": facts,
+        "messages": [{"role": m["role"], "content": m["content"], "tokens": m["tokens"]} for m in latest],
+    }
+
+
+def load_conversation_window_sync(external_id, limit=10):
+    """
+    (summary_text, [{"role": ..., "content": ..., "tokens": ...}, ...]),
+    see load_turn_context_sync().
+    """
+    context = load_turn_context_sync(external_id, limit)
+    return context["summary_text"], context["messages"]
+
+
+def get_user_facts_sync(external_id):
+    """UserMemory.facts for this user, served from the memory cache when possible."""
+    return get_memory_cache().get(
+        "facts", external_id, lambda: _load_user_memory_sync(external_id)[0].facts
+    )
+
+
+def memory_group_name(external_id):
+    """
+    Channel layer group for everything connected as `external_id`.
+    external_ids contain ':' and '!' which group names don't allow.
+    """
+    return "memory." + hashlib.sha1(external_id.encode("utf-8")).hexdigest()
+
+
+async def notify_summary_updated(external_id, summary_text):
+    """Push a new summary to every open connection of this user, on any worker."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        await channel_layer.group_send(memory_group_name(external_id), {
+            "type": "memory.summary",
+            "summary": summary_text,
+        })
+    except Exception as e:
+        logger.warning("summary notification failed: %s", e)
+
+
+_SENTIMENT = {"type": "string", "enum": ["positive", "neutral", "negative"]}
+
+# Strict JSON schema for the combined memory extraction call
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "profile_summary": {"type": "string"},
+        "important_facts": {"type": "array", "items": {"type": "string"}},
+        "current_concerns": {"type": "array", "items": {"type": "string"}},
+        "sentiment": _SENTIMENT,
+        "sentiment_score": {"type": "number"},
+        "topics": {"type": "array", "items": {"type": "string"}},
+        "messages": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "integer"},
+                    "sentiment": _SENTIMENT,
+                    "sentiment_score": {"type": "number"},
+                    "topics": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["id", "sentiment", "sentiment_score", "topics"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": [
+        "profile_summary", "important_facts", "current_concerns",
+        "sentiment", "sentiment_score", "topics", "messages",
+    ],
+    "additionalProperties": False,
+}
+
+SUMMARY_KEYS = ("profile_summary", "important_facts", "current_concerns")
+
+
+def _load_extraction_input_sync(external_id):
+    """
+    Everything one extraction call needs:
+      (UserMemory, previous summary, last SUMMARIZE_AFTER_MESSAGES messages,
+       user messages not yet extracted (newest EXTRACTION_MAX_PENDING),
+       newest message id)
     """
     from .models import ConversationMessage, ConversationSummary
 
     um = get_or_create_user_memory_sync(external_id)
+    cs = ConversationSummary.objects.filter(user_memory=um).first()
+    cursor = cs.last_message_id if cs else 0
 
-    messages = ConversationMessage.objects.filter(user_memory=um).order_by('-created_at')[:SUMMARIZE_AFTER_MESSAGES]
+    messages = ConversationMessage.objects.filter(user_memory=um).order_by('-created_at', '-id')[:SUMMARIZE_AFTER_MESSAGES]
     messages = list(reversed(messages))
-    raw_text = "\n".join(f"{m.role}: {m.content}" for m in messages)
 
-    prompt = (
-        "Summarize the user's recent conversation into short bullet points suitable for long-term memory.\n\n"
-        f"Conversation:\n{raw_text}\n\n"
-        "Return a short JSON object with keys: 'profile_summary', 'important_facts', 'current_concerns'. "
-        "Keep each field short."
+    pending = ConversationMessage.objects.filter(
+        user_memory=um, role="user", id__gt=cursor,
+    ).order_by('-id')[:EXTRACTION_MAX_PENDING]
+    pending = list(reversed(pending))
+
+    newest_id = max([m.id for m in messages] + [cursor])
+    return um, (cs.summary_text if cs else ""), messages, pending, newest_id
+
+
+def _build_extraction_prompt(previous_summary, messages, pending):
+    conversation = "\n".join(f"{m.role}: {m.content}" for m in messages)
+    # numbered by position, not by row id, so the same conversation always
+    # produces the same prompt (and hits the LLM result cache)
+    pending_lines = "\n".join(f"[{n}] {m.content}" for n, m in enumerate(pending, 1)) or "(none)"
+    return (
+        "You maintain long-term memory for a personal assistant.\n\n"
+        f"Previous memory (may be empty):\n{previous_summary}\n\n"
+        f"Recent conversation:\n{conversation}\n\n"
+        f"New user messages to analyze, as [id] text:\n{pending_lines}\n\n"
+        "Return one JSON object:\n"
+        "  - profile_summary: short summary of who the user is, updated with the recent conversation\n"
+        "  - important_facts: short durable facts (name, preferences, background)\n"
+        "  - current_concerns: what the user is currently dealing with\n"
+        "  - sentiment / sentiment_score (-1..1) / topics: for the new user messages overall\n"
+        "  - messages: one entry per new user message with its id, sentiment, sentiment_score and topics\n"
+        "Keep every field short."
     )
 
-    client = get_client()
-    resp = client.responses.create(
-        model=MEMORY_MODEL,
-        # input_text=prompt,
-        input=prompt,
-    )
 
-    # extract summary text
+def _parse_extraction(out):
+    """Return the extraction dict, or None if the model didn't return valid JSON."""
+    import json
     try:
-        # summary_text = resp.output[0].content[0].text
-        summary_text = extract_text_from_response(resp)
+        parsed = json.loads(out)
     except Exception:
-        summary_text = str(resp)
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def _normalize_analysis(item):
+    sentiment = item.get("sentiment")
+    if sentiment not in ("positive", "neutral", "negative"):
+        sentiment = "neutral"
+    try:
+        score = max(-1.0, min(1.0, float(item.get("sentiment_score", 0.0))))
+    except (TypeError, ValueError):
+        score = 0.0
+    topics = []
+    for topic in item.get("topics") or []:
+        topic = str(topic).strip().lower()[:64]
+        if topic and topic not in topics:
+            topics.append(topic)
+    return {"sentiment": sentiment, "sentiment_score": score, "topics": topics}
+
+
+def _store_analyses_sync(um, pending, extraction):
+    """
+    Write each pending message's analysis into its metadata and fold the
+    batch into UserMemoryStats. Returns the number of messages analyzed.
+    """
+    from .models import ConversationMessage, UserMemoryStats
+
+    by_id = {}
+    for item in extraction.get("messages") or []:
+        if isinstance(item, dict) and "id" in item:
+            by_id[item["id"]] = _normalize_analysis(item)
+
+    analyzed = []
+    for n, m in enumerate(pending, 1):
+        analysis = by_id.get(n)
+        if analysis is None:
+            continue
+        m.metadata = {**(m.metadata or {}), "analysis": analysis}
+        analyzed.append((m, analysis))
+    if not analyzed:
+        return 0
+
+    ConversationMessage.objects.bulk_update([m for m, _ in analyzed], ["metadata"])
+
+    stats, _ = UserMemoryStats.objects.select_for_update().get_or_create(user_memory=um)
+    first = stats.analyzed_messages == 0
+    for _, analysis in analyzed:  # oldest first, so the moving average ends on the newest
+        score = analysis["sentiment_score"]
+        stats.analyzed_messages += 1
+        stats.sentiment_sum += score
+        if first:
+            stats.sentiment_rolling = score
+            first = False
+        else:
+            stats.sentiment_rolling += SENTIMENT_EMA_ALPHA * (score - stats.sentiment_rolling)
+        stats.sentiment_counts[analysis["sentiment"]] = stats.sentiment_counts.get(analysis["sentiment"], 0) + 1
+        for topic in analysis["topics"]:
+            stats.topic_counts[topic] = stats.topic_counts.get(topic, 0) + 1
+
+    if len(stats.topic_counts) > TOPIC_COUNTS_MAX:
+        top = sorted(stats.topic_counts.items(), key=lambda kv: kv[1], reverse=True)[:TOPIC_COUNTS_MAX]
+        stats.topic_counts = dict(top)
+    stats.save()
+    return len(analyzed)
+
+
+def _store_extraction_sync(um, summary_text, last_message_id, pending, extraction):
+    """Summary, per-message analyses and stats in one transaction."""
+    from django.db import transaction
+
+    with transaction.atomic():
+        cs = _store_summary_sync(um, summary_text, last_message_id)
+        if extraction is not None:
+            _store_analyses_sync(um, pending, extraction)
+    return cs
+
+
+def get_user_stats_sync(external_id):
+    """
+    Precomputed analysis aggregates for dashboards / personalization:
+      {"analyzed_messages", "top_topics", "sentiment_counts",
+       "sentiment_mean", "sentiment_rolling"}
+    """
+    from .models import UserMemoryStats
+
+    stats = UserMemoryStats.objects.filter(user_memory__external_id=external_id).first()
+    if stats is None:
+        return {
+            "analyzed_messages": 0,
+            "top_topics": [],
+            "sentiment_counts": {},
+            "sentiment_mean": 0.0,
+            "sentiment_rolling": 0.0,
+        }
+    top_topics = sorted(stats.topic_counts.items(), key=lambda kv: kv[1], reverse=True)[:10]
+    return {
+        "analyzed_messages": stats.analyzed_messages,
+        "top_topics": top_topics,
+        "sentiment_counts": stats.sentiment_counts,
+        "sentiment_mean": round(stats.sentiment_mean, 4),
+        "sentiment_rolling": round(stats.sentiment_rolling, 4),
+    }
+
+
+def _store_summary_sync(um, summary_text, last_message_id=None):
+    """
+    Store the summary in ConversationSummary + merge into UserMemory.facts.
+    """
+    from .models import ConversationSummary
 
     cs, _ = ConversationSummary.objects.get_or_create(user_memory=um)
     cs.summary_text = summary_text
     cs.last_updated = timezone.now()
+    if last_message_id is not None:
+        cs.last_message_id = max(cs.last_message_id, last_message_id)
     cs.save()
 
     # merge into facts
@@ -148,40 +704,12 @@ def _summarize_memory_sync(external_id):
         um.facts.update({"summary": summary_text})
     um.save()
 
-    return cs
-
+    # write-through; other workers drop their local copies via pub/sub
+    cache = get_memory_cache()
+    cache.set("summary", um.external_id, cs.summary_text)
+    cache.set("facts", um.external_id, um.facts)
 
-def _analyze_message_sync(external_id, text):
-    """
-    Analyze sentiment/topics of a message. Returns a dict.
-    """
-    prompt = (
-        "Perform a short analysis of the following user message. Return a JSON object with fields:\n"
-        "  - sentiment: one of {positive, neutral, negative}\n"
-        "  - sentiment_score: a number between -1 and 1\n"
-        "  - topics: array of short topic labels\n\n"
-        f"Message: '''{text}'''"
-    )
-
-    client = get_client()
-    resp = client.responses.create(
-        model=ANALYSIS_MODEL,
-        # input_text=prompt,
-        input=prompt,
-    )
-
-    try:
-        # out = resp.output[0].content[0].text
-        out = extract_text_from_response(resp)
-    except Exception:
-        out = str(resp)
-
-    try:
-        import json
-        parsed = json.loads(out)
-        return parsed
-    except Exception:
-        return {"sentiment": "neutral", "sentiment_score": 0.0, "topics": []}
+    return cs
 
 
 # -------------------------
@@ -189,16 +717,90 @@ def _analyze_message_sync(external_id, text):
 # -------------------------
 
 async def append_message_to_memory(external_id, role, content, metadata=None):
-    return await asyncio.to_thread(append_message_to_memory_sync, external_id, role, content, metadata)
+    return await run_db(append_message_to_memory_sync, external_id, role, content, metadata)
 
 
 async def get_recent_messages_as_list(external_id, limit=50):
-    return await asyncio.to_thread(get_recent_messages_as_list_sync, external_id, limit)
+    return await run_db(get_recent_messages_as_list_sync, external_id, limit)
+
+
+async def get_latest_messages(user_memory_id, limit=50, before=None):
+    return await run_db(get_latest_messages_sync, user_memory_id, limit, before)
+
+
+async def load_turn_context(external_id, limit=10):
+    return await run_db(load_turn_context_sync, external_id, limit)
+
+
+async def load_conversation_window(external_id, limit=10):
+    return await run_db(load_conversation_window_sync, external_id, limit)
 
 
-async def summarize_memory_async(external_id):
-    return await asyncio.to_thread(_summarize_memory_sync, external_id)
+async def get_user_facts(external_id):
+    return await run_db(get_user_facts_sync, external_id)
 
 
-async def analyze_message_async(external_id, text):
-    return await asyncio.to_thread(_analyze_message_sync, external_id, text)
+async def get_user_stats(external_id):
+    return await run_db(get_user_stats_sync, external_id)
+
+
+async def extract_memory_async(external_id):
+    """
+    One LLM call per batch of new messages that replaces the separate
+    summary and per-message analysis calls.
+
+    Returns a strict JSON document with the updated profile summary,
+    important facts and current concerns (stored in ConversationSummary +
+    UserMemory.facts as before) plus sentiment/topics, overall and for each
+    pending user message. Each message's analysis is written to its
+    metadata["analysis"] and folded into UserMemoryStats in the same
+    transaction as the summary. Only the DB work runs in a thread.
+
+    Returns the parsed extraction dict (or None if there was nothing new or
+    the model output could not be parsed).
+    """
+    import json
+
+    await message_buffer.flush()
+    um, previous_summary, messages, pending, newest_id = await run_db(
+        _load_extraction_input_sync, external_id
+    )
+    if not messages:
+        return None
+
+    prompt = _build_extraction_prompt(previous_summary, messages, pending)
+    text_format = {"format": {
+        "type": "json_schema",
+        "name": "memory_extraction",
+        "schema": EXTRACTION_SCHEMA,
+        "strict": True,
+    }}
+
+    provider = get_provider("extraction")
+
+    async def call():
+        # background work: queues behind chat turns for an upstream slot
+        async with get_admission().slot(external_id, priority=PRIORITY_BACKGROUND):
+            text, usage = await provider.complete(MEMORY_MODEL, prompt, text=text_format)
+        record_usage("extraction", usage)
+        return text
+
+    # the prompt holds the previous summary and every pending message, so this
+    # only hits when the same batch is extracted again (a job retried after
+    # its store failed, or delivered twice by the queue); it is not expected
+    # to hit across users or across new messages
+    llm_cache = get_llm_cache()
+    key = request_key("extraction", provider.cache_namespace(MEMORY_MODEL), input=prompt, text=text_format)
+    out = await llm_cache.get_or_call("extraction", key, call)
+
+    extraction = _parse_extraction(out)
+    if extraction is None:
+        await llm_cache.discard(key)
+        # keep the old behaviour: the raw text becomes the summary
+        summary_text = out
+    else:
+        summary_text = json.dumps({k: extraction.get(k) for k in SUMMARY_KEYS})
+
+    cs = await run_db(_store_extraction_sync, um, summary_text, newest_id, pending, extraction)
+    await notify_summary_updated(external_id, cs.summary_text)
+    return extraction
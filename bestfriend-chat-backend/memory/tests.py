@@ -1,3 +1,283 @@
-from django.test import TestCase
+import time
+import uuid
+import asyncio
+from unittest import mock
 
-# Create your tests here.
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from . import recall, services
+from .jobs import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, JobDropped, JobSupervisor
+from .models import ConversationMessage, ConversationSummary, RecallSegment, UserMemory
+from .db import run_db
+from .scheduler import SummaryScheduler
+from .services import MessageWriteBuffer, load_turn_context_sync
+
+
+def _external_id():
+    return f"user:test-{uuid.uuid4().hex[:12]}"
+
+
+class JobSupervisorTests(SimpleTestCase):
+    async def _blocked(self, supervisor):
+        """Occupy the only worker until the returned event is set."""
+        gate = asyncio.Event()
+        supervisor.submit("block", "gate", gate.wait, priority=PRIORITY_HIGH)
+        await asyncio.sleep(0)
+        return gate
+
+    async def test_runs_in_priority_order(self):
+        supervisor = JobSupervisor(workers=1, limits={})
+        gate = await self._blocked(supervisor)
+        order = []
+
+        async def job(name):
+            order.append(name)
+
+        futures = [
+            supervisor.submit("t", "low", job, "low", priority=PRIORITY_LOW),
+            supervisor.submit("t", "normal", job, "normal", priority=PRIORITY_NORMAL),
+            supervisor.submit("t", "high", job, "high", priority=PRIORITY_HIGH),
+        ]
+        gate.set()
+        await asyncio.gather(*futures)
+        self.assertEqual(order, ["high", "normal", "low"])
+        await supervisor.drain(timeout=1)
+
+    async def test_same_key_is_merged(self):
+        supervisor = JobSupervisor(workers=1, limits={})
+        gate = await self._blocked(supervisor)
+        calls = []
+
+        async def job(value):
+            calls.append(value)
+            return value
+
+        first = supervisor.submit("extraction", "user:1", job, 1, priority=PRIORITY_LOW)
+        second = supervisor.submit("extraction", "user:1", job, 2, priority=PRIORITY_HIGH)
+        self.assertIs(first, second)
+        gate.set()
+        self.assertEqual(await first, 1)
+        self.assertEqual(calls, [1])
+        self.assertEqual(supervisor.stats()["merged"], 1)
+        await supervisor.drain(timeout=1)
+
+    async def test_full_queue_evicts_less_important_jobs(self):
+        supervisor = JobSupervisor(max_queue=1, workers=1, limits={})
+        gate = await self._blocked(supervisor)
+
+        async def job():
+            return "done"
+
+        low = supervisor.submit("t", "low", job, priority=PRIORITY_LOW)
+        high = supervisor.submit("t", "high", job, priority=PRIORITY_HIGH)
+        dropped = supervisor.submit("t", "other", job, priority=PRIORITY_LOW)
+        with self.assertRaises(JobDropped):
+            await low
+        with self.assertRaises(JobDropped):
+            await dropped
+        gate.set()
+        self.assertEqual(await high, "done")
+        await supervisor.drain(timeout=1)
+
+    async def test_drain_finishes_queued_jobs_then_refuses_new_ones(self):
+        supervisor = JobSupervisor(workers=2, limits={})
+        done = []
+
+        async def job(name):
+            await asyncio.sleep(0.01)
+            done.append(name)
+
+        for name in ("a", "b", "c"):
+            supervisor.submit("t", name, job, name)
+        await supervisor.drain(timeout=5)
+        self.assertEqual(sorted(done), ["a", "b", "c"])
+        with self.assertRaises(JobDropped):
+            await supervisor.submit("t", "late", job, "late")
+
+
+class SummarySchedulerTests(SimpleTestCase):
+    async def test_dropped_job_keeps_its_messages_pending(self):
+        loop = asyncio.get_running_loop()
+        futures = []
+
+        class Supervisor:
+            def submit(self, *args, **kwargs):
+                futures.append(loop.create_future())
+                return futures[-1]
+
+        scheduler = SummaryScheduler(job=None, threshold=2, idle_seconds=60, supervisor=Supervisor())
+        self.addCleanup(scheduler._cancel_idle_timer, "user:1")
+        scheduler.note_messages("user:1", 2)
+        scheduler.note_messages("user:1", 2)  # arrives while the first job runs
+        futures[0].set_exception(JobDropped())
+        await asyncio.sleep(0)
+
+        self.assertEqual(len(futures), 1)
+        self.assertEqual(scheduler.stats(), {"pending_users": 1, "pending_messages": 4, "running": 0})
+        self.assertFalse(scheduler._rerun)
+
+
+class MessageWriteBufferTests(TransactionTestCase):
+    def _buffer(self, **kwargs):
+        kwargs.setdefault("flush_interval", 60)
+        kwargs.setdefault("max_batch", 1000)
+        return MessageWriteBuffer(**kwargs)
+
+    def _contents(self, external_id):
+        return list(
+            ConversationMessage.objects.filter(user_memory__external_id=external_id)
+            .order_by("created_at", "id").values_list("content", flat=True)
+        )
+
+    async def test_flush_writes_in_order(self):
+        buffer = self._buffer()
+        a, b = _external_id(), _external_id()
+        for i in range(3):
+            buffer.add(a, "user", f"a{i}")
+            buffer.add(b, "assistant", f"b{i}")
+        self.assertEqual(await buffer.flush(), 6)
+        self.assertEqual(await run_db(self._contents, a), ["a0", "a1", "a2"])
+        self.assertEqual(await run_db(self._contents, b), ["b0", "b1", "b2"])
+        self.assertEqual(buffer.stats()["pending"], 0)
+        self.assertEqual(await buffer.flush(), 0)
+
+    async def test_unreachable_database_keeps_the_batch(self):
+        buffer = self._buffer()
+        external_id = _external_id()
+        buffer.add(external_id, "user", "kept")
+        with mock.patch.object(buffer, "_write_sync", side_effect=OperationalError("down")):
+            self.assertEqual(await buffer.flush(), 0)
+        self.assertEqual(buffer.stats()["pending"], 1)
+        self.assertEqual(await buffer.flush(), 1)
+        self.assertEqual(await run_db(self._contents, external_id), ["kept"])
+
+    async def test_rejected_rows_are_requeued_without_blocking_others(self):
+        buffer = self._buffer()
+        good, bad = _external_id(), _external_id()
+        buffer.add(good, "user", "fine")
+        buffer.add(bad, "user", "stale pk", user_memory_id=10 ** 9)
+        self.assertEqual(await buffer.flush(), 1)
+        self.assertEqual(await run_db(self._contents, good), ["fine"])
+        self.assertEqual(buffer.stats()["pending"], 1)
+        # the retry resolves the user's pk again
+        self.assertEqual(await buffer.flush(), 1)
+        self.assertEqual(await run_db(self._contents, bad), ["stale pk"])
+
+    async def test_rows_rejected_too_often_are_dropped(self):
+        buffer = self._buffer(max_attempts=1)
+        buffer.add(_external_id(), "user", "bad", user_memory_id=10 ** 9)
+        self.assertEqual(await buffer.flush(), 0)
+        self.assertEqual(buffer.stats()["pending"], 0)
+        self.assertEqual(buffer.stats()["dropped"], 1)
+
+    async def test_prunes_every_n_inserts(self):
+        buffer = self._buffer(prune_every=5)
+        external_id = _external_id()
+        prune = services.prune_messages_sync
+        with mock.patch("memory.services.prune_messages_sync", side_effect=lambda pk: prune(pk, keep=3)):
+            for i in range(4):
+                buffer.add(external_id, "user", f"m{i}")
+            await buffer.flush()
+            self.assertEqual(buffer.stats()["prunes"], 0)
+            buffer.add(external_id, "user", "m4")
+            await buffer.flush()
+        self.assertEqual(buffer.stats()["prunes"], 1)
+        self.assertEqual(await run_db(self._contents, external_id), ["m2", "m3", "m4"])
+
+
+class LoadTurnContextTests(TestCase):
+    def test_known_user_in_two_queries_then_one(self):
+        external_id = _external_id()
+        um = UserMemory.objects.create(external_id=external_id, facts={"name": "Ana"})
+        ConversationSummary.objects.create(user_memory=um, summary_text="likes tea")
+        for i in range(5):
+            ConversationMessage.objects.create(user_memory=um, role="user", content=f"m{i}")
+        services._user_memory_ids.delete(external_id)
+
+        with self.assertNumQueries(2):
+            context = load_turn_context_sync(external_id, limit=3)
+        self.assertEqual(context["user_memory_id"], um.pk)
+        self.assertEqual(context["summary_text"], "likes tea")
+        self.assertEqual(context["facts"], {"name": "Ana"})
+        self.assertEqual([m["content"] for m in context["messages"]], ["m2", "m3", "m4"])
+
+        # pk, summary and facts are cached now: only the messages are read
+        with self.assertNumQueries(1):
+            self.assertEqual(load_turn_context_sync(external_id, limit=3), context)
+
+    def test_new_user_needs_no_message_query(self):
+        external_id = _external_id()
+        context = load_turn_context_sync(external_id)
+        self.assertEqual(context["messages"], [])
+        self.assertEqual(context["summary_text"], "")
+        self.assertTrue(UserMemory.objects.filter(pk=context["user_memory_id"]).exists())
+
+
+class RecallTests(TestCase):
+    def setUp(self):
+        self.embedder = recall.HashingEmbedder(dim=64)
+
+    def test_top_k_matches_a_full_sort(self):
+        import numpy as np
+        rng = np.random.default_rng(0)
+        matrix = recall._normalize_rows(rng.standard_normal((200, 64)).astype(np.float32))
+        queries = recall._normalize_rows(rng.standard_normal((3, 64)).astype(np.float32))
+        idx, scores = recall.top_k(matrix, queries, 5)
+        expected = np.argsort(-(queries @ matrix.T), axis=1)[:, :5]
+        self.assertEqual(idx.tolist(), expected.tolist())
+        self.assertTrue(np.all(np.diff(scores, axis=1) <= 0))
+        self.assertEqual(recall.top_k(matrix[:2], queries, 5)[0].shape, (3, 2))
+
+    def test_search_finds_shared_words(self):
+        texts = ["my dog is called Rex", "I work as a nurse in Lisbon", "green tea every morning"]
+        index = recall.RecallIndex(self.embedder.embed_sync(texts),
+                                   [[i, "user", t] for i, t in enumerate(texts)], version=1)
+        hits = index.search(self.embedder.embed_sync(["what is my dog called"]), k=2, min_score=0.1)[0]
+        self.assertEqual(hits[0]["content"], texts[0])
+        self.assertGreater(hits[0]["score"], 0.1)
+
+    def test_appends_fill_tails_and_reload_incrementally(self):
+        external_id = _external_id()
+        um = services.get_or_create_user_memory_sync(external_id)
+        texts = [f"note {i} about topic{i}" for i in range(9)]
+        indexes = []
+        with mock.patch.object(recall, "RECALL_TAIL_SIZE", 2), mock.patch.object(recall, "RECALL_SEGMENT_SIZE", 4):
+            for start in range(0, 9, 3):
+                batch = texts[start:start + 3]
+                recall._append_vectors_sync(
+                    um, self.embedder, self.embedder.embed_sync(batch),
+                    [[start + i, "user", t] for i, t in enumerate(batch)], start + len(batch) - 1,
+                )
+                indexes.append(recall.load_index_sync(external_id, self.embedder))
+
+        # every two full tails were merged into one segment, then the open tail
+        segments = list(RecallSegment.objects.filter(user_memory=um).order_by("id").values_list("id", "size"))
+        self.assertEqual([size for _, size in segments], [4, 4, 1])
+        index = indexes[-1]
+        self.assertEqual(index.version, 8)
+        self.assertEqual([e[0] for e in index.entries], list(range(9)))
+        self.assertEqual(index.matrix.tolist(), self.embedder.embed_sync(texts).tolist())
+        # the merged segment did not change since the second load: its block was reused
+        merged_id = segments[0][0]
+        self.assertIs(index.segments[merged_id][1], indexes[1].segments[merged_id][1])
+
+        # over RECALL_MAX_ROWS only the newest segments are searched, and that is logged
+        recall._index_cache.clear()
+        with mock.patch.object(recall, "RECALL_MAX_ROWS", 5), self.assertLogs("memory.recall", "INFO") as logs:
+            capped = recall.load_index_sync(external_id, self.embedder)
+        self.assertEqual([e[0] for e in capped.entries], list(range(4, 9)))
+        self.assertIn("4 older rows skipped", logs.output[0])
+
+    async def test_collect_recall_budget_counts_from_the_message(self):
+        async def lookup(delay):
+            await asyncio.sleep(delay)
+            return [{"content": "hit"}]
+
+        quick = asyncio.ensure_future(lookup(0.01))
+        self.assertEqual(await recall.collect_recall(quick, time.perf_counter(), wait=1), [{"content": "hit"}])
+        # the message arrived a while ago: the budget is used up, no waiting
+        late = asyncio.ensure_future(lookup(1))
+        self.assertEqual(await recall.collect_recall(late, time.perf_counter() - 1, wait=1), [])
+        await asyncio.sleep(0)
+        self.assertTrue(late.cancelled())